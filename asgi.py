@@ -0,0 +1,465 @@
+import asyncio
+import base64
+import binascii
+import json
+import os
+import time
+from urllib.parse import parse_qs
+
+import bcrypt
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from flask import Config
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+import server
+from utils.hashing import (HashingPool, PoolSaturated, checkpw,
+                           configured_rounds, hashpw, needs_rehash)
+from utils.memory_store import AsyncMemoryClient
+from utils.request_body import BodyError, validate
+from utils.serializer import Serializer
+from utils.token_cache import TokenCache
+from utils.tokens import REVOKED_COLLECTION, SignedTokens, revoked_query
+from utils.trip_patch import patch_update
+
+# Async entry point serving the same /trips/, /register/ and /login/ API as
+# server.py from an ASGI server, e.g.
+#
+#     uvicorn asgi:app --workers 4
+#
+# Mongo is reached through motor so a worker can keep many requests in
+# flight, and bcrypt still runs on the HashingPool, awaited from the loop.
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status, headers=None):
+        self.status = status
+        self.headers = headers or []
+
+
+class AsyncRequest(object):
+
+    def __init__(self, scope, body):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.args = dict((key, values[-1]) for key, values in parse_qs(
+            scope.get("query_string", b"").decode("latin-1")).items())
+        self.headers = dict((key.decode("latin-1").lower(),
+                             value.decode("latin-1"))
+                            for key, value in scope.get("headers", []))
+        self.body = body
+        self._json = None
+
+    @property
+    def json(self):
+        if self._json is None:
+            # As in server.parsed_body, no body reads as an empty object
+            if not self.body.strip():
+                self._json = {}
+                return self._json
+            try:
+                self._json = json.loads(self.body.decode("utf-8"))
+            except ValueError:
+                raise HTTPError(400)
+            if not isinstance(self._json, dict):
+                raise HTTPError(400)
+        return self._json
+
+    def field(self, name):
+        try:
+            return self.json[name]
+        except KeyError:
+            raise HTTPError(400)
+
+    def validate(self, schema):
+        try:
+            validate(self.json, schema)
+        except BodyError as e:
+            raise HTTPError(e.status)
+
+    # (username, token) from a Basic Authorization header or the body
+    def credentials(self):
+        scheme, _, value = self.headers.get("authorization", "").partition(
+            " ")
+        if scheme.lower() == "basic":
+            try:
+                decoded = base64.b64decode(value).decode("utf-8")
+            except (binascii.Error, ValueError):
+                raise HTTPError(401)
+            username, _, token = decoded.partition(":")
+            return username, token
+        return self.json.get("username"), self.json.get("token")
+
+
+class TripAPI(object):
+
+    def __init__(self, config):
+        self.config = config
+        self.token_cache = TokenCache(config['TOKEN_CACHE_SIZE'],
+                                      config['TOKEN_CACHE_TTL'])
+        self.signed_tokens = None
+        if config['AUTH_TOKEN_MODE'] == 'signed':
+            self.signed_tokens = SignedTokens(config['SECRET_KEY'],
+                                              config['AUTH_TOKEN_MAX_AGE'])
+        self.serializer = Serializer(config['JSON_BACKEND'])
+        self.hasher = HashingPool(config['HASH_EXECUTOR'],
+                                  config['HASH_WORKERS'],
+                                  config['HASH_QUEUE_SIZE'])
+        self.bcrypt_rounds = configured_rounds(config)
+        self.rehash_tolerance = config['BCRYPT_REHASH_TOLERANCE']
+        self.client = None
+        self.db = None
+        self._startup = None
+
+    # Runs once per worker, from the lifespan protocol or the first request
+    async def ensure_started(self):
+        if self._startup is None:
+            self._startup = asyncio.ensure_future(self.startup())
+        await self._startup
+
+    # Motor binds to the running loop, so connect from inside the worker
+    async def startup(self):
+        config = self.config
+        if config['MONGO_BACKEND'] == 'mongo':
+            self.client = AsyncIOMotorClient(
+                config['MONGO_URI'],
+                maxPoolSize=config['MONGO_MAX_POOL_SIZE'],
+                minPoolSize=config['MONGO_MIN_POOL_SIZE'],
+                waitQueueTimeoutMS=config['MONGO_WAIT_QUEUE_TIMEOUT_MS'],
+                connectTimeoutMS=config['MONGO_CONNECT_TIMEOUT_MS'],
+                socketTimeoutMS=config['MONGO_SOCKET_TIMEOUT_MS'],
+                serverSelectionTimeoutMS=config[
+                    'MONGO_SERVER_SELECTION_TIMEOUT_MS'],
+                readPreference=config['MONGO_READ_PREFERENCE'])
+        elif config['MONGO_BACKEND'] == 'memory':
+            # Each worker gets a database of its own, as in server.py
+            self.client = AsyncMemoryClient()
+        else:
+            raise ValueError("Unknown MONGO_BACKEND: %s" %
+                             config['MONGO_BACKEND'])
+        self.db = self.client[config['MONGO_DBNAME']]
+        await self.db.users.create_index([("username", ASCENDING)],
+                                         unique=True)
+        await self.db.trips.create_index([("username", ASCENDING),
+                                          ("_id", ASCENDING)])
+        await self.db.trip_changes.create_index([("username", ASCENDING),
+                                                 ("seq", ASCENDING)],
+                                                unique=True)
+
+    async def shutdown(self):
+        if self.client is not None:
+            self.client.close()
+        self.hasher.shutdown(wait=False)
+
+    async def run_hasher(self, fn, *args):
+        try:
+            future = self.hasher.submit(fn, *args)
+        except PoolSaturated:
+            raise HTTPError(429, [(b"retry-after", b"1")])
+        return await asyncio.wrap_future(future)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if len(body) > self.config['MAX_BODY_BYTES']:
+                await self.send(send, 413, {"data": []})
+                return
+
+        await self.ensure_started()
+        request = AsyncRequest(scope, body)
+        try:
+            handler, kwargs = self.route(request)
+            result = await handler(request, **kwargs)
+        except HTTPError as e:
+            await self.send(send, e.status, {"data": []}, e.headers)
+            return
+        if callable(result):
+            await result(send)
+        else:
+            await self.send(send, *result)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await self.ensure_started()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def send(self, send, status, payload, headers=None):
+        body = self.serializer.dumps(payload)
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/json"),
+                        (b"content-length", str(len(body)).encode())] +
+            list(headers or [])
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    def route(self, request):
+        routes = {
+            ("POST", "/register/"): self.register,
+            ("POST", "/login/"): self.login,
+            ("GET", "/trips/"): self.list_trips,
+            ("POST", "/trips/"): self.create_trip,
+        }
+        handler = routes.get((request.method, request.path))
+        if handler is not None:
+            return handler, {}
+        if request.path.startswith("/trips/"):
+            trip_id = request.path[len("/trips/"):]
+            handler = {
+                "GET": self.get_trip,
+                "PUT": self.replace_trip,
+                "PATCH": self.patch_trip,
+                "DELETE": self.delete_trip
+            }.get(request.method)
+            if trip_id and "/" not in trip_id:
+                if handler is None:
+                    raise HTTPError(405)
+                return handler, {"trip_id": trip_id}
+        if any(path == request.path for _, path in routes):
+            raise HTTPError(405)
+        raise HTTPError(404)
+
+    async def register(self, request):
+        request.validate(server.CREDENTIALS_SCHEMA)
+        pw_bytes = request.field("password").encode('utf-8')
+        hashed = await self.run_hasher(hashpw, pw_bytes,
+                                       bcrypt.gensalt(self.bcrypt_rounds))
+        user = {
+            "username": request.field("username"),
+            "password": hashed.decode('utf-8')
+        }
+        try:
+            await self.db.users.insert_one(user)
+        except DuplicateKeyError:
+            raise HTTPError(409)
+        return 200, {"username": user["username"]}
+
+    async def login(self, request):
+        request.validate(server.CREDENTIALS_SCHEMA)
+        result = await self.db.users.find_one(
+            {"username": request.field("username")})
+        if not result:
+            raise HTTPError(401)
+        pw_bytes = request.field("password").encode('utf-8')
+        h_bytes = result["password"].encode('utf-8')
+        if not await self.run_hasher(checkpw, pw_bytes, h_bytes):
+            raise HTTPError(401)
+        updates = {}
+        if needs_rehash(h_bytes, self.bcrypt_rounds, self.rehash_tolerance):
+            try:
+                rehashed = await self.run_hasher(
+                    hashpw, pw_bytes, bcrypt.gensalt(self.bcrypt_rounds))
+                updates["password"] = rehashed.decode('utf-8')
+            except HTTPError:
+                pass
+        if self.signed_tokens is not None:
+            token = self.signed_tokens.issue(result["username"])
+        else:
+            token = bcrypt.gensalt(10).decode('utf-8')
+            updates["token"] = token
+        if updates:
+            await self.db.users.update_one({"username": result["username"]},
+                                           {"$set": updates})
+        if self.signed_tokens is None:
+            self.token_cache.set(result["username"], token)
+        return 200, {"username": result["username"], "token": token}
+
+    # Same token check as server.requires_auth; returns the username
+    async def authenticate(self, request):
+        username, token = request.credentials()
+        if not isinstance(username, str) or not isinstance(token, str):
+            raise HTTPError(401)
+        if self.signed_tokens is not None:
+            token_id = self.signed_tokens.token_id(token, username)
+            if token_id is None:
+                raise HTTPError(401)
+            # Logouts are made through the Flask app, so there is only
+            # anything to check when they are shared
+            if self.config['AUTH_REVOCATION_BACKEND'] == 'mongo':
+                revoked = await self.db[REVOKED_COLLECTION].find_one(
+                    revoked_query(token_id, time.time()), {"_id": 1})
+                if revoked is not None:
+                    raise HTTPError(401)
+            return username
+        cached = self.token_cache.get(username)
+        if cached is not None and cached == token:
+            return username
+        user = await self.db.users.find_one({"username": username})
+        if user and user.get("token") is not None:
+            self.token_cache.set(username, user["token"])
+        if not user or user.get("token") != token:
+            raise HTTPError(401)
+        return username
+
+    async def create_trip(self, request):
+        username = await self.authenticate(request)
+        request.validate(server.TRIP_SCHEMA)
+        try:
+            trip = server.trip_document(
+                dict((field, request.json[field])
+                     for field in server.TRIP_FIELDS
+                     if field in request.json), username)
+        except ValueError:
+            raise HTTPError(400)
+        await self.db.trips.insert_one(trip)
+        await self.record_change(username, "upsert", trip["_id"])
+        return 200, trip
+
+    async def list_trips(self, request):
+        username = await self.authenticate(request)
+        query = {"username": username}
+        try:
+            if request.args.get("after"):
+                query["_id"] = {"$gt": ObjectId(request.args["after"])}
+            limit = int(request.args.get(
+                "limit", self.config['TRIPS_PAGE_SIZE']))
+        except (InvalidId, ValueError):
+            raise HTTPError(400)
+        if not 0 < limit <= self.config['TRIPS_MAX_PAGE_SIZE']:
+            raise HTTPError(400)
+        projection = None
+        if request.args.get("fields"):
+            fields = request.args["fields"].split(",")
+            if any(not field or field.startswith("$") for field in fields):
+                raise HTTPError(400)
+            projection = dict((field, 1) for field in fields)
+
+        cursor = self.db.trips.find(query, projection).sort(
+            "_id", ASCENDING).limit(limit)
+        if request.args.get("stream") in ("1", "true"):
+            return self.stream_trips(cursor)
+        trips = await cursor.to_list(length=limit)
+        headers = []
+        if len(trips) == limit:
+            headers.append((b"x-next-cursor", str(trips[-1]["_id"]).encode()))
+        return 200, trips, headers
+
+    def stream_trips(self, cursor):
+        async def write(send):
+            await send({
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(b"content-type", b"application/json")]
+            })
+            separator = b"["
+            async for trip in cursor:
+                await send({"type": "http.response.body",
+                            "body": separator + self.serializer.dumps(trip),
+                            "more_body": True})
+                separator = b","
+            await send({"type": "http.response.body",
+                        "body": b"[]" if separator == b"[" else b"]"})
+        return write
+
+    async def get_trip(self, request, trip_id):
+        username = await self.authenticate(request)
+        trip = await self.db.trips.find_one({"_id": object_id(trip_id)})
+        if trip is None:
+            raise HTTPError(404)
+        if trip["username"] != username:
+            raise HTTPError(401)
+        return 200, trip
+
+    async def replace_trip(self, request, trip_id):
+        username = await self.authenticate(request)
+        request.validate(server.TRIP_SCHEMA)
+        try:
+            replacement = server.trip_document(request.json, username)
+        except ValueError:
+            raise HTTPError(400)
+        trip = await self.db.trips.find_one_and_replace(
+            {"_id": object_id(trip_id), "username": username},
+            replacement, return_document=ReturnDocument.AFTER)
+        if trip is None:
+            await self.missing_or_unauthorized(trip_id)
+        await self.record_change(username, "upsert", trip["_id"])
+        return 200, trip
+
+    async def patch_trip(self, request, trip_id):
+        username = await self.authenticate(request)
+        request.validate(server.PATCH_SCHEMA)
+        try:
+            update, array_filters, waypoints = patch_update(
+                request.json["patch"])
+        except ValueError:
+            raise HTTPError(400)
+        server.stamp_version(update.setdefault("$set", {}))
+        query = {"_id": object_id(trip_id), "username": username}
+        trip = await self.db.trips.find_one_and_update(
+            dict(query, **waypoints), update,
+            array_filters=array_filters or None,
+            return_document=ReturnDocument.AFTER)
+        if trip is None:
+            if waypoints and await self.db.trips.find_one(query, {"_id": 1}):
+                raise HTTPError(409)
+            await self.missing_or_unauthorized(trip_id)
+        await self.record_change(username, "upsert", trip["_id"])
+        return 200, trip
+
+    async def delete_trip(self, request, trip_id):
+        username = await self.authenticate(request)
+        result = await self.db.trips.delete_one(
+            {"_id": object_id(trip_id), "username": username})
+        if result.deleted_count != 1:
+            await self.missing_or_unauthorized(trip_id)
+        await self.record_change(username, "delete", object_id(trip_id))
+        return 200, {"data": []}
+
+    # Same numbering as server.record_changes, so the Flask app's
+    # /trips/changes feed also covers writes made through this app
+    async def record_change(self, username, op, trip_id):
+        last = await self.db.trip_changes.find_one(
+            {"username": username}, {"seq": 1}, sort=[("seq", DESCENDING)])
+        seq = last["seq"] if last is not None else 0
+        while True:
+            try:
+                await self.db.trip_changes.insert_many(
+                    server.change_entries(username, seq, [(op, trip_id)]))
+                return
+            except BulkWriteError as e:
+                failed = e.details["writeErrors"]
+                if not failed or failed[0]["code"] != 11000:
+                    raise
+                seq += 1
+
+    async def missing_or_unauthorized(self, trip_id):
+        trip = await self.db.trips.find_one({"_id": object_id(trip_id)},
+                                            {"_id": 1})
+        raise HTTPError(404 if trip is None else 401)
+
+
+def object_id(value):
+    try:
+        return ObjectId(value)
+    except InvalidId:
+        raise HTTPError(404)
+
+
+def create_asgi_app(config=None):
+    app_config = Config(os.path.dirname(os.path.abspath(server.__file__)))
+    app_config.update(server.DEFAULT_CONFIG)
+    app_config.from_envvar('TRIP_PLANNER_SETTINGS', silent=True)
+    app_config.update(config or {})
+    return TripAPI(app_config)
+
+
+app = create_asgi_app()
@@ -0,0 +1,258 @@
+import argparse
+import datetime
+import itertools
+import json
+import random
+import subprocess
+import threading
+
+import bcrypt
+from bson.objectid import ObjectId
+
+from benchmarks.http_load import call, run_load
+
+# Latency/throughput suite for the trip API. Seeds N users with M trips
+# each, drives every endpoint at the requested concurrency and writes
+# throughput plus latency percentiles to a JSON file, so runs from
+# different commits can be diffed:
+#
+#     python -m benchmarks.api_bench --mongomock          # no mongod needed
+#     python -m benchmarks.api_bench                      # local mongod
+#     python -m benchmarks.api_bench --url http://localhost:8000
+#
+# In-process runs go through Flask's test client, which keeps the numbers
+# about the handlers and Mongo rather than the HTTP server in front.
+
+ENDPOINTS = ["list_trips", "get_trip", "create_trip", "update_trip",
+             "login"]
+
+
+# Serves requests through per-thread Flask test clients
+class InProcessClient(object):
+
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+
+    def __call__(self, method, path, payload):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.open(path, method=method,
+                               data=json.dumps(payload),
+                               content_type='application/json')
+        return response.status_code, response.data
+
+
+class HttpClient(object):
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    def __call__(self, method, path, payload):
+        return call(self.base_url, method, path, payload)
+
+
+# Writes users and trips straight into the database and returns each
+# user's credentials with the ids of its trips
+def seed_database(db, users, trips, rounds):
+    db.drop_collection('users')
+    db.drop_collection('trips')
+    # Every user shares one password, so it only has to be hashed once
+    hashed = bcrypt.hashpw(b"pass", bcrypt.gensalt(rounds)).decode('utf-8')
+    seeded = []
+    for i in range(users):
+        username = "bench%d" % i
+        token = bcrypt.gensalt(10).decode('utf-8')
+        db.users.insert_one({"username": username, "password": hashed,
+                             "token": token})
+        documents = [{"_id": ObjectId(), "name": "Trip %d" % j,
+                      "username": username} for j in range(trips)]
+        if documents:
+            db.trips.insert_many(documents)
+        seeded.append({"username": username, "token": token,
+                       "trip_ids": [str(d["_id"]) for d in documents]})
+    return seeded
+
+
+# Seeds a server we can only reach over HTTP, through the API itself
+def seed_over_http(client, users, trips):
+    seeded = []
+    run_id = ObjectId()
+    for i in range(users):
+        username = "bench%s-%d" % (run_id, i)
+        client("POST", "/register/", {"username": username,
+                                      "password": "pass"})
+        status, body = client("POST", "/login/", {"username": username,
+                                                  "password": "pass"})
+        token = json.loads(body.decode("utf-8"))["token"]
+        ops = [{"op": "create", "trip": {"name": "Trip %d" % j}}
+               for j in range(trips)]
+        trip_ids = []
+        for start in range(0, len(ops), 1000):
+            status, body = client("POST", "/trips/bulk",
+                                  {"username": username, "token": token,
+                                   "ops": ops[start:start + 1000]})
+            trip_ids.extend(r["_id"] for r in
+                            json.loads(body.decode("utf-8"))["results"])
+        seeded.append({"username": username, "token": token,
+                       "trip_ids": trip_ids})
+    return seeded
+
+
+def scenario(name, client, seeded):
+    users = itertools.cycle(seeded)
+    lock = threading.Lock()
+
+    def next_user():
+        with lock:
+            return next(users)
+
+    def list_trips():
+        user = next_user()
+        return client("GET", "/trips/", {"username": user["username"],
+                                         "token": user["token"]})[0]
+
+    def get_trip():
+        user = next_user()
+        return client("GET", "/trips/" + random.choice(user["trip_ids"]),
+                      {"username": user["username"],
+                       "token": user["token"]})[0]
+
+    def create_trip():
+        user = next_user()
+        return client("POST", "/trips/", {"username": user["username"],
+                                          "token": user["token"],
+                                          "name": "Bench trip"})[0]
+
+    def update_trip():
+        user = next_user()
+        return client("PUT", "/trips/" + random.choice(user["trip_ids"]),
+                      {"username": user["username"], "token": user["token"],
+                       "name": "Updated bench trip"})[0]
+
+    # Logging in rotates the token, so each login re-reads it from the
+    # response to keep the other scenarios authenticated
+    def login():
+        user = next_user()
+        status, body = client("POST", "/login/",
+                              {"username": user["username"],
+                               "password": "pass"})
+        if status == 200:
+            user["token"] = json.loads(body.decode("utf-8"))["token"]
+        return status
+
+    return {
+        "list_trips": list_trips,
+        "get_trip": get_trip,
+        "create_trip": create_trip,
+        "update_trip": update_trip,
+        "login": login
+    }[name]
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1,
+                int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(samples, elapsed):
+    latencies = sorted(seconds * 1000 for _, seconds in samples)
+    statuses = {}
+    for status, _ in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        "requests": len(samples),
+        "statuses": statuses,
+        "errors": sum(1 for status, _ in samples
+                      if status is None or status >= 400),
+        "throughput": len(samples) / elapsed if elapsed else None,
+        "latency_ms": {
+            "mean": sum(latencies) / len(latencies) if latencies else None,
+            "p50": percentile(latencies, 0.50),
+            "p90": percentile(latencies, 0.90),
+            "p99": percentile(latencies, 0.99),
+            "max": latencies[-1] if latencies else None
+        }
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the trip API endpoints")
+    parser.add_argument("--url", help="benchmark a running server instead "
+                                      "of the app in-process")
+    parser.add_argument("--mongomock", action="store_true",
+                        help="run in-process against mongomock")
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017/")
+    parser.add_argument("--database", default="benchmark_database")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--trips", type=int, default=100,
+                        help="trips per user")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=1000,
+                        help="requests per endpoint")
+    parser.add_argument("--bcrypt-rounds", type=int, default=12)
+    parser.add_argument("--endpoints", nargs="+", default=ENDPOINTS,
+                        choices=ENDPOINTS)
+    parser.add_argument("--output", default="bench_output.json")
+    args = parser.parse_args(argv)
+
+    if args.url:
+        client = HttpClient(args.url)
+        seeded = seed_over_http(client, args.users, args.trips)
+    else:
+        import server
+        # Measures the handlers themselves, so no rate limits or shedding
+        app = server.create_app({'MONGO_URI': args.mongo_uri,
+                                 'MONGO_DBNAME': args.database,
+                                 'RATE_LIMIT_BACKEND': None,
+                                 'SHED_MAX_IN_FLIGHT': None,
+                                 'SHED_MAX_POOL_WAIT': None})
+        if args.mongomock:
+            import mongomock
+            app.db = mongomock.MongoClient()[args.database]
+            app.write_behind.database = lambda: app.db
+        server.ensure_indexes(app.db)
+        seeded = seed_database(app.db, args.users, args.trips,
+                               args.bcrypt_rounds)
+        client = InProcessClient(app)
+
+    results = {}
+    for name in args.endpoints:
+        samples, elapsed = run_load(scenario(name, client, seeded),
+                                    args.concurrency, args.requests)
+        results[name] = summarize(samples, elapsed)
+        print("%-12s %9.1f req/s  p50 %7.2f ms  p99 %7.2f ms  errors %d" % (
+            name, results[name]["throughput"],
+            results[name]["latency_ms"]["p50"],
+            results[name]["latency_ms"]["p99"],
+            results[name]["errors"]))
+
+    report = {
+        "revision": git_revision(),
+        "timestamp": datetime.datetime.utcnow().isoformat(),
+        "target": args.url or ("mongomock" if args.mongomock
+                               else args.mongo_uri),
+        "users": args.users,
+        "trips_per_user": args.trips,
+        "concurrency": args.concurrency,
+        "results": results
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
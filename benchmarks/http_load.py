@@ -0,0 +1,99 @@
+import argparse
+import json
+import threading
+import time
+import uuid
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+# Drives GET /trips/ against one or more running servers at increasing
+# concurrency and prints the throughput of each, e.g. to compare the
+# threaded Flask server with the ASGI entry point:
+#
+#     python server.py                          # :5000
+#     uvicorn asgi:app --port 8000 --workers 1
+#     python -m benchmarks.http_load http://localhost:5000 \
+#         http://localhost:8000 --concurrency 1 16 64 256
+
+
+def call(base_url, method, path, payload, timeout=30):
+    request = Request(base_url.rstrip("/") + path,
+                      data=json.dumps(payload).encode("utf-8"),
+                      headers={"Content-Type": "application/json"},
+                      method=method)
+    try:
+        with urlopen(request, timeout=timeout) as response:
+            return response.status, response.read()
+    except HTTPError as e:
+        return e.code, e.read()
+
+
+# Registers a throwaway user with a few trips and returns its credentials
+def seed_user(base_url, trips=20):
+    username = "load-%s" % uuid.uuid4().hex
+    call(base_url, "POST", "/register/",
+         {"username": username, "password": "pass"})
+    status, body = call(base_url, "POST", "/login/",
+                        {"username": username, "password": "pass"})
+    if status != 200:
+        raise RuntimeError("Login against %s failed: %s" % (base_url, status))
+    auth = {"username": username,
+            "token": json.loads(body.decode("utf-8"))["token"]}
+    for i in range(trips):
+        call(base_url, "POST", "/trips/", dict(auth, name="Trip %d" % i))
+    return auth
+
+
+# Issues `requests` calls from `concurrency` threads; returns a list of
+# (status, seconds) samples and the wall clock time it all took
+def run_load(fn, concurrency, requests):
+    samples = []
+    lock = threading.Lock()
+    remaining = [requests]
+
+    def worker():
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            started = time.perf_counter()
+            try:
+                status = fn()
+            except Exception:
+                status = None
+            elapsed = time.perf_counter() - started
+            with lock:
+                samples.append((status, elapsed))
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, time.perf_counter() - started
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compare GET /trips/ throughput across servers")
+    parser.add_argument("urls", nargs="+")
+    parser.add_argument("--concurrency", type=int, nargs="+",
+                        default=[1, 16, 64, 256])
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args(argv)
+
+    print("%-30s %6s %10s %8s" % ("server", "conc", "req/s", "errors"))
+    for url in args.urls:
+        auth = seed_user(url)
+        for concurrency in args.concurrency:
+            samples, elapsed = run_load(
+                lambda: call(url, "GET", "/trips/", auth)[0],
+                concurrency, args.requests)
+            errors = sum(1 for status, _ in samples if status != 200)
+            print("%-30s %6d %10.1f %8d" %
+                  (url, concurrency, len(samples) / elapsed, errors))
+
+if __name__ == '__main__':
+    main()
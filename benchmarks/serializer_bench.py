@@ -0,0 +1,46 @@
+import argparse
+import timeit
+
+from bson.objectid import ObjectId
+
+from utils.mongo_json_encoder import JSONEncoder
+from utils.serializer import BACKENDS, Serializer
+
+
+# A GET /trips/ payload: trips as they come back from Mongo
+def make_trips(count):
+    return [{
+        "_id": ObjectId(),
+        "name": "Trip %d" % i,
+        "username": "user%d" % (i % 50)
+    } for i in range(count)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compare output_json serializers on a trip list")
+    parser.add_argument("--trips", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--number", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    trips = make_trips(args.trips)
+    candidates = [("JSONEncoder (default hook)",
+                   lambda: JSONEncoder().encode(trips))]
+    for backend in BACKENDS:
+        serializer = Serializer(backend)
+        candidates.append(("Serializer(%s)" % backend,
+                           lambda s=serializer: s.dumps(trips)))
+
+    baseline = None
+    print("%d trips, best of %d x %d runs" %
+          (args.trips, args.repeat, args.number))
+    for name, fn in candidates:
+        best = min(timeit.repeat(fn, repeat=args.repeat,
+                                 number=args.number)) / args.number
+        baseline = baseline or best
+        print("%-30s %8.2f ms  %5.2fx" %
+              (name, best * 1000, baseline / best))
+
+if __name__ == '__main__':
+    main()
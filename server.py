@@ -1,34 +1,525 @@
-from flask import Flask, request, make_response, jsonify
+from flask import (Flask, Response, current_app, g, request, make_response,
+                   jsonify)
 from flask_restful import Resource, Api
-from pymongo import MongoClient
+from pymongo import (ReturnDocument, ASCENDING, DESCENDING, GEOSPHERE,
+                     TEXT, InsertOne, ReplaceOne, DeleteOne)
+from pymongo.errors import (DuplicateKeyError, BulkWriteError,
+                            OperationFailure)
 from bson.objectid import ObjectId
-from utils.mongo_json_encoder import JSONEncoder
+from bson.errors import InvalidId
+from utils.metrics import Metrics
+from utils.memory_store import MemoryConnection
+from utils.mongo import MongoConnection, LazyDatabase
+from utils.request_body import BodyError, parsed_body, validate
+from utils.response_cache import create_cache
+from utils.compression import COMPRESSORS, compress, compress_stream
+from utils.serializer import BINARY_ENCODERS, Serializer
+from utils.token_cache import TokenCache
+from utils.tokens import SignedTokens, create_revocations
+from utils.trip_patch import patch_update, waypoint_documents
+from utils.trip_search import DATE_FIELDS, iso_date, search_query
+from utils.load_shedding import LoadShedder
+from utils.rate_limit import create_rate_limiter
+from utils.write_behind import WriteBehind
+from utils.hashing import (HashingPool, PoolSaturated, configured_rounds,
+                           needs_rehash)
+from werkzeug.http import quote_etag
+from werkzeug.middleware.proxy_fix import ProxyFix
+from collections import OrderedDict
 from functools import wraps
 import bcrypt
-import json
+import datetime
+import hashlib
+import math
+import time
 
-# Basic Setup
-app = Flask(__name__)
-mongo = MongoClient('localhost', 27017)
-app.db = mongo.develop_database
-api = Api(app)
+# Defaults, overridden by the file named in $TRIP_PLANNER_SETTINGS and
+# then by the mapping passed to create_app
+DEFAULT_CONFIG = {
+    # 'mongo', or 'memory' for the in-process stand-in (tests, demos)
+    'MONGO_BACKEND': 'mongo',
+    'MONGO_URI': 'mongodb://localhost:27017/',
+    'MONGO_DBNAME': 'develop_database',
+    'MONGO_MAX_POOL_SIZE': 100,
+    'MONGO_MIN_POOL_SIZE': 0,
+    'MONGO_WAIT_QUEUE_TIMEOUT_MS': 1000,
+    'MONGO_CONNECT_TIMEOUT_MS': 20000,
+    'MONGO_SOCKET_TIMEOUT_MS': None,
+    'MONGO_SERVER_SELECTION_TIMEOUT_MS': 30000,
+    'MONGO_READ_PREFERENCE': 'primary',
+    'TOKEN_CACHE_SIZE': 10000,
+    # Seconds a worker trusts a database token without asking the users
+    # collection. Logouts and re-logins reach the worker handling them at
+    # once but the others only when their entry expires, so this is how
+    # long a logged-out token may keep working there.
+    'TOKEN_CACHE_TTL': 30,
+    'AUTH_TOKEN_MODE': 'database',
+    'AUTH_TOKEN_MAX_AGE': 3600,
+    # Where signed-mode logouts are kept. 'memory' applies one only in the
+    # worker that handled it, the others accepting the token until
+    # AUTH_TOKEN_MAX_AGE runs out; 'mongo' shares them through the
+    # revoked_tokens collection, at a lookup per authenticated request.
+    'AUTH_REVOCATION_BACKEND': 'memory',
+    'SECRET_KEY': None,
+    'TRIPS_PAGE_SIZE': 100,
+    'TRIPS_MAX_PAGE_SIZE': 1000,
+    'BULK_MAX_OPS': 1000,
+    # Deepest /trips/search page; skipping costs a scan of what is skipped
+    'SEARCH_MAX_OFFSET': 10000,
+    'MAX_BODY_BYTES': 1024 * 1024,
+    'JSON_BACKEND': None,
+    'HASH_EXECUTOR': 'process',
+    'HASH_WORKERS': None,
+    'HASH_QUEUE_SIZE': None,
+    'BCRYPT_ROUNDS': None,
+    'BCRYPT_TARGET_SECONDS': 0.25,
+    'BCRYPT_MIN_ROUNDS': 10,
+    'BCRYPT_MAX_ROUNDS': 15,
+    # Logins rehash passwords stored this many rounds or more away from
+    # the current work factor. Calibration can differ by one round between
+    # workers, so 1 only suits a fixed BCRYPT_ROUNDS.
+    'BCRYPT_REHASH_TOLERANCE': 2,
+    'METRICS_ENABLED': False,
+    # Single-trip responses. The 'memory' backend is per worker and only
+    # invalidated by that worker's writes: others serve the old trip and
+    # ETag (and If-Match writes based on it get 412) until their entry
+    # expires. 'redis' is shared and invalidated by every write. TTL None
+    # is 5 seconds for 'memory' and 60 for 'redis'.
+    'RESPONSE_CACHE_BACKEND': 'memory',
+    'RESPONSE_CACHE_TTL': None,
+    'RESPONSE_CACHE_MAX_BYTES': 64 * 1024 * 1024,
+    'RESPONSE_CACHE_URL': None,
+    'COMPRESSION_ENABLED': True,
+    'COMPRESSION_MIN_BYTES': 1024,
+    'COMPRESSION_LEVEL': 6,
+    # Token buckets per client IP and per user (RATE_LIMIT_RATE requests a
+    # second, bursts of RATE_LIMIT_BURST) and for /register/ and /login/
+    # per IP (RATE_LIMIT_AUTH_*) and per username from any IP
+    # (RATE_LIMIT_AUTH_USER_*); backend None disables. Clients are told
+    # apart by their address, so behind a reverse proxy set PROXY_FIX_HOPS
+    # or every client shares the proxy's buckets.
+    'RATE_LIMIT_BACKEND': 'memory',
+    'RATE_LIMIT_URL': None,
+    'RATE_LIMIT_MAX_KEYS': 100000,
+    'RATE_LIMIT_RATE': 50,
+    'RATE_LIMIT_BURST': 100,
+    'RATE_LIMIT_AUTH_RATE': 0.2,
+    'RATE_LIMIT_AUTH_BURST': 10,
+    # Slows guessing one password from many addresses. Anyone can spend
+    # these buckets, so they are kept loose enough that doing so to lock
+    # a user out takes a sustained flood.
+    'RATE_LIMIT_AUTH_USER_RATE': 1,
+    'RATE_LIMIT_AUTH_USER_BURST': 30,
+    # Number of reverse proxies in front of the app whose X-Forwarded-*
+    # headers are trusted for the client address; 0 trusts none
+    'PROXY_FIX_HOPS': 0,
+    # Shed load beyond this many concurrent requests or this recent Mongo
+    # pool checkout wait in seconds; None disables either check
+    'SHED_MAX_IN_FLIGHT': 256,
+    'SHED_MAX_POOL_WAIT': 0.5,
+    # auth_events audit records are queued and written in batches from a
+    # background thread, once BATCH_SIZE are pending or INTERVAL seconds
+    # on; MAX_PENDING None writes them inline
+    'WRITE_BEHIND_MAX_PENDING': 10000,
+    'WRITE_BEHIND_BATCH_SIZE': 500,
+    'WRITE_BEHIND_INTERVAL': 0.1
+}
+
+# Media types responses can be encoded as, the default (JSON) first
+MEDIA_TYPES = ['application/json'] + list(BINARY_ENCODERS)
+
+
+# Indexes backing every query the handlers issue, as (collection, keys,
+# unique); see utils/query_plans.py. Writes to users and trip_changes rely
+# on their unique index to detect duplicates and concurrent writers.
+INDEXES = [
+    ("users", [("username", ASCENDING)], True),
+    ("trips", [("username", ASCENDING), ("_id", ASCENDING)], False),
+    # Trip search: date ranges, name text and waypoint geo queries
+    ("trips", [("username", ASCENDING), ("start_date", ASCENDING)], False),
+    ("trips", [("username", ASCENDING), ("name", TEXT)], False),
+    ("trips", [("waypoints.location", GEOSPHERE), ("username", ASCENDING)],
+     False),
+    ("trip_changes", [("username", ASCENDING), ("seq", ASCENDING)], True)
+]
+
+# Seconds between attempts at a unique index that couldn't be built
+INDEX_RETRY_INTERVAL = 60
+
+
+# Builds every index in INDEXES, each on its own so one that can't be
+# built doesn't hold back the rest. Returns [(index, error)] for those
+# that failed.
+def build_indexes(db, indexes=INDEXES):
+    failed = []
+    for index in indexes:
+        collection, keys, unique = index
+        try:
+            getattr(db, collection).create_index(keys, unique=unique)
+        except OperationFailure as e:
+            failed.append((index, e))
+    return failed
+
+
+# Builds every index, raising the first failure once the others are built
+def ensure_indexes(db):
+    failed = build_indexes(db)
+    if failed:
+        raise failed[0][1]
+
+
+# Builds the indexes on a worker's first request. Failures are logged, not
+# raised: Flask would retry on every request, each answering 500. The
+# likely one is the unique users index over duplicate usernames from
+# before it existed; utils/dedupe_users.py removes them. Until a missing
+# unique index is built, writes relying on it are refused (see
+# requires_unique_index).
+def bootstrap_indexes():
+    for index, error in build_indexes(current_app.db):
+        collection, keys, unique = index
+        current_app.logger.error(
+            "Could not build the %s index %s: %s. For duplicate usernames "
+            "run `python -m utils.dedupe_users`.", collection, keys, error)
+        if unique:
+            current_app.missing_indexes[collection] = (
+                time.monotonic() + INDEX_RETRY_INTERVAL)
+
+
+# True once the unique index of `collection` exists. One that failed to
+# build is retried every INDEX_RETRY_INTERVAL seconds, so fixing the data
+# takes effect without a restart.
+def unique_index_built(collection):
+    retry_at = current_app.missing_indexes.get(collection)
+    if retry_at is None:
+        return True
+    if time.monotonic() < retry_at:
+        return False
+    indexes = [index for index in INDEXES
+               if index[0] == collection and index[2]]
+    failed = build_indexes(current_app.db, indexes)
+    if failed:
+        current_app.missing_indexes[collection] = (
+            time.monotonic() + INDEX_RETRY_INTERVAL)
+        return False
+    current_app.missing_indexes.pop(collection, None)
+    current_app.logger.info("Built the unique %s index", collection)
+    return True
+
+
+# Answers 503 instead of writing to `collection` while its unique index is
+# missing: Register would create duplicate usernames and record_changes
+# would hand out duplicate change seqs
+def requires_unique_index(collection):
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            if not unique_index_built(collection):
+                response = error_response(503)
+                response.headers['Retry-After'] = str(INDEX_RETRY_INTERVAL)
+                return response
+            return f(*args, **kwargs)
+        return decorated
+    return decorator
+
+
+def error_response(status):
+    response = jsonify(data=[])
+    response.status_code = status
+    return response
+
+
+def bad_request():
+    return error_response(400)
+
+
+def too_many_requests(retry_after=1):
+    response = jsonify(data=[])
+    response.status_code = 429
+    response.headers['Retry-After'] = str(max(1, int(math.ceil(retry_after))))
+    return response
+
+
+# Endpoints where every attempt costs a bcrypt hash
+AUTH_ENDPOINTS = ('register', 'login')
+
+
+# Spends a token from each bucket in turn, answering 429 at the first
+# empty one
+def take_tokens(keys, rate, burst):
+    for key in keys:
+        allowed, retry_after = current_app.rate_limiter.take(key, rate,
+                                                              burst)
+        if not allowed:
+            return too_many_requests(retry_after)
+    return None
+
+
+# Limits requests per client IP and, for /register/ and /login/, far more
+# strictly per IP, which is what slows down password guessing, plus per
+# username across all IPs against guessing from many. The username bucket
+# is looser (RATE_LIMIT_AUTH_USER_*), anyone being able to spend it.
+# Authenticated endpoints add a per user limit in requires_auth.
+def limit_rate():
+    config = current_app.config
+    client = str(request.remote_addr)
+    if request.endpoint not in AUTH_ENDPOINTS:
+        return take_tokens(["ip:" + client], config['RATE_LIMIT_RATE'],
+                           config['RATE_LIMIT_BURST'])
+    limited = take_tokens(["auth-ip:" + client],
+                          config['RATE_LIMIT_AUTH_RATE'],
+                          config['RATE_LIMIT_AUTH_BURST'])
+    if limited is not None:
+        return limited
+    try:
+        username = request_body().get("username")
+    except BodyError:
+        # Left for the handler to reject
+        username = None
+    if not isinstance(username, str):
+        return None
+    return take_tokens(["auth-user:" + username],
+                       config['RATE_LIMIT_AUTH_USER_RATE'],
+                       config['RATE_LIMIT_AUTH_USER_BURST'])
+
+
+# Sheds the request with a 503 when the process is overloaded (see
+# LoadShedder); /metrics is always served so the overload stays visible
+def shed_load():
+    if request.endpoint == 'metrics':
+        return None
+    if not current_app.load_shedder.enter():
+        response = error_response(503)
+        response.headers['Retry-After'] = '1'
+        return response
+    g._admitted = True
+
+
+def release_load(exception):
+    if getattr(g, '_admitted', False):
+        g._admitted = False
+        current_app.load_shedder.leave()
+
+
+# Request body schemas: field -> (accepted types, required)
+CREDENTIALS_SCHEMA = {"username": (str, True), "password": (str, True)}
+TRIP_SCHEMA = {"name": (str, True), "waypoints": (list, False),
+               "start_date": (str, False), "end_date": (str, False)}
+PATCH_SCHEMA = {"patch": (list, True)}
+BULK_SCHEMA = {"ops": (list, True), "ordered": (bool, False)}
+
+# Fields a new trip is created from
+TRIP_FIELDS = ("name", "waypoints", "start_date", "end_date")
+
+# Body fields that describe the request rather than the trip
+REQUEST_ONLY_FIELDS = ("username", "token", "_id", "version", "updated_at")
+
+
+def request_body():
+    return parsed_body(current_app.config['MAX_BODY_BYTES'])
+
+
+# Validates the (once parsed) request body before the handler runs
+def json_body(schema):
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            try:
+                validate(request_body(), schema)
+            except BodyError as e:
+                return error_response(e.status)
+            return f(*args, **kwargs)
+        return decorated
+    return decorator
+
+
+# Credentials from an `Authorization: Basic base64(username:token)` header,
+# falling back to the username/token fields of the body
+def request_credentials(body):
+    auth = request.authorization
+    if auth is not None and auth.username:
+        return auth.username, auth.password
+    return body.get("username"), body.get("token")
+
+
+# Version reported for trips written before trips carried one
+LEGACY_VERSION = "0"
+
+
+# Gives a trip document a fresh version and updated_at; every write to a
+# trip goes through here so its ETag changes with it
+def stamp_version(trip):
+    trip["version"] = str(ObjectId())
+    trip["updated_at"] = datetime.datetime.utcnow()
+    return trip
+
+
+# Trip document to store from client supplied fields; raises ValueError
+# for malformed waypoints or dates
+def trip_document(fields, username):
+    trip = dict((key, value) for key, value in fields.items()
+                if key not in REQUEST_ONLY_FIELDS)
+    trip["username"] = username
+    trip["waypoints"] = waypoint_documents(trip.get("waypoints", []))
+    for field in DATE_FIELDS:
+        if field in trip:
+            iso_date(trip[field])
+    return stamp_version(trip)
+
+
+def trip_etag(trip):
+    return trip.get("version", LEGACY_VERSION)
+
+
+# Strong ETag of a page of trips: changes whenever any trip on it does
+def list_etag(trips, fields):
+    digest = hashlib.sha1((fields or "").encode('utf-8'))
+    for trip in trips:
+        digest.update(("|%s:%s" % (trip["_id"], trip_etag(trip)))
+                      .encode('utf-8'))
+    return digest.hexdigest()
+
+
+# ObjectId of the trip a URL names, or None if it can't name one (404)
+def trip_object_id(trip_id):
+    try:
+        return ObjectId(trip_id)
+    except InvalidId:
+        return None
+
+
+# Keyed on the normalized id: ObjectId() also takes upper case hex
+def trip_cache_key(username, trip_id):
+    return "trip:%s:%s" % (username, ObjectId(trip_id))
+
+
+# Cached trip entries are either b"<etag>\n<body>" or a marker left by the
+# last write, which readers treat as a miss
+STALE_PREFIX = b"stale:"
+
+
+# Called after every write to a trip. Rather than deleting the entry it
+# writes a fresh marker, so a get_trip that read the trip before the write
+# finds the entry changed and doesn't cache what it read.
+def invalidate_trip(username, trip_id):
+    cache = current_app.response_cache
+    if cache is not None:
+        cache.set(trip_cache_key(username, trip_id),
+                  STALE_PREFIX + str(ObjectId()).encode('utf-8'))
+
+
+# Seconds a worker trusts its record of a user's last change seq. Must
+# stay well below the age utils/compact_changes.py compacts from, so the
+# entry after a remembered seq can't have been compacted away.
+CHANGE_SEQ_TTL = 60
+
+
+def last_change_seq(change_collection, username):
+    last = change_collection.find_one({"username": username}, {"seq": 1},
+                                      sort=[("seq", DESCENDING)])
+    return last["seq"] if last is not None else 0
+
+
+# Change log entries are numbered 1, 2, ... per user. An entry is only
+# written once the one before it exists (a duplicate seq means another
+# writer took it, so we look up the last one again), which lets a reader
+# that has seen seq n never miss anything before it. Each worker remembers
+# the last seq it wrote per user, so a trip write usually costs the log a
+# single insert.
+def record_changes(username, changes):
+    change_collection = current_app.db.trip_changes
+    seq = current_app.change_seqs.get(username)
+    if seq is None:
+        seq = last_change_seq(change_collection, username)
+    while changes:
+        try:
+            change_collection.insert_many(change_entries(username, seq,
+                                                         changes))
+            seq += len(changes)
+            break
+        except BulkWriteError as e:
+            failed = e.details["writeErrors"]
+            if not failed or failed[0]["code"] != 11000:
+                raise
+            changes = changes[e.details["nInserted"]:]
+            seq = last_change_seq(change_collection, username)
+    current_app.change_seqs.set(username, seq)
+
+
+# Entries for (op, trip_id) changes numbered from after `seq`; op is
+# "upsert" or "delete", the latter being a tombstone for a removed trip
+def change_entries(username, seq, changes):
+    return [{"username": username, "seq": seq + offset, "op": op,
+             "trip_id": trip_id}
+            for offset, (op, trip_id) in enumerate(changes, 1)]
+
+
+def record_change(username, op, trip_id):
+    record_changes(username, [(op, trip_id)])
+
+
+# Records an authentication event in auth_events. The record is dropped
+# rather than written inline when the write-behind queue is full; an audit
+# trail isn't worth slowing logins down under load.
+def audit(event, username):
+    record = {
+        "event": event,
+        "username": username,
+        "ip": request.remote_addr,
+        "at": datetime.datetime.utcnow()
+    }
+    if current_app.write_behind is not None:
+        current_app.write_behind.insert("auth_events", record)
+    else:
+        current_app.db.auth_events.insert_one(record)
+
+
+def not_modified(etag, headers=None):
+    response = Response(status=304)
+    response.headers.extend(headers or {})
+    response.headers['ETag'] = quote_etag(etag)
+    return response
+
+
+# Maps an If-Match header onto a filter on the trip's version. If-Match
+# compares strongly, so weak tags (as compressing proxies make of ours)
+# never match; a header with nothing else matches no version, and the
+# write answers 412. No header at all means an unconditional write.
+def version_filter(if_match):
+    versions = list(if_match.as_set())
+    if 'If-Match' not in request.headers or if_match.star_tag:
+        return {}
+    if LEGACY_VERSION in versions:
+        return {"$or": [{"version": {"$in": versions}},
+                        {"version": {"$exists": False}}]}
+    return {"version": {"$in": versions}}
 
 
 # Implement REST Resource
 class Register(Resource):
 
+    @requires_unique_index("users")
+    @json_body(CREDENTIALS_SCHEMA)
     def post(self):
-        user_collection = app.db.users
-        pw_bytes = request.json["password"].encode('utf-8')
-        hashed = bcrypt.hashpw(pw_bytes, bcrypt.gensalt(12))
+        user_collection = current_app.db.users
+        body = request_body()
+        pw_bytes = body["password"].encode('utf-8')
+        try:
+            hashed = current_app.hasher.hashpw(
+                pw_bytes, bcrypt.gensalt(current_app.bcrypt_rounds))
+        except PoolSaturated:
+            return too_many_requests()
         user = {
-            "username": request.json["username"],
+            "username": body["username"],
             "password": hashed.decode('utf-8')
         }
-        result = user_collection.insert_one(user)
-        user = user_collection.find_one(
-            {"_id": ObjectId(result.inserted_id)})
-        if user:
+        try:
+            result = user_collection.insert_one(user)
+        except DuplicateKeyError:
+            response = jsonify(data=[])
+            response.status_code = 409
+            return response
+        if result.inserted_id is not None:
+            audit("register", user["username"])
             response = jsonify({
                 "username": user["username"]
             })
@@ -43,19 +534,50 @@ class Register(Resource):
 # Implement REST Resource
 class Login(Resource):
 
+    @json_body(CREDENTIALS_SCHEMA)
     def post(self):
-        user_collection = app.db.users
-        result = user_collection.find_one(
-            {"username": request.json["username"]})
+        user_collection = current_app.db.users
+        body = request_body()
+        result = user_collection.find_one({"username": body["username"]})
         if result:
-            pw_bytes = request.json["password"].encode('utf-8')
+            pw_bytes = body["password"].encode('utf-8')
             h_bytes = result["password"].encode('utf-8')
-            if bcrypt.hashpw(pw_bytes, h_bytes) == h_bytes:
-                token = bcrypt.gensalt(10).decode('utf-8')
-                user_collection.update_one(
-                    {"username": request.json["username"]},
-                    {"$set": {"token": token}}
-                )
+            try:
+                valid = current_app.hasher.checkpw(pw_bytes, h_bytes)
+            except PoolSaturated:
+                return too_many_requests()
+            if valid:
+                updates = {}
+                # Brings the stored hash to the current work factor, in
+                # either direction, while the plain password is at hand
+                if needs_rehash(h_bytes, current_app.bcrypt_rounds,
+                                current_app.config['BCRYPT_REHASH_TOLERANCE']):
+                    try:
+                        updates["password"] = current_app.hasher.hashpw(
+                            pw_bytes,
+                            bcrypt.gensalt(current_app.bcrypt_rounds)
+                        ).decode('utf-8')
+                    except PoolSaturated:
+                        # Not worth failing the login; retried next time
+                        pass
+                if current_app.signed_tokens is not None:
+                    token = current_app.signed_tokens.issue(
+                        result["username"])
+                else:
+                    token = bcrypt.gensalt(10).decode('utf-8')
+                    updates["token"] = token
+                if updates:
+                    # Inline: other workers must accept the new token as
+                    # soon as the client has it
+                    user_collection.update_one(
+                        {"username": result["username"]},
+                        {"$set": updates}
+                    )
+                if current_app.signed_tokens is None:
+                    # Replaces any cached token so the old one stops
+                    # validating
+                    current_app.token_cache.set(result["username"], token)
+                audit("login", result["username"])
                 response = jsonify({
                     "username": result["username"],
                     "token": token
@@ -63,137 +585,739 @@ class Login(Resource):
                 response.status_code = 200
                 return response
             else:
+                audit("login_failed", body["username"])
                 response = jsonify(data=[])
                 response.status_code = 401
                 return response
         else:
+            audit("login_failed", body["username"])
             response = jsonify(data=[])
             response.status_code = 401
             return response
 
 
+# True if `token` is the current token of `username`
+def authenticate(username, token):
+    # Signed tokens are checked in CPU alone, no users lookup
+    if current_app.signed_tokens is not None:
+        return current_app.signed_tokens.verify(token, username)
+    cached = current_app.token_cache.get(username)
+    if cached is not None and cached == token:
+        return True
+    user_collection = current_app.db.users
+    user = user_collection.find_one({"username": username})
+    if not user:
+        return False
+    if user.get("token") is not None:
+        current_app.token_cache.set(username, user["token"])
+    return user.get("token") == token
+
+
 def requires_auth(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        data = json.loads(request.data.decode("utf-8"))
-        username = data["username"]
-        token = data["token"]
-        user_collection = app.db.users
-        user = user_collection.find_one({"username": username})
-        if user:
-            if user["token"] != token:
-                response = jsonify(data=[])
-                response.status_code = 401
-                return response
-            else:
-                return f(*args, **kwargs)
-        else:
-            response = jsonify(data=[])
-            response.status_code = 401
-            return response
+        try:
+            body = request_body()
+        except BodyError as e:
+            return error_response(e.status)
+        username, token = request_credentials(body)
+        if not isinstance(username, str) or not isinstance(token, str):
+            return error_response(401)
+        if not authenticate(username, token):
+            return error_response(401)
+        if current_app.rate_limiter is not None:
+            limited = take_tokens(["user:" + username],
+                                  current_app.config['RATE_LIMIT_RATE'],
+                                  current_app.config['RATE_LIMIT_BURST'])
+            if limited is not None:
+                return limited
+        # Handlers act on behalf of this user
+        g.username = username
+        g.token = token
+        return f(*args, **kwargs)
     return decorated
 
 
+# Implement REST Resource
+class Logout(Resource):
+
+    # Ends the session of the token in the request: a signed token goes on
+    # the revocation list, a database token is removed from the user.
+    # Other workers may accept a database token for up to TOKEN_CACHE_TTL
+    # seconds more, until their cached copy expires, and a signed one until
+    # it expires unless AUTH_REVOCATION_BACKEND is shared.
+    @requires_auth
+    def post(self):
+        username = g.username
+        if current_app.signed_tokens is not None:
+            current_app.signed_tokens.revoke(g.token)
+        else:
+            current_app.db.users.update_one({"username": username},
+                                            {"$unset": {"token": ""}})
+            current_app.token_cache.invalidate(username)
+        audit("logout", username)
+        response = jsonify(data=[])
+        response.status_code = 200
+        return response
+
+
 # Implement REST Resource
 class Trip(Resource):
 
     @requires_auth
+    @requires_unique_index("trip_changes")
+    @json_body(TRIP_SCHEMA)
     def post(self):
-        trip_collection = app.db.trips
-        trip = {
-            "name": request.json["name"],
-            "username": request.json["username"]
-        }
-        result = trip_collection.insert_one(trip)
-        trip = trip_collection.find_one(
-            {"_id": ObjectId(result.inserted_id)})
-        return trip
+        trip_collection = current_app.db.trips
+        body = request_body()
+        try:
+            trip = trip_document(dict((field, body[field])
+                                      for field in TRIP_FIELDS
+                                      if field in body), g.username)
+        except ValueError:
+            return bad_request()
+        trip_collection.insert_one(trip)
+        # insert_one stores the generated _id on the document itself
+        record_change(g.username, "upsert", trip["_id"])
+        return trip, 200, {"ETag": quote_etag(trip_etag(trip))}
 
     @requires_auth
     def get(self, trip_id=None):
-        trip_collection = app.db.trips
+        trip_collection = current_app.db.trips
         if not trip_id:
-            trips = list(trip_collection.find(
-                {"username": request.json["username"]}))
-            return trips
+            return self.list_trips(trip_collection, g.username)
         else:
-            trip = trip_collection.find_one({"_id": ObjectId(trip_id)})
-            if trip is None:
-                response = jsonify(data=[])
-                response.status_code = 404
-                return response
-            else:
-                if trip["username"] == request.json["username"]:
-                    return trip
-                else:
-                    response = jsonify(data=[])
-                    response.status_code = 401
-                    return response
+            return self.get_trip(trip_collection, g.username, trip_id)
+
+    # Single trips are served from the response cache when possible, as
+    # the bytes encoded for an earlier request, skipping Mongo entirely
+    # Only JSON bodies are cached; binary encodings are cheap to produce
+    def get_trip(self, trip_collection, username, trip_id):
+        mediatype = response_mediatype()
+        cache = current_app.response_cache
+        if mediatype != 'application/json':
+            cache = None
+        if trip_object_id(trip_id) is None:
+            return error_response(404)
+        key = trip_cache_key(username, trip_id)
+        cached = cache.get(key) if cache is not None else None
+        if cached is not None and not cached.startswith(STALE_PREFIX):
+            etag, body = cached.split(b"\n", 1)
+            etag = etag.decode('utf-8')
+            if request.if_none_match.contains_weak(etag):
+                return not_modified(etag)
+            return json_response(body, 200, {"ETag": quote_etag(etag)})
 
-    @requires_auth
-    def put(self, trip_id):
-        trip_collection = app.db.trips
         trip = trip_collection.find_one({"_id": ObjectId(trip_id)})
         if trip is None:
             response = jsonify(data=[])
             response.status_code = 404
             return response
-        else:
-            if trip["username"] == request.json["username"]:
-                result = trip_collection.replace_one(
-                    {"_id": ObjectId(trip_id)}, request.json)
-                if result.modified_count == 1:
-                    trip = trip_collection.find_one({"_id": ObjectId(trip_id)})
-                    return trip
-                else:
-                    response = jsonify(data=[])
-                    response.status_code = 500
-                    return response
-            else:
-                response = jsonify(data=[])
-                response.status_code = 401
-                return response
+        if trip["username"] != username:
+            response = jsonify(data=[])
+            response.status_code = 401
+            return response
+        etag = trip_etag(trip)
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+        if mediatype != 'application/json':
+            return trip, 200, {"ETag": quote_etag(etag)}
+        body = encode_json(trip)
+        if cache is not None:
+            # Only if no write invalidated the entry since it was looked up
+            cache.set_if(key, cached, etag.encode('utf-8') + b"\n" + body)
+        return json_response(body, 200, {"ETag": quote_etag(etag)})
+
+    # Pages through a user's trips in _id order. `after` is the _id of the
+    # last trip already seen, `fields` a comma separated projection and
+    # `stream` encodes the page from the cursor instead of materializing it
+    # (JSON only: the binary encodings need the whole page up front).
+    def list_trips(self, trip_collection, username):
+        query = {"username": username}
+        try:
+            if request.args.get("after"):
+                query["_id"] = {"$gt": ObjectId(request.args["after"])}
+            limit = int(request.args.get(
+                "limit", current_app.config['TRIPS_PAGE_SIZE']))
+        except (InvalidId, ValueError):
+            return bad_request()
+        if not 0 < limit <= current_app.config['TRIPS_MAX_PAGE_SIZE']:
+            return bad_request()
+        projection = None
+        if request.args.get("fields"):
+            fields = request.args["fields"].split(",")
+            if any(not field or field.startswith("$") for field in fields):
+                return bad_request()
+            projection = dict((field, 1) for field in fields)
+        stream = (request.args.get("stream") in ("1", "true") and
+                  response_mediatype() == 'application/json')
+        # The page ETag needs every trip's version, asked for or not
+        extra_version = (projection is not None and not stream and
+                         "version" not in projection)
+        if extra_version:
+            projection["version"] = 1
+
+        cursor = trip_collection.find(query, projection).sort(
+            "_id", ASCENDING).limit(limit)
+        if stream:
+            return Response(current_app.serializer.stream_array(cursor),
+                            mimetype='application/json')
+        trips = list(cursor)
+        headers = {}
+        if len(trips) == limit:
+            headers['X-Next-Cursor'] = str(trips[-1]["_id"])
+        etag = list_etag(trips, request.args.get("fields"))
+        if extra_version:
+            for trip in trips:
+                trip.pop("version", None)
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag, headers)
+        headers['ETag'] = quote_etag(etag)
+        return trips, 200, headers
 
+    # With If-Match the replace only applies to the version the client
+    # last saw and answers 412 otherwise, instead of a blind overwrite
     @requires_auth
-    def delete(self, trip_id):
-        trip_collection = app.db.trips
-        trip = trip_collection.find_one({"_id": ObjectId(trip_id)})
+    @requires_unique_index("trip_changes")
+    @json_body(TRIP_SCHEMA)
+    def put(self, trip_id):
+        trip_collection = current_app.db.trips
+        if trip_object_id(trip_id) is None:
+            return error_response(404)
+        query = {"_id": ObjectId(trip_id), "username": g.username}
+        query.update(version_filter(request.if_match))
+        try:
+            replacement = trip_document(request_body(), g.username)
+        except ValueError:
+            return bad_request()
+        trip = trip_collection.find_one_and_replace(
+            query, replacement, return_document=ReturnDocument.AFTER)
+        if trip is None:
+            return missing_or_unauthorized(trip_collection, trip_id)
+        invalidate_trip(trip["username"], trip_id)
+        record_change(g.username, "upsert", trip["_id"])
+        return trip, 200, {"ETag": quote_etag(trip_etag(trip))}
+
+    # Applies {"patch": [operations]} as a single targeted update of the
+    # fields and waypoints it names (see utils.trip_patch) rather than
+    # rewriting the trip; If-Match works as for put. A patch removing or
+    # replacing a waypoint the trip doesn't have fails with 409.
+    @requires_auth
+    @requires_unique_index("trip_changes")
+    @json_body(PATCH_SCHEMA)
+    def patch(self, trip_id):
+        if trip_object_id(trip_id) is None:
+            return error_response(404)
+        try:
+            update, array_filters, waypoints = patch_update(
+                request_body()["patch"])
+        except ValueError:
+            return bad_request()
+        stamp_version(update.setdefault("$set", {}))
+        trip_collection = current_app.db.trips
+        query = {"_id": ObjectId(trip_id), "username": g.username}
+        query.update(version_filter(request.if_match))
+        trip = trip_collection.find_one_and_update(
+            dict(query, **waypoints), update,
+            array_filters=array_filters or None,
+            return_document=ReturnDocument.AFTER)
         if trip is None:
+            # Only the waypoints missing is a conflict
+            if waypoints and trip_collection.find_one(query, {"_id": 1}):
+                return error_response(409)
+            return missing_or_unauthorized(trip_collection, trip_id)
+        invalidate_trip(trip["username"], trip_id)
+        record_change(g.username, "upsert", trip["_id"])
+        return trip, 200, {"ETag": quote_etag(trip_etag(trip))}
+
+    @requires_auth
+    @requires_unique_index("trip_changes")
+    def delete(self, trip_id):
+        trip_collection = current_app.db.trips
+        if trip_object_id(trip_id) is None:
+            return error_response(404)
+        result = trip_collection.delete_one(
+            {"_id": ObjectId(trip_id), "username": g.username})
+        if result.deleted_count == 1:
+            invalidate_trip(g.username, trip_id)
+            record_change(g.username, "delete", ObjectId(trip_id))
             response = jsonify(data=[])
-            response.status_code = 404
+            response.status_code = 200
             return response
         else:
-            if trip["username"] == request.json["username"]:
-                result = trip_collection.delete_one({"_id": ObjectId(trip_id)})
-                if result.deleted_count == 1:
-                    response = jsonify(data=[])
-                    response.status_code = 200
-                    return response
-                else:
-                    response = jsonify(data=[])
-                    response.status_code = 500
-                    return response
+            return missing_or_unauthorized(trip_collection, trip_id)
+
+
+# Implement REST Resource
+class TripSearch(Resource):
+
+    # Filters the user's trips server side, see utils.trip_search for the
+    # parameters. Pages with `offset` and `limit`; X-Next-Offset is set
+    # while there may be more.
+    @requires_auth
+    def get(self):
+        try:
+            query, projection, sort = search_query(request.args, g.username)
+            offset = int(request.args.get("offset", 0))
+            limit = int(request.args.get(
+                "limit", current_app.config['TRIPS_PAGE_SIZE']))
+        except ValueError:
+            return bad_request()
+        if (not 0 <= offset <= current_app.config['SEARCH_MAX_OFFSET'] or
+                not 0 < limit <= current_app.config['TRIPS_MAX_PAGE_SIZE']):
+            return bad_request()
+        cursor = current_app.db.trips.find(query, projection)
+        if sort is not None:
+            cursor = cursor.sort(sort)
+        trips = list(cursor.skip(offset).limit(limit))
+        headers = {}
+        if len(trips) == limit:
+            headers['X-Next-Offset'] = str(offset + limit)
+        return trips, 200, headers
+
+
+class TripChanges(Resource):
+
+    # What changed in the user's trips after change `since` (0 for
+    # everything), oldest first: {"changes", "cursor", "more"}. Each trip
+    # appears once, at its latest change, with its current document, or as
+    # a {"op": "delete"} tombstone once it is gone. Pass `cursor` back as
+    # `since` to continue; `more` says whether to do so right away.
+    @requires_auth
+    def get(self):
+        try:
+            since = int(request.args.get("since", 0))
+            limit = int(request.args.get(
+                "limit", current_app.config['TRIPS_PAGE_SIZE']))
+        except ValueError:
+            return bad_request()
+        if (since < 0 or
+                not 0 < limit <= current_app.config['TRIPS_MAX_PAGE_SIZE']):
+            return bad_request()
+        entries = list(current_app.db.trip_changes.find(
+            {"username": g.username, "seq": {"$gt": since}},
+            {"_id": 0, "seq": 1, "op": 1, "trip_id": 1}
+        ).sort("seq", ASCENDING).limit(limit))
+
+        latest = OrderedDict()
+        for entry in entries:
+            latest.pop(entry["trip_id"], None)
+            latest[entry["trip_id"]] = entry
+        trips = {}
+        upserted = [trip_id for trip_id, entry in latest.items()
+                    if entry["op"] == "upsert"]
+        if upserted:
+            for trip in current_app.db.trips.find(
+                    {"_id": {"$in": upserted}, "username": g.username}):
+                trips[trip["_id"]] = trip
+        changes = []
+        for trip_id, entry in latest.items():
+            change = {"seq": entry["seq"], "trip_id": trip_id}
+            if trip_id in trips:
+                change["op"] = "upsert"
+                change["trip"] = trips[trip_id]
             else:
-                response = jsonify(data=[])
-                response.status_code = 401
-                return response
+                # A tombstone, or a trip deleted by a change that is not
+                # in the log yet
+                change["op"] = "delete"
+            changes.append(change)
+        return {"changes": changes,
+                "cursor": entries[-1]["seq"] if entries else since,
+                "more": len(entries) == limit}
 
 
-# Add REST resources to API
-api.add_resource(Trip, '/trips/', '/trips/<string:trip_id>')
-api.add_resource(Register, '/register/')
-api.add_resource(Login, '/login/')
+class TripBulk(Resource):
+
+    # Applies a batch of {"op": "create" | "update" | "delete", "_id",
+    # "trip"} items for the authenticated user through a single bulk_write
+    # and answers with one {"op", "_id", "status"} result per item. Update
+    # and delete targets are checked with one read up front so each item
+    # gets its own 404/401; items failing a check are never sent. In an
+    # ordered batch everything after the first failure is skipped (424).
+    @requires_auth
+    @requires_unique_index("trip_changes")
+    @json_body(BULK_SCHEMA)
+    def post(self):
+        username = g.username
+        items = request_body()["ops"]
+        ordered = request_body().get("ordered", True)
+        if (not items or
+                len(items) > current_app.config['BULK_MAX_OPS'] or
+                not all(isinstance(item, dict) for item in items)):
+            return bad_request()
+        trip_collection = current_app.db.trips
+
+        targets = [bulk_target(item) for item in items]
+        owners = {}
+        trip_ids = [trip_id for trip_id in targets if trip_id is not None]
+        if trip_ids:
+            for trip in trip_collection.find({"_id": {"$in": trip_ids}},
+                                             {"username": 1}):
+                owners[trip["_id"]] = trip["username"]
+
+        results = [{"op": item.get("op"), "_id": trip_id, "status": 424}
+                   for item, trip_id in zip(items, targets)]
+        writes = []
+        positions = []
+        for position, item in enumerate(items):
+            result = results[position]
+            status, trip_id, write = bulk_write_for(item, result["_id"],
+                                                    username, owners)
+            result["status"] = status
+            result["_id"] = trip_id
+            if write is None:
+                if ordered:
+                    break
+                continue
+            writes.append(write)
+            positions.append(position)
+
+        if writes:
+            try:
+                trip_collection.bulk_write(writes, ordered=ordered)
+            except BulkWriteError as e:
+                failed = e.details["writeErrors"]
+                for error in failed:
+                    results[positions[error["index"]]]["status"] = (
+                        409 if error["code"] == 11000 else 500)
+                if ordered and failed:
+                    for position in positions[failed[0]["index"] + 1:]:
+                        results[position]["status"] = 424
+            # After the write, so no read can cache what it replaced
+            for position in positions:
+                if items[position]["op"] != "create":
+                    invalidate_trip(username, results[position]["_id"])
+            changes = [("delete" if items[position]["op"] == "delete"
+                        else "upsert", results[position]["_id"])
+                       for position in positions
+                       if results[position]["status"] == 200]
+            if changes:
+                record_changes(username, changes)
+        return {"results": results}
+
+
+# The trip an update/delete bulk item targets, if it names a valid one
+def bulk_target(item):
+    if item.get("op") not in ("update", "delete"):
+        return None
+    try:
+        return ObjectId(item.get("_id"))
+    except (InvalidId, TypeError):
+        return None
+
+
+# Returns (status, trip_id, write) for one bulk item; write is None if the
+# item failed its checks
+def bulk_write_for(item, trip_id, username, owners):
+    op = item.get("op")
+    trip = item.get("trip")
+    if op == "create":
+        if not isinstance(trip, dict) or "name" not in trip:
+            return 400, None, None
+        try:
+            document = trip_document(trip, username)
+        except ValueError:
+            return 400, None, None
+        document["_id"] = trip_id = ObjectId()
+        return 200, trip_id, InsertOne(document)
+    if op not in ("update", "delete") or trip_id is None:
+        return 400, trip_id, None
+    if trip_id not in owners:
+        return 404, trip_id, None
+    if owners[trip_id] != username:
+        return 401, trip_id, None
+    if op == "delete":
+        return 200, trip_id, DeleteOne({"_id": trip_id,
+                                        "username": username})
+    if not isinstance(trip, dict) or "name" not in trip:
+        return 400, trip_id, None
+    try:
+        document = trip_document(trip, username)
+    except ValueError:
+        return 400, trip_id, None
+    return 200, trip_id, ReplaceOne({"_id": trip_id, "username": username},
+                                    document)
+
+
+# Ownership-filtered writes match nothing when the trip doesn't exist, when
+# it belongs to someone else and when an If-Match precondition fails; only
+# then do we look it up to tell those apart, so the successful path stays
+# a single round trip.
+def missing_or_unauthorized(trip_collection, trip_id):
+    trip = trip_collection.find_one({"_id": ObjectId(trip_id)},
+                                    {"username": 1})
+    response = jsonify(data=[])
+    if trip is None:
+        response.status_code = 404
+    elif trip["username"] != g.username:
+        response.status_code = 401
+    else:
+        response.status_code = 412
+    return response
+
+
+def encode_body(data, dumps):
+    metrics = current_app.metrics
+    if metrics is None:
+        return dumps(data)
+    started = time.perf_counter()
+    body = dumps(data)
+    metrics.serialization_seconds.observe(time.perf_counter() - started,
+                                          request.endpoint)
+    return body
+
+
+def encode_json(data):
+    return encode_body(data, current_app.serializer.dumps)
+
+
+# Best of MEDIA_TYPES for the request's Accept header, JSON if none fits;
+# the same choice flask_restful makes among the registered representations
+def response_mediatype():
+    return request.accept_mimetypes.best_match(MEDIA_TYPES,
+                                               default='application/json')
+
+
+# Response for a body that is already encoded JSON
+def json_response(body, code, headers=None):
+    resp = make_response(body, code)
+    resp.headers.extend(headers or {})
+    resp.headers['Content-Type'] = 'application/json'
+    return resp
 
 
 # provide a custom JSON serializer for flaks_restful
-@api.representation('application/json')
 def output_json(data, code, headers=None):
-    resp = make_response(JSONEncoder().encode(data), code)
+    resp = make_response(encode_json(data), code)
     resp.headers.extend(headers or {})
     return resp
 
+
+# flask_restful representation for one of BINARY_ENCODERS; the Api sets
+# the Content-Type itself
+def binary_representation(dumps):
+    def output(data, code, headers=None):
+        resp = make_response(encode_body(data, dumps), code)
+        resp.headers.extend(headers or {})
+        return resp
+    return output
+
+
+# Compresses responses for clients that accept it. Bodies under
+# COMPRESSION_MIN_BYTES are sent as they are since compressing them costs
+# more than it saves; streamed bodies are compressed chunk by chunk.
+def compress_response(response):
+    response.vary.add('Accept')
+    response.vary.add('Accept-Encoding')
+    if (response.status_code != 200 or request.method == 'HEAD' or
+            'Content-Encoding' in response.headers):
+        return response
+    encoding = request.accept_encodings.best_match(list(COMPRESSORS))
+    if encoding is None:
+        return response
+    level = current_app.config['COMPRESSION_LEVEL']
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding,
+                                            level)
+        response.headers.pop('Content-Length', None)
+    else:
+        body = response.get_data()
+        if len(body) < current_app.config['COMPRESSION_MIN_BYTES']:
+            return response
+        response.set_data(compress(body, encoding, level))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def metrics_view():
+    return Response(current_app.metrics.render(),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+# Hooks request timing and Mongo command counts into the app and serves
+# them, along with cache and pool figures, from /metrics. Only called when
+# METRICS_ENABLED is set, so a disabled app pays for none of it.
+def install_metrics(app):
+    metrics = app.metrics
+
+    def pool_stat(key):
+        stats = app.mongo.pool_stats
+        return stats.snapshot()[key] if stats is not None else 0
+
+    metrics.add_gauge("trip_api_token_cache_hits_total",
+                      "Token cache hits in requires_auth",
+                      lambda: app.token_cache.hits, "counter")
+    metrics.add_gauge("trip_api_token_cache_misses_total",
+                      "Token cache misses in requires_auth",
+                      lambda: app.token_cache.misses, "counter")
+    metrics.add_gauge("trip_api_mongo_pool_in_use",
+                      "Pooled Mongo connections checked out",
+                      lambda: pool_stat("in_use"))
+    metrics.add_gauge("trip_api_mongo_pool_open",
+                      "Open Mongo connections",
+                      lambda: pool_stat("open"))
+    metrics.add_gauge("trip_api_mongo_pool_utilization",
+                      "Checked out connections over maxPoolSize",
+                      lambda: pool_stat("utilization"))
+    metrics.add_gauge("trip_api_mongo_pool_wait_seconds",
+                      "Recent average wait to check out a connection",
+                      lambda: pool_stat("wait_time_recent"))
+
+    if app.write_behind is not None:
+        write_behind = app.write_behind
+        metrics.add_gauge("trip_api_write_behind_pending",
+                          "Writes queued for the write-behind thread",
+                          lambda: write_behind.pending)
+        metrics.add_gauge("trip_api_write_behind_refused_total",
+                          "Writes the full write-behind queue turned away",
+                          lambda: write_behind.refused, "counter")
+        metrics.add_gauge("trip_api_write_behind_failed_total",
+                          "Queued writes that could not be written",
+                          lambda: write_behind.failed, "counter")
+
+    if app.load_shedder is not None:
+        shedder = app.load_shedder
+        metrics.add_gauge("trip_api_requests_in_flight",
+                          "Requests admitted and not yet finished",
+                          lambda: shedder.in_flight)
+        metrics.add_gauge("trip_api_requests_shed_total",
+                          "Requests turned away with a 503 by the shedder",
+                          lambda: shedder.shed, "counter")
+
+    app.before_request(metrics.begin_request)
+
+    @app.after_request
+    def record_request(response):
+        metrics.end_request(request.endpoint, request.method,
+                            response.status_code)
+        return response
+
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
+
+
+def create_app(config=None):
+    app = Flask(__name__)
+    app.config.update(DEFAULT_CONFIG)
+    app.config.from_envvar('TRIP_PLANNER_SETTINGS', silent=True)
+    app.config.update(config or {})
+    if app.config['PROXY_FIX_HOPS']:
+        hops = app.config['PROXY_FIX_HOPS']
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops,
+                                x_host=hops)
+
+    app.metrics = Metrics() if app.config['METRICS_ENABLED'] else None
+    if app.config['MONGO_BACKEND'] == 'mongo':
+        # The client itself is created lazily, once per (forked) process
+        app.mongo = MongoConnection(
+            app.config['MONGO_URI'],
+            app.config['MONGO_DBNAME'],
+            max_pool_size=app.config['MONGO_MAX_POOL_SIZE'],
+            min_pool_size=app.config['MONGO_MIN_POOL_SIZE'],
+            wait_queue_timeout_ms=app.config['MONGO_WAIT_QUEUE_TIMEOUT_MS'],
+            connect_timeout_ms=app.config['MONGO_CONNECT_TIMEOUT_MS'],
+            socket_timeout_ms=app.config['MONGO_SOCKET_TIMEOUT_MS'],
+            server_selection_timeout_ms=app.config[
+                'MONGO_SERVER_SELECTION_TIMEOUT_MS'],
+            read_preference=app.config['MONGO_READ_PREFERENCE'],
+            event_listeners=[app.metrics.listener] if app.metrics else [])
+    elif app.config['MONGO_BACKEND'] == 'memory':
+        app.mongo = MemoryConnection(app.config['MONGO_DBNAME'])
+    else:
+        raise ValueError("Unknown MONGO_BACKEND: %s" %
+                         app.config['MONGO_BACKEND'])
+    app.db = LazyDatabase(app.mongo)
+    # In 'signed' mode tokens are HMAC-signed and verified without Mongo
+    if app.config['AUTH_TOKEN_MODE'] == 'signed':
+        app.signed_tokens = SignedTokens(
+            app.config['SECRET_KEY'], app.config['AUTH_TOKEN_MAX_AGE'],
+            revocations=create_revocations(
+                app.config['AUTH_REVOCATION_BACKEND'], lambda: app.db))
+    elif app.config['AUTH_TOKEN_MODE'] == 'database':
+        app.signed_tokens = None
+    else:
+        raise ValueError("Unknown AUTH_TOKEN_MODE: %s" %
+                         app.config['AUTH_TOKEN_MODE'])
+    # Fronts the users collection lookup done by requires_auth
+    app.token_cache = TokenCache(app.config['TOKEN_CACHE_SIZE'],
+                                 app.config['TOKEN_CACHE_TTL'])
+    # Last change log seq written per user, see record_changes
+    app.change_seqs = TokenCache(app.config['TOKEN_CACHE_SIZE'],
+                                 CHANGE_SEQ_TTL)
+    # Encoded single-trip responses, invalidated by every write to a trip
+    app.response_cache = create_cache(app.config['RESPONSE_CACHE_BACKEND'],
+                                      app.config['RESPONSE_CACHE_TTL'],
+                                      app.config['RESPONSE_CACHE_MAX_BYTES'],
+                                      app.config['RESPONSE_CACHE_URL'])
+    # Fastest available JSON library unless one is configured
+    app.serializer = Serializer(app.config['JSON_BACKEND'])
+    # Keeps bcrypt off the request threads and spreads it across cores
+    app.hasher = HashingPool(app.config['HASH_EXECUTOR'],
+                             app.config['HASH_WORKERS'],
+                             app.config['HASH_QUEUE_SIZE'])
+    # bcrypt work factor for new hashes, calibrated unless configured
+    app.bcrypt_rounds = configured_rounds(app.config)
+    app.write_behind = None
+    if app.config['WRITE_BEHIND_MAX_PENDING'] is not None:
+        # Writes to app.mongo's database, past any app.db wrapper
+        app.write_behind = WriteBehind(
+            lambda: app.mongo.database,
+            app.config['WRITE_BEHIND_MAX_PENDING'],
+            app.config['WRITE_BEHIND_BATCH_SIZE'],
+            app.config['WRITE_BEHIND_INTERVAL'])
+    app.rate_limiter = create_rate_limiter(app.config['RATE_LIMIT_BACKEND'],
+                                           app.config['RATE_LIMIT_MAX_KEYS'],
+                                           app.config['RATE_LIMIT_URL'])
+
+    def pool_wait():
+        stats = app.mongo.pool_stats
+        return stats.current_wait() if stats is not None else 0.0
+
+    app.load_shedder = None
+    if (app.config['SHED_MAX_IN_FLIGHT'] is not None or
+            app.config['SHED_MAX_POOL_WAIT'] is not None):
+        app.load_shedder = LoadShedder(app.config['SHED_MAX_IN_FLIGHT'],
+                                       app.config['SHED_MAX_POOL_WAIT'],
+                                       pool_wait)
+    # Collection -> when to retry its unique index, see bootstrap_indexes
+    app.missing_indexes = {}
+    app.before_first_request(bootstrap_indexes)
+    if app.metrics is not None:
+        install_metrics(app)
+    # Shedding goes first so an overloaded process does no other work
+    if app.load_shedder is not None:
+        app.before_request(shed_load)
+        app.teardown_request(release_load)
+    if app.rate_limiter is not None:
+        app.before_request(limit_rate)
+    if app.config['COMPRESSION_ENABLED']:
+        app.after_request(compress_response)
+
+    # Add REST resources to API
+    api = Api(app)
+    api.add_resource(Trip, '/trips/', '/trips/<string:trip_id>')
+    api.add_resource(TripBulk, '/trips/bulk')
+    api.add_resource(TripChanges, '/trips/changes')
+    api.add_resource(TripSearch, '/trips/search')
+    api.add_resource(Register, '/register/')
+    api.add_resource(Login, '/login/')
+    api.add_resource(Logout, '/logout/')
+    api.representation('application/json')(output_json)
+    for mediatype, dumps in BINARY_ENCODERS.items():
+        api.representation(mediatype)(binary_representation(dumps))
+    return app
+
+
+app = create_app()
+
 if __name__ == '__main__':
     # Turn this on in debug mode to get detailled information about
     # request related exceptions: http://flask.pocoo.org/docs/0.10/config/
     app.config['TRAP_BAD_REQUEST_ERRORS'] = True
+    failed = build_indexes(app.db)
+    if failed:
+        (collection, keys, unique), error = failed[0]
+        raise SystemExit("Could not build the %s index %s: %s. For "
+                         "duplicate usernames run `python -m "
+                         "utils.dedupe_users` first." %
+                         (collection, keys, error))
     app.run(debug=True)
@@ -1,22 +1,85 @@
+import asgi
 import server
 import unittest
+import asyncio
+import base64
+import bson
+import datetime
+import gzip
 import json
-from pymongo import MongoClient
+import os
+import threading
+import uuid
+from utils.compact_changes import compact_changes
+from utils.dedupe_users import dedupe_users
+from utils.hashing import HashingPool
+from utils.query_plans import collection_scans
+
+# Point TEST_MONGO_URI at a MongoDB server to run the suite against it.
+# Otherwise tests use the in-memory store: no services needed, and since
+# every test gets a database of its own they can run in parallel, e.g.
+# `python -m pytest -n auto` with pytest-xdist.
+TEST_MONGO_URI = os.environ.get('TEST_MONGO_URI')
+TEST_CONFIG = {
+    # Retrieve exceptions and stack traces
+    'TESTING': True,
+    'MONGO_BACKEND': 'mongo' if TEST_MONGO_URI else 'memory',
+    'MONGO_URI': TEST_MONGO_URI or server.DEFAULT_CONFIG['MONGO_URI'],
+    # The cheapest bcrypt there is, hashed on the calling thread
+    'BCRYPT_ROUNDS': 4,
+    'HASH_EXECUTOR': 'inline'
+}
+requires_mongo = unittest.skipUnless(
+    TEST_MONGO_URI, "needs a MongoDB server, set TEST_MONGO_URI")
+
+
+# Wraps a database and records every collection method the app calls
+class OpCountingDatabase(object):
+
+    def __init__(self, db):
+        self.db = db
+        self.ops = []
+
+    def __getattr__(self, name):
+        return OpCountingCollection(self, getattr(self.db, name))
+
+
+class OpCountingCollection(object):
+
+    def __init__(self, recorder, collection):
+        self.recorder = recorder
+        self.collection = collection
+
+    def __getattr__(self, name):
+        attr = getattr(self.collection, name)
+        if not callable(attr):
+            return attr
+
+        def counted(*args, **kwargs):
+            self.recorder.ops.append((self.collection.name, name))
+            return attr(*args, **kwargs)
+        return counted
 
 
 class FlaskrTestCase(unittest.TestCase):
 
     def setUp(self):
-        self.app = server.app.test_client()
-        # Run app in testing mode to retrieve exceptions and stack traces
-        server.app.config['TESTING'] = True
-        # Inject test database into application
-        mongo = MongoClient('localhost', 27017)
-        db = mongo.test_database
-        server.app.db = db
-        # Drop collection (significantly faster than dropping entire db)
-        db.drop_collection('trips')
-        db.drop_collection('users')
+        # A fresh app and database per test keeps tests independent
+        self.database_name = 'test_%s' % uuid.uuid4().hex
+        self.flask_app = self.create_app()
+        self.app = self.flask_app.test_client()
+        server.ensure_indexes(self.flask_app.db)
+
+    def tearDown(self):
+        self.flask_app.write_behind.close()
+        self.flask_app.mongo.client.drop_database(self.database_name)
+        self.flask_app.mongo.close()
+
+    # App on the test database with TEST_CONFIG and `config` on top
+    def create_app(self, config=None):
+        app_config = dict(TEST_CONFIG, MONGO_DBNAME=self.database_name)
+        app_config.update(config or {})
+        return server.create_app(app_config)
 
     # Test auth
     def test_register_user(self):
@@ -51,6 +114,434 @@ class FlaskrTestCase(unittest.TestCase):
         assert 'application/json' in response.content_type
         assert 'user' in responseJSON["username"]
 
+    def test_register_rejected_when_hash_pool_saturated(self):
+        default_hasher = self.flask_app.hasher
+        self.flask_app.hasher = HashingPool('thread', workers=1,
+                                            queue_size=1)
+        release = threading.Event()
+        try:
+            self.flask_app.hasher.submit(release.wait)
+            response = self.app.post('/register/',
+                                     data=json.dumps(dict(
+                                         username="user",
+                                         password="pass"
+                                         )),
+                                     content_type='application/json')
+            self.assertEqual(response.status_code, 429)
+        finally:
+            release.set()
+            self.flask_app.hasher.shutdown()
+            self.flask_app.hasher = default_hasher
+
+    def test_login_attempts_rate_limited(self):
+        app = self.create_app({'RATE_LIMIT_AUTH_BURST': 3})
+        app.db = self.flask_app.db
+        client = app.test_client()
+        for attempt in range(3):
+            response = client.post('/login/',
+                                   data=json.dumps(dict(
+                                       username="user",
+                                       password="guess%d" % attempt
+                                       )),
+                                   content_type='application/json')
+            self.assertEqual(response.status_code, 401)
+        response = client.post('/login/',
+                               data=json.dumps(dict(
+                                   username="user",
+                                   password="guess"
+                                   )),
+                               content_type='application/json')
+        self.assertEqual(response.status_code, 429)
+        assert int(response.headers['Retry-After']) >= 1
+
+    def test_login_attempts_cannot_lock_out_user(self):
+        self.__register_and_login("user", "pass")
+        app = self.create_app({'RATE_LIMIT_AUTH_BURST': 3})
+        app.db = self.flask_app.db
+        client = app.test_client()
+        for attempt in range(11):
+            response = client.post('/login/',
+                                   data=json.dumps(dict(
+                                       username="user",
+                                       password="guess"
+                                       )),
+                                   content_type='application/json',
+                                   environ_base={
+                                       'REMOTE_ADDR': '10.0.0.%d' % attempt})
+            self.assertEqual(response.status_code, 401)
+        response = client.post('/login/',
+                               data=json.dumps(dict(
+                                   username="user",
+                                   password="pass"
+                                   )),
+                               content_type='application/json',
+                               environ_base={'REMOTE_ADDR': '10.0.1.1'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_login_attempts_limited_per_username(self):
+        app = self.create_app({'RATE_LIMIT_AUTH_USER_BURST': 3})
+        app.db = self.flask_app.db
+        client = app.test_client()
+        statuses = []
+        for attempt in range(4):
+            response = client.post('/login/',
+                                   data=json.dumps(dict(
+                                       username="user",
+                                       password="guess"
+                                       )),
+                                   content_type='application/json',
+                                   environ_base={
+                                       'REMOTE_ADDR': '10.0.0.%d' % attempt})
+            statuses.append(response.status_code)
+        self.assertEqual(statuses, [401, 401, 401, 429])
+
+    def test_rate_limit_by_forwarded_address(self):
+        app = self.create_app({'RATE_LIMIT_AUTH_BURST': 3,
+                               'PROXY_FIX_HOPS': 1})
+        app.db = self.flask_app.db
+        client = app.test_client()
+        for attempt in range(4):
+            response = client.post('/login/',
+                                   data=json.dumps(dict(
+                                       username="user%d" % attempt,
+                                       password="guess"
+                                       )),
+                                   content_type='application/json',
+                                   headers={'X-Forwarded-For':
+                                            '10.0.0.%d' % attempt})
+            self.assertEqual(response.status_code, 401)
+
+    def test_overloaded_app_sheds_requests(self):
+        app = self.create_app({'SHED_MAX_IN_FLIGHT': 1})
+        app.db = self.flask_app.db
+        client = app.test_client()
+        app.load_shedder.enter()
+        try:
+            response = client.post('/register/',
+                                   data=json.dumps(dict(
+                                       username="user",
+                                       password="pass"
+                                       )),
+                                   content_type='application/json')
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers['Retry-After'], '1')
+        finally:
+            app.load_shedder.leave()
+        response = client.post('/register/',
+                               data=json.dumps(dict(
+                                   username="user",
+                                   password="pass"
+                                   )),
+                               content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(app.load_shedder.in_flight, 0)
+
+    def test_register_duplicate_user(self):
+        self.__register_and_login("user", "pass")
+        response = self.app.post('/register/',
+                                 data=json.dumps(dict(
+                                     username="user",
+                                     password="other"
+                                     )),
+                                 content_type='application/json')
+        self.assertEqual(response.status_code, 409)
+
+    @requires_mongo
+    def test_handler_queries_use_indexes(self):
+        self.assertEqual(collection_scans(self.flask_app.db), [])
+
+    def test_app_factory_configures_mongo(self):
+        app = server.create_app({'MONGO_DBNAME': 'test_database',
+                                 'MONGO_MAX_POOL_SIZE': 5})
+        self.assertEqual(app.db.name, 'test_database')
+        self.assertEqual(
+            app.mongo.client.options.pool_options.max_pool_size, 5)
+        self.assertEqual(app.mongo.pool_stats.snapshot()["max_pool_size"], 5)
+        app.mongo.close()
+
+    def test_duplicate_usernames_dont_break_startup(self):
+        app = self.create_app({'MONGO_DBNAME': self.database_name + '_old'})
+        try:
+            # As left by a Register that didn't enforce unique usernames
+            ids = [app.db.users.insert_one({"username": "user",
+                                            "password": password}
+                                           ).inserted_id
+                   for password in ("first", "second")]
+            # And a change log from writers racing without its index
+            change_ids = [app.db.trip_changes.insert_one(
+                {"username": "user", "seq": 1}).inserted_id
+                for _ in range(2)]
+            client = app.test_client()
+            response = client.get('/trips/',
+                                  data=json.dumps(dict(username="user",
+                                                       token="none")),
+                                  content_type='application/json')
+            self.assertEqual(response.status_code, 401)
+
+            # Writes relying on a missing unique index are refused
+            credentials = json.dumps(dict(username="new", password="pass"))
+            response = client.post('/register/', data=credentials,
+                                   content_type='application/json')
+            self.assertEqual(response.status_code, 503)
+
+            removed = dedupe_users(app.db)
+            self.assertEqual([user["_id"] for user in removed], ids[1:])
+            self.assertEqual(app.db.users.count_documents({}), 1)
+            # Retried once INDEX_RETRY_INTERVAL has passed
+            app.missing_indexes["users"] = 0
+            response = client.post('/register/', data=credentials,
+                                   content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            response = client.post('/login/', data=credentials,
+                                   content_type='application/json')
+            trip = json.dumps(dict(
+                name="Trip", username="new",
+                token=json.loads(response.data.decode())["token"]))
+            response = client.post('/trips/', data=trip,
+                                   content_type='application/json')
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(app.db.trips.count_documents({}), 0)
+
+            app.db.trip_changes.delete_one({"_id": change_ids[1]})
+            app.missing_indexes["trip_changes"] = 0
+            response = client.post('/trips/', data=trip,
+                                   content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(app.missing_indexes, {})
+        finally:
+            app.mongo.client.drop_database(self.database_name + '_old')
+            app.mongo.close()
+
+    def test_metrics_endpoint(self):
+        app = self.create_app({'METRICS_ENABLED': True})
+        client = app.test_client()
+        client.post('/register/',
+                    data=json.dumps(dict(
+                        username="user",
+                        password="pass"
+                        )),
+                    content_type='application/json')
+        response = client.get('/metrics')
+        body = response.data.decode()
+
+        self.assertEqual(response.status_code, 200)
+        assert 'text/plain' in response.content_type
+        assert ('trip_api_request_duration_seconds_count'
+                '{endpoint="register",method="POST",status="200"} 1') in body
+        # Command timings come from pymongo's command monitoring
+        if TEST_MONGO_URI:
+            assert ('trip_api_mongo_command_duration_seconds_count'
+                    '{command="insert",outcome="ok"}') in body
+        assert 'trip_api_token_cache_hits_total 0.0' in body
+        app.mongo.close()
+
+    def test_metrics_disabled_by_default(self):
+        response = self.app.get('/metrics')
+        self.assertEqual(response.status_code, 404)
+
+    def test_logout_revokes_token(self):
+        responseJSON = self.__register_and_login("user", "pass")
+        auth = dict(username=responseJSON["username"],
+                    token=responseJSON["token"])
+        response = self.app.post('/logout/',
+                                 data=json.dumps(auth),
+                                 content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        response = self.app.get('/trips/',
+                                data=json.dumps(auth),
+                                content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+
+    def test_credentials_in_authorization_header(self):
+        responseJSON = self.__register_and_login("user", "pass")
+        credentials = base64.b64encode(
+            ("user:" + responseJSON["token"]).encode()).decode()
+        response = self.app.get('/trips/', headers={
+            'Authorization': 'Basic ' + credentials})
+        self.assertEqual(response.status_code, 200)
+        response = self.app.get('/trips/', headers={
+            'Authorization': 'Basic ' + base64.b64encode(
+                b"user:wrong").decode()})
+        self.assertEqual(response.status_code, 401)
+        response = self.app.get('/trips/')
+        self.assertEqual(response.status_code, 401)
+
+    def test_rejects_malformed_bodies(self):
+        response = self.app.post('/register/',
+                                 data='{"username": "user"',
+                                 content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        response = self.app.post('/register/',
+                                 data=json.dumps(["user", "pass"]),
+                                 content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        response = self.app.post('/register/',
+                                 data=json.dumps(dict(username="user",
+                                                      password=1234)),
+                                 content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        responseJSON = self.__register_and_login("user", "pass")
+        response = self.app.post('/trips/',
+                                 data=json.dumps(dict(
+                                     username="user",
+                                     token=responseJSON["token"]
+                                     )),
+                                 content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_rejects_oversized_body(self):
+        limit = self.flask_app.config['MAX_BODY_BYTES']
+        response = self.app.post('/register/',
+                                 data=json.dumps(dict(
+                                     username="user",
+                                     password="x" * limit
+                                     )),
+                                 content_type='application/json')
+        self.assertEqual(response.status_code, 413)
+
+    def test_signed_tokens_skip_user_lookup(self):
+        app = self.create_app({'AUTH_TOKEN_MODE': 'signed',
+                                 'SECRET_KEY': 'test-secret'})
+        counter = OpCountingDatabase(self.flask_app.db)
+        app.db = counter
+        client = app.test_client()
+        client.post('/register/',
+                    data=json.dumps(dict(
+                        username="user",
+                        password="pass"
+                        )),
+                    content_type='application/json')
+        response = client.post('/login/',
+                               data=json.dumps(dict(
+                                   username="user",
+                                   password="pass"
+                                   )),
+                               content_type='application/json')
+        auth = dict(username="user",
+                    token=json.loads(response.data.decode())["token"])
+
+        del counter.ops[:]
+        response = client.get('/trips/',
+                              data=json.dumps(auth),
+                              content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(counter.ops, [('trips', 'find')])
+
+        response = client.get('/trips/',
+                              data=json.dumps(dict(auth, username="other")),
+                              content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+
+        client.post('/logout/',
+                    data=json.dumps(auth),
+                    content_type='application/json')
+        response = client.get('/trips/',
+                              data=json.dumps(auth),
+                              content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+
+    def test_signed_logout_shared_through_mongo(self):
+        config = {'AUTH_TOKEN_MODE': 'signed', 'SECRET_KEY': 'test-secret'}
+        workers = []
+        for backend in ('memory', 'mongo', 'mongo'):
+            app = self.create_app(dict(config,
+                                       AUTH_REVOCATION_BACKEND=backend))
+            app.mongo = self.flask_app.mongo
+            app.db = self.flask_app.db
+            workers.append(app)
+        client = workers[2].test_client()
+        client.post('/register/',
+                    data=json.dumps(dict(username="user", password="pass")),
+                    content_type='application/json')
+        response = client.post('/login/',
+                               data=json.dumps(dict(username="user",
+                                                    password="pass")),
+                               content_type='application/json')
+        auth = json.dumps(dict(
+            username="user",
+            token=json.loads(response.data.decode())["token"]))
+        client.post('/logout/', data=auth, content_type='application/json')
+        # An in-process revocation list never hears of the logout
+        for app, status in zip(workers, (200, 401, 401)):
+            response = app.test_client().get(
+                '/trips/', data=auth, content_type='application/json')
+            self.assertEqual(response.status_code, status)
+            app.write_behind.close()
+
+    def test_login_rehashes_to_current_work_factor(self):
+        register_app = self.create_app({'BCRYPT_ROUNDS': 4})
+        register_app.db = self.flask_app.db
+        register_app.test_client().post('/register/',
+                                        data=json.dumps(dict(
+                                            username="user",
+                                            password="pass"
+                                            )),
+                                        content_type='application/json')
+        stored = self.flask_app.db.users.find_one({"username": "user"})
+        assert stored["password"].startswith("$2b$04$")
+
+        # A round of drift, as between calibrated workers, is left alone
+        for rounds, prefix in ((5, "$2b$04$"), (6, "$2b$06$"),
+                               (6, "$2b$06$"), (5, "$2b$06$")):
+            login_app = self.create_app({'BCRYPT_ROUNDS': rounds})
+            login_app.db = self.flask_app.db
+            response = login_app.test_client().post(
+                '/login/',
+                data=json.dumps(dict(username="user", password="pass")),
+                content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            stored = self.flask_app.db.users.find_one({"username": "user"})
+            assert stored["password"].startswith(prefix)
+
+    def test_login_token_accepted_by_other_workers(self):
+        # Two app instances on one database stand in for two workers
+        other_app = self.create_app()
+        other_app.mongo = self.flask_app.mongo
+        other_app.db = self.flask_app.db
+        responseJSON = self.__register_and_login("user", "pass")
+        auth = dict(username="user", token=responseJSON["token"])
+        response = other_app.test_client().get(
+            '/trips/', data=json.dumps(auth),
+            content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        other_app.write_behind.close()
+
+    def test_logout_reaches_other_workers_within_cache_ttl(self):
+        responseJSON = self.__register_and_login("user", "pass")
+        auth = json.dumps(dict(username="user", token=responseJSON["token"]))
+        workers = []
+        for ttl in (30, 0):
+            other_app = self.create_app({'TOKEN_CACHE_TTL': ttl})
+            other_app.mongo = self.flask_app.mongo
+            other_app.db = self.flask_app.db
+            response = other_app.test_client().get(
+                '/trips/', data=auth, content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            workers.append(other_app)
+        self.app.post('/logout/', data=auth,
+                      content_type='application/json')
+        # The worker that cached the token keeps it until the entry expires
+        for other_app, status in zip(workers, (200, 401)):
+            response = other_app.test_client().get(
+                '/trips/', data=auth, content_type='application/json')
+            self.assertEqual(response.status_code, status)
+            other_app.write_behind.close()
+
+    def test_auth_events_written_behind(self):
+        responseJSON = self.__register_and_login("user", "pass")
+        self.app.post('/login/',
+                      data=json.dumps(dict(username="user", password="no")),
+                      content_type='application/json')
+        self.app.post('/logout/',
+                      data=json.dumps(dict(username="user",
+                                           token=responseJSON["token"])),
+                      content_type='application/json')
+        self.flask_app.write_behind.flush()
+        events = self.flask_app.db.auth_events.find().sort("_id", 1)
+        self.assertEqual([(e["event"], e["username"]) for e in events],
+                         [("register", "user"), ("login", "user"),
+                          ("login_failed", "user"), ("logout", "user")])
+
     def test_unauthorized_user(self):
         response = self.app.post('/login/',
                                  data=json.dumps(dict(
@@ -108,6 +599,117 @@ class FlaskrTestCase(unittest.TestCase):
         assert 'application/json' in response.content_type
         assert 'An Updated Trip' in responseJSON["name"]
 
+    def test_patch_trip_waypoints(self):
+        responseJSON = self.__register_and_login("user", "pass")
+        auth = dict(username=responseJSON["username"],
+                    token=responseJSON["token"])
+        response = self.app.post('/trips/',
+                                 data=json.dumps(dict(
+                                     name="Road Trip",
+                                     waypoints=[{"name": "Denver"},
+                                                {"name": "Moab"}],
+                                     **auth)),
+                                 content_type='application/json')
+        trip = json.loads(response.data.decode())
+        self.assertEqual([w["name"] for w in trip["waypoints"]],
+                         ["Denver", "Moab"])
+
+        response = self.app.patch('/trips/' + trip["_id"],
+                                  data=json.dumps(dict(patch=[
+                                      {"op": "replace", "path": "/name",
+                                       "value": "Utah"},
+                                      {"op": "add", "path": "/waypoints/1",
+                                       "value": {"name": "Vail"}}
+                                      ], **auth)),
+                                  content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        patched = json.loads(response.data.decode())
+        self.assertEqual(patched["name"], "Utah")
+        self.assertEqual([w["name"] for w in patched["waypoints"]],
+                         ["Denver", "Vail", "Moab"])
+        self.assertNotEqual(patched["version"], trip["version"])
+
+        response = self.app.patch('/trips/' + trip["_id"],
+                                  data=json.dumps(dict(patch=[
+                                      {"op": "remove", "path": "/waypoints/" +
+                                       trip["waypoints"][0]["_id"]}
+                                      ], **auth)),
+                                  content_type='application/json')
+        patched = json.loads(response.data.decode())
+        self.assertEqual([w["name"] for w in patched["waypoints"]],
+                         ["Vail", "Moab"])
+
+        for patch in ([], [{"op": "replace", "path": "/username",
+                            "value": "other"}],
+                      [{"op": "remove", "path": "/name"}],
+                      [{"op": "move", "path": "/waypoints/0"}]):
+            response = self.app.patch('/trips/' + trip["_id"],
+                                      data=json.dumps(dict(patch=patch,
+                                                           **auth)),
+                                      content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+
+        response = self.app.patch('/trips/' + trip["_id"],
+                                  data=json.dumps(dict(patch=[
+                                      {"op": "replace", "path": "/name",
+                                       "value": "Stale"}
+                                      ], **auth)),
+                                  content_type='application/json',
+                                  headers={'If-Match': '"%s"' %
+                                           trip["version"]})
+        self.assertEqual(response.status_code, 412)
+
+    def test_patch_waypoint_fields(self):
+        responseJSON = self.__register_and_login("user", "pass")
+        auth = dict(username=responseJSON["username"],
+                    token=responseJSON["token"])
+        response = self.app.post('/trips/',
+                                 data=json.dumps(dict(
+                                     name="Road Trip",
+                                     waypoints=[{"name": "Denver"},
+                                                {"name": "Moab"}],
+                                     **auth)),
+                                 content_type='application/json')
+        trip = json.loads(response.data.decode())
+        moab = trip["waypoints"][1]["_id"]
+        response = self.app.patch('/trips/' + trip["_id"],
+                                  data=json.dumps(dict(patch=[
+                                      {"op": "replace",
+                                       "path": "/waypoints/%s/nights" % moab,
+                                       "value": 2}
+                                      ], **auth)),
+                                  content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        patched = json.loads(response.data.decode())
+        self.assertEqual(patched["waypoints"][1],
+                         {"_id": moab, "name": "Moab", "nights": 2})
+        self.assertEqual(patched["waypoints"][0], trip["waypoints"][0])
+
+        # Removing or replacing a waypoint the trip doesn't have fails
+        # and leaves the trip alone
+        missing = "0" * 24
+        for operation in ({"op": "remove", "path": "/waypoints/" + missing},
+                          {"op": "replace", "path": "/waypoints/%s/nights" %
+                           missing, "value": 1}):
+            response = self.app.patch('/trips/' + trip["_id"],
+                                      data=json.dumps(dict(
+                                          patch=[operation], **auth)),
+                                      content_type='application/json')
+            self.assertEqual(response.status_code, 409)
+        response = self.app.get('/trips/' + trip["_id"],
+                                data=json.dumps(auth),
+                                content_type='application/json')
+        self.assertEqual(json.loads(response.data.decode())["version"],
+                         patched["version"])
+
+        for method in (self.app.get, self.app.put, self.app.patch,
+                       self.app.delete):
+            response = method('/trips/notanid',
+                              data=json.dumps(dict(name="Trip", patch=[],
+                                                   **auth)),
+                              content_type='application/json')
+            self.assertEqual(response.status_code, 404)
+
     def test_update_unauth(self):
         responseJSON = self.__register_and_login("user", "pass")
         username = responseJSON["username"]
@@ -317,6 +919,719 @@ class FlaskrTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         assert 'Another Trip' in responseJSON[1]["name"]
 
+    def test_get_trips_paginated(self):
+        responseJSON = self.__register_and_login("user", "pass")
+        auth = dict(username=responseJSON["username"],
+                    token=responseJSON["token"])
+        for name in ("One", "Two", "Three"):
+            self.app.post('/trips/',
+                          data=json.dumps(dict(name=name, **auth)),
+                          content_type='application/json')
+
+        response = self.app.get('/trips/?limit=2&fields=name',
+                                data=json.dumps(auth),
+                                content_type="application/json")
+        responseJSON = json.loads(response.data.decode())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([t["name"] for t in responseJSON], ["One", "Two"])
+        assert "username" not in responseJSON[0]
+        cursor = response.headers["X-Next-Cursor"]
+        self.assertEqual(cursor, responseJSON[1]["_id"])
+
+        response = self.app.get('/trips/?limit=2&after='+cursor,
+                                data=json.dumps(auth),
+                                content_type="application/json")
+        responseJSON = json.loads(response.data.decode())
+        self.assertEqual([t["name"] for t in responseJSON], ["Three"])
+        assert "X-Next-Cursor" not in response.headers
+
+    def test_get_trips_streamed(self):
+        responseJSON = self.__register_and_login("user", "pass")
+        auth = dict(username=responseJSON["username"],
+                    token=responseJSON["token"])
+        response = self.app.get('/trips/?stream=1',
+                                data=json.dumps(auth),
+                                content_type="application/json")
+        self.assertEqual(json.loads(response.data.decode()), [])
+
+        for name in ("One", "Two"):
+            self.app.post('/trips/',
+                          data=json.dumps(dict(name=name, **auth)),
+                          content_type='application/json')
+        response = self.app.get('/trips/?stream=1',
+                                data=json.dumps(auth),
+                                content_type="application/json")
+        responseJSON = json.loads(response.data.decode())
+        self.assertEqual(response.status_code, 200)
+        assert 'application/json' in response.content_type
+        self.assertEqual([t["name"] for t in responseJSON], ["One", "Two"])
+
+    def test_get_trips_compressed(self):
+        responseJSON = self.__register_and_login("user", "pass")
+        auth = dict(username=responseJSON["username"],
+                    token=responseJSON["token"])
+        for i in range(50):
+            self.app.post('/trips/',
+                          data=json.dumps(dict(name="Trip %d" % i, **auth)),
+                          content_type='application/json')
+        for query in ('', '?stream=1'):
+            response = self.app.get('/trips/' + query,
+                                    data=json.dumps(auth),
+                                    content_type="application/json",
+                                    headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            assert 'Accept-Encoding' in response.headers['Vary']
+            trips = json.loads(gzip.decompress(response.data).decode())
+            self.assertEqual(len(trips), 50)
+
+        # Below the size threshold the body is sent as it is
+        response = self.app.get('/trips/?limit=1',
+                                data=json.dumps(auth),
+                                content_type="application/json",
+                                headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(len(json.loads(response.data.decode())), 1)
+
+    def test_get_trip_as_bson(self):
+        responseJSON = self.__register_and_login("user", "pass")
+        auth = dict(username=responseJSON["username"],
+                    token=responseJSON["token"])
+        response = self.app.post('/trips/',
+                                 data=json.dumps(dict(name="Trip", **auth)),
+                                 content_type='application/json')
+        trip_id = json.loads(response.data.decode())["_id"]
+        response = self.app.get('/trips/' + trip_id,
+                                data=json.dumps(auth),
+                                content_type="application/json",
+                                headers={'Accept': 'application/bson'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content_type, 'application/bson')
+        trip = bson.decode(response.data)
+        self.assertEqual(str(trip["_id"]), trip_id)
+        self.assertEqual(trip["name"], "Trip")
+
+        response = self.app.get('/trips/',
+                                data=json.dumps(auth),
+                                content_type="application/json",
+                                headers={'Accept': 'application/bson'})
+        self.assertEqual(response.content_type, 'application/bson')
+        self.assertEqual([t["name"] for t in bson.decode(
+            response.data)["data"]], ["Trip"])
+
+    def test_get_trips_bad_cursor(self):
+        responseJSON = self.__register_and_login("user", "pass")
+        response = self.app.get('/trips/?after=nope',
+                                data=json.dumps(dict(
+                                    username=responseJSON["username"],
+                                    token=responseJSON["token"]
+                                    )),
+                                content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_trip_not_modified(self):
+        responseJSON = self.__register_and_login("user", "pass")
+        auth = dict(username=responseJSON["username"],
+                    token=responseJSON["token"])
+        response = self.app.post('/trips/',
+                                 data=json.dumps(dict(name="A Trip", **auth)),
+                                 content_type='application/json')
+        trip_id = json.loads(response.data.decode())["_id"]
+        etag = response.headers["ETag"]
+
+        response = self.app.get('/trips/'+trip_id,
+                                data=json.dumps(auth),
+                                headers={"If-None-Match": etag},
+                                content_type='application/json')
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+        # If-None-Match compares weakly, so a weakened tag still matches
+        response = self.app.get('/trips/'+trip_id,
+                                data=json.dumps(auth),
+                                headers={"If-None-Match": "W/" + etag},
+                                content_type='application/json')
+        self.assertEqual(response.status_code, 304)
+
+        response = self.app.put('/trips/'+trip_id,
+                                data=json.dumps(dict(name="Changed", **auth)),
+                                content_type='application/json')
+        self.assertNotEqual(response.headers["ETag"], etag)
+        response = self.app.get('/trips/'+trip_id,
+                                data=json.dumps(auth),
+                                headers={"If-None-Match": etag},
+                                content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_get_trips_not_modified(self):
+        responseJSON = self.__register_and_login("user", "pass")
+        auth = dict(username=responseJSON["username"],
+                    token=responseJSON["token"])
+        self.app.post('/trips/',
+                      data=json.dumps(dict(name="A Trip", **auth)),
+                      content_type='application/json')
+        response = self.app.get('/trips/',
+                                data=json.dumps(auth),
+                                content_type='application/json')
+        etag = response.headers["ETag"]
+
+        response = self.app.get('/trips/',
+                                data=json.dumps(auth),
+                                headers={"If-None-Match": etag},
+                                content_type='application/json')
+        self.assertEqual(response.status_code, 304)
+
+        self.app.post('/trips/',
+                      data=json.dumps(dict(name="Another Trip", **auth)),
+                      content_type='application/json')
+        response = self.app.get('/trips/',
+                                data=json.dumps(auth),
+                                headers={"If-None-Match": etag},
+                                content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_get_trips_fields_not_modified(self):
+        responseJSON = self.__register_and_login("user", "pass")
+        auth = dict(username=responseJSON["username"],
+                    token=responseJSON["token"])
+        response = self.app.post('/trips/',
+                                 data=json.dumps(dict(name="A Trip", **auth)),
+                                 content_type='application/json')
+        trip_id = json.loads(response.data.decode())["_id"]
+        response = self.app.get('/trips/?fields=name',
+                                data=json.dumps(auth),
+                                content_type='application/json')
+        etag = response.headers["ETag"]
+        self.assertNotIn("version", json.loads(response.data.decode())[0])
+
+        self.app.put('/trips/'+trip_id,
+                     data=json.dumps(dict(name="Renamed", **auth)),
+                     content_type='application/json')
+        response = self.app.get('/trips/?fields=name',
+                                data=json.dumps(auth),
+                                headers={"If-None-Match": etag},
+                                content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data.decode())[0]["name"],
+                         "Renamed")
+
+    def test_update_trip_if_match(self):
+        responseJSON = self.__register_and_login("user", "pass")
+        auth = dict(username=responseJSON["username"],
+                    token=responseJSON["token"])
+        response = self.app.post('/trips/',
+                                 data=json.dumps(dict(name="A Trip", **auth)),
+                                 content_type='application/json')
+        trip_id = json.loads(response.data.decode())["_id"]
+        etag = response.headers["ETag"]
+
+        response = self.app.put('/trips/'+trip_id,
+                                data=json.dumps(dict(name="First", **auth)),
+                                headers={"If-Match": etag},
+                                content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+        # Without If-Match a write doesn't depend on the version
+        response = self.app.put('/trips/'+trip_id,
+                                data=json.dumps(dict(name="Plain", **auth)),
+                                content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+        response = self.app.put('/trips/'+trip_id,
+                                data=json.dumps(dict(name="Stale", **auth)),
+                                headers={"If-Match": etag},
+                                content_type='application/json')
+        self.assertEqual(response.status_code, 412)
+
+        # Weak tags never match, not even the current version's
+        current = self.app.get('/trips/'+trip_id,
+                               data=json.dumps(auth),
+                               content_type='application/json')
+        for weak in ("W/" + etag, "W/" + current.headers["ETag"]):
+            response = self.app.put('/trips/'+trip_id,
+                                    data=json.dumps(dict(name="Weak",
+                                                         **auth)),
+                                    headers={"If-Match": weak},
+                                    content_type='application/json')
+            self.assertEqual(response.status_code, 412)
+
+    def test_get_trip_served_from_response_cache(self):
+        # Short-lived, as other workers' writes don't reach it
+        self.assertEqual(self.flask_app.response_cache.ttl, 5)
+        responseJSON = self.__register_and_login("user", "pass")
+        auth = dict(username=responseJSON["username"],
+                    token=responseJSON["token"])
+        response = self.app.post('/trips/',
+                                 data=json.dumps(dict(name="A Trip", **auth)),
+                                 content_type='application/json')
+        trip_id = json.loads(response.data.decode())["_id"]
+        self.app.get('/trips/'+trip_id,
+                     data=json.dumps(auth),
+                     content_type='application/json')
+
+        db = self.flask_app.db
+        counter = OpCountingDatabase(db)
+        self.flask_app.db = counter
+        try:
+            response = self.app.get('/trips/'+trip_id,
+                                    data=json.dumps(auth),
+                                    content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            assert 'application/json' in response.content_type
+            self.assertEqual(counter.ops, [])
+
+            self.app.put('/trips/'+trip_id,
+                         data=json.dumps(dict(name="Changed", **auth)),
+                         content_type='application/json')
+            response = self.app.get('/trips/'+trip_id,
+                                    data=json.dumps(auth),
+                                    content_type='application/json')
+            responseJSON = json.loads(response.data.decode())
+            self.assertEqual(responseJSON["name"], "Changed")
+        finally:
+            self.flask_app.db = db
+
+        # Any spelling of the id shares the entry writes invalidate
+        self.app.get('/trips/'+trip_id.upper(),
+                     data=json.dumps(auth),
+                     content_type='application/json')
+        self.app.put('/trips/'+trip_id,
+                     data=json.dumps(dict(name="Again", **auth)),
+                     content_type='application/json')
+        response = self.app.get('/trips/'+trip_id.upper(),
+                                data=json.dumps(auth),
+                                content_type='application/json')
+        self.assertEqual(json.loads(response.data.decode())["name"], "Again")
+
+        # A read that started before a write can't cache what it read
+        cache = self.flask_app.response_cache
+        key = server.trip_cache_key("user", trip_id)
+        before = cache.get(key)
+        self.app.put('/trips/'+trip_id,
+                     data=json.dumps(dict(name="Latest", **auth)),
+                     content_type='application/json')
+        assert not cache.set_if(key, before, b'"stale"\n{}')
+        response = self.app.get('/trips/'+trip_id,
+                                data=json.dumps(auth),
+                                content_type='application/json')
+        self.assertEqual(json.loads(response.data.decode())["name"],
+                         "Latest")
+
+    def test_bulk_trip_operations(self):
+        responseJSON = self.__register_and_login("user", "pass")
+        auth = dict(username=responseJSON["username"],
+                    token=responseJSON["token"])
+        response = self.app.post('/trips/',
+                                 data=json.dumps(dict(name="Old", **auth)),
+                                 content_type='application/json')
+        old_id = json.loads(response.data.decode())["_id"]
+        response = self.app.post('/trips/',
+                                 data=json.dumps(dict(name="Gone", **auth)),
+                                 content_type='application/json')
+        gone_id = json.loads(response.data.decode())["_id"]
+
+        response = self.app.post('/trips/bulk',
+                                 data=json.dumps(dict(ops=[
+                                     dict(op="create", trip=dict(name="New")),
+                                     dict(op="update", _id=old_id,
+                                          trip=dict(name="Renamed")),
+                                     dict(op="delete", _id=gone_id)
+                                     ], **auth)),
+                                 content_type='application/json')
+        responseJSON = json.loads(response.data.decode())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r["status"] for r in responseJSON["results"]],
+                         [200, 200, 200])
+
+        response = self.app.get('/trips/',
+                                data=json.dumps(auth),
+                                content_type="application/json")
+        names = [t["name"] for t in json.loads(response.data.decode())]
+        self.assertEqual(names, ["Renamed", "New"])
+
+    def test_bulk_ordered_stops_at_first_failure(self):
+        responseJSON = self.__register_and_login("user", "pass")
+        auth = dict(username=responseJSON["username"],
+                    token=responseJSON["token"])
+        ops = [dict(op="create", trip=dict(name="First")),
+               dict(op="delete", _id="55f0cbb4236f44b7f0e3cb23"),
+               dict(op="create", trip=dict(name="Third"))]
+
+        response = self.app.post('/trips/bulk',
+                                 data=json.dumps(dict(ops=ops, **auth)),
+                                 content_type='application/json')
+        results = json.loads(response.data.decode())["results"]
+        self.assertEqual([r["status"] for r in results], [200, 404, 424])
+
+        response = self.app.post('/trips/bulk',
+                                 data=json.dumps(dict(ops=ops, ordered=False,
+                                                      **auth)),
+                                 content_type='application/json')
+        results = json.loads(response.data.decode())["results"]
+        self.assertEqual([r["status"] for r in results], [200, 404, 200])
+
+    # A trip write is its own round trip plus one to the change log
+    def test_write_endpoint_round_trips(self):
+        # Get the first request's index bootstrap out of the way
+        self.app.get('/trips/')
+        db = self.flask_app.db
+        counter = OpCountingDatabase(db)
+        self.flask_app.db = counter
+        try:
+            response = self.app.post('/register/',
+                                     data=json.dumps(dict(
+                                         username="user",
+                                         password="pass"
+                                         )),
+                                     content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(counter.ops, [('users', 'insert_one')])
+
+            del counter.ops[:]
+            response = self.app.post('/login/',
+                                     data=json.dumps(dict(
+                                         username="user",
+                                         password="pass"
+                                         )),
+                                     content_type='application/json')
+            token = json.loads(response.data.decode())["token"]
+            # The audit record is written behind
+            self.assertEqual(counter.ops, [('users', 'find_one'),
+                                           ('users', 'update_one')])
+            auth = dict(username="user", token=token)
+
+            del counter.ops[:]
+            response = self.app.post('/trips/',
+                                     data=json.dumps(dict(
+                                         name="A Trip", **auth)),
+                                     content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            # The user's first write also looks up the last change seq
+            changes = [('trip_changes', 'insert_many')]
+            self.assertEqual(counter.ops, [('trips', 'insert_one'),
+                                           ('trip_changes', 'find_one')] +
+                             changes)
+            trip_id = json.loads(response.data.decode())["_id"]
+
+            del counter.ops[:]
+            response = self.app.get('/trips/'+trip_id,
+                                    data=json.dumps(auth),
+                                    content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(counter.ops, [('trips', 'find_one')])
+
+            del counter.ops[:]
+            response = self.app.put('/trips/'+trip_id,
+                                    data=json.dumps(dict(
+                                        name="An Updated Trip", **auth)),
+                                    content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(counter.ops,
+                             [('trips', 'find_one_and_replace')] + changes)
+
+            del counter.ops[:]
+            response = self.app.delete('/trips/'+trip_id,
+                                       data=json.dumps(auth),
+                                       content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(counter.ops, [('trips', 'delete_one')] + changes)
+        finally:
+            self.flask_app.db = db
+
+    def __create_trips(self, auth, trips):
+        for trip in trips:
+            response = self.app.post('/trips/',
+                                     data=json.dumps(dict(trip, **auth)),
+                                     content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+
+    def test_search_trips_by_date(self):
+        responseJSON = self.__register_and_login("user", "pass")
+        auth = dict(username=responseJSON["username"],
+                    token=responseJSON["token"])
+        self.__create_trips(auth, [
+            dict(name="Summer", start_date="2016-07-01"),
+            dict(name="Winter", start_date="2016-12-20"),
+            dict(name="Spring", start_date="2016-04-02"),
+            dict(name="Undated")])
+        response = self.app.get('/trips/search?from=2016-04-01&to=2016-08-01',
+                                data=json.dumps(auth),
+                                content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([t["name"] for t in
+                          json.loads(response.data.decode())],
+                         ["Spring", "Summer"])
+
+        response = self.app.get('/trips/search?from=2016-01-01&limit=2',
+                                data=json.dumps(auth),
+                                content_type='application/json')
+        self.assertEqual([t["name"] for t in
+                          json.loads(response.data.decode())],
+                         ["Spring", "Summer"])
+        self.assertEqual(response.headers['X-Next-Offset'], '2')
+        response = self.app.get('/trips/search?from=2016-01-01&limit=2'
+                                '&offset=2',
+                                data=json.dumps(auth),
+                                content_type='application/json')
+        self.assertEqual([t["name"] for t in
+                          json.loads(response.data.decode())], ["Winter"])
+        self.assertNotIn('X-Next-Offset', response.headers)
+
+        for query in ('from=July', 'near=1,2,3', 'within=0,0,-1,1',
+                      'q=road&near=1,2', 'offset=-1'):
+            response = self.app.get('/trips/search?' + query,
+                                    data=json.dumps(auth),
+                                    content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+        response = self.app.post('/trips/',
+                                 data=json.dumps(dict(
+                                     name="Bad", start_date="soon", **auth)),
+                                 content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_search_trips_by_text_and_location(self):
+        responseJSON = self.__register_and_login("user", "pass")
+        auth = dict(username=responseJSON["username"],
+                    token=responseJSON["token"])
+
+        def stop(lng, lat):
+            return {"location": {"type": "Point", "coordinates": [lng, lat]}}
+        self.__create_trips(auth, [
+            dict(name="Rocky Mountain road trip",
+                 waypoints=[stop(-105.27, 40.01), stop(-105.68, 40.34)]),
+            dict(name="Coast road trip", waypoints=[stop(-122.42, 37.77)]),
+            dict(name="Museum weekend", waypoints=[stop(-74.0, 40.71)])])
+
+        response = self.app.get('/trips/search?q=road',
+                                data=json.dumps(auth),
+                                content_type='application/json')
+        self.assertEqual(sorted(t["name"] for t in
+                                json.loads(response.data.decode())),
+                         ["Coast road trip", "Rocky Mountain road trip"])
+
+        response = self.app.get('/trips/search?near=-105.0,39.7'
+                                '&max_distance=100000',
+                                data=json.dumps(auth),
+                                content_type='application/json')
+        self.assertEqual([t["name"] for t in
+                          json.loads(response.data.decode())],
+                         ["Rocky Mountain road trip"])
+
+        response = self.app.get('/trips/search?within=-125,30,-100,45',
+                                data=json.dumps(auth),
+                                content_type='application/json')
+        self.assertEqual(sorted(t["name"] for t in
+                                json.loads(response.data.decode())),
+                         ["Coast road trip", "Rocky Mountain road trip"])
+
+    def test_trip_changes_feed(self):
+        responseJSON = self.__register_and_login("user", "pass")
+        auth = dict(username=responseJSON["username"],
+                    token=responseJSON["token"])
+        trip_ids = []
+        for name in ("One", "Two", "Three"):
+            response = self.app.post('/trips/',
+                                     data=json.dumps(dict(name=name, **auth)),
+                                     content_type='application/json')
+            trip_ids.append(json.loads(response.data.decode())["_id"])
+        response = self.app.get('/trips/changes',
+                                data=json.dumps(auth),
+                                content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        feed = json.loads(response.data.decode())
+        self.assertEqual([c["trip"]["name"] for c in feed["changes"]],
+                         ["One", "Two", "Three"])
+        self.assertEqual(feed["cursor"], 3)
+        self.assertFalse(feed["more"])
+
+        self.app.put('/trips/' + trip_ids[0],
+                     data=json.dumps(dict(name="One again", **auth)),
+                     content_type='application/json')
+        self.app.delete('/trips/' + trip_ids[1],
+                        data=json.dumps(auth),
+                        content_type='application/json')
+        response = self.app.get('/trips/changes?since=3',
+                                data=json.dumps(auth),
+                                content_type='application/json')
+        feed = json.loads(response.data.decode())
+        self.assertEqual([(c["op"], c["trip_id"]) for c in feed["changes"]],
+                         [("upsert", trip_ids[0]), ("delete", trip_ids[1])])
+        self.assertEqual(feed["changes"][0]["trip"]["name"], "One again")
+        self.assertEqual(feed["cursor"], 5)
+
+        # Older changes to a trip collapse into its latest one
+        response = self.app.get('/trips/changes?since=0&limit=5',
+                                data=json.dumps(auth),
+                                content_type='application/json')
+        feed = json.loads(response.data.decode())
+        self.assertEqual([c["seq"] for c in feed["changes"]], [3, 4, 5])
+        self.assertTrue(feed["more"])
+
+        response = self.app.get('/trips/changes?since=5',
+                                data=json.dumps(auth),
+                                content_type='application/json')
+        feed = json.loads(response.data.decode())
+        self.assertEqual(feed["changes"], [])
+        self.assertEqual(feed["cursor"], 5)
+
+    def test_trip_changes_from_other_workers_and_compaction(self):
+        other_app = self.create_app()
+        other_app.mongo = self.flask_app.mongo
+        other_app.db = self.flask_app.db
+        responseJSON = self.__register_and_login("user", "pass")
+        auth = dict(username="user", token=responseJSON["token"])
+        # Each worker remembers the seq it last wrote; writes from the
+        # other leave that stale, and it has to catch up
+        trip_ids = []
+        for client in (self.app, other_app.test_client(), self.app):
+            response = client.post('/trips/',
+                                   data=json.dumps(dict(name="Trip", **auth)),
+                                   content_type='application/json')
+            trip_ids.append(json.loads(response.data.decode())["_id"])
+        other_app.test_client().put(
+            '/trips/' + trip_ids[0],
+            data=json.dumps(dict(name="Renamed", **auth)),
+            content_type='application/json')
+        self.app.delete('/trips/' + trip_ids[1], data=json.dumps(auth),
+                        content_type='application/json')
+        entries = self.flask_app.db.trip_changes.find().sort("seq", 1)
+        self.assertEqual([e["seq"] for e in entries], [1, 2, 3, 4, 5])
+
+        def feed():
+            response = self.app.get('/trips/changes?since=0',
+                                    data=json.dumps(auth),
+                                    content_type='application/json')
+            return json.loads(response.data.decode())
+
+        before = feed()
+        with self.assertRaises(ValueError):
+            compact_changes(self.flask_app.db, datetime.timedelta(0))
+        later = datetime.datetime.utcnow() + datetime.timedelta(days=8)
+        self.assertEqual(compact_changes(self.flask_app.db, now=later), 2)
+        self.assertEqual(self.flask_app.db.trip_changes.count_documents({}),
+                         3)
+        self.assertEqual(feed(), before)
+        other_app.write_behind.close()
+
+    def test_token_cache_serves_repeat_auth(self):
+        responseJSON = self.__register_and_login("user", "pass")
+        username = responseJSON["username"]
+        token = responseJSON["token"]
+
+        for _ in range(3):
+            response = self.app.get('/trips/',
+                                    data=json.dumps(dict(
+                                        username=username,
+                                        token=token
+                                        )),
+                                    content_type="application/json")
+            self.assertEqual(response.status_code, 200)
+        stats = self.flask_app.token_cache.stats()
+        self.assertEqual(stats["hits"], 3)
+        self.assertEqual(stats["misses"], 0)
+
+    def test_relogin_invalidates_cached_token(self):
+        responseJSON = self.__register_and_login("user", "pass")
+        username = responseJSON["username"]
+        old_token = responseJSON["token"]
+        self.__register_and_login("user", "pass")
+
+        response = self.app.get('/trips/',
+                                data=json.dumps(dict(
+                                    username=username,
+                                    token=old_token
+                                    )),
+                                content_type="application/json")
+        self.assertEqual(response.status_code, 401)
+
+    # ASGI app tests, run in-process on the same backend as the rest
+    def test_asgi_app(self):
+        app = asgi.create_asgi_app(dict(TEST_CONFIG,
+                                        MONGO_DBNAME=self.database_name))
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self.__asgi_session(app))
+        finally:
+            loop.run_until_complete(app.shutdown())
+            loop.close()
+
+    async def __asgi_session(self, app):
+        call = self.__asgi_call
+        status, _, body = await call(app, "POST", "/register/",
+                                     dict(username="user", password="pass"))
+        self.assertEqual(status, 200)
+        status, _, _ = await call(app, "POST", "/register/",
+                                  dict(username="user", password="pass"))
+        self.assertEqual(status, 409)
+        status, _, _ = await call(app, "POST", "/login/",
+                                  dict(username="user", password="nope"))
+        self.assertEqual(status, 401)
+        status, _, body = await call(app, "POST", "/login/",
+                                     dict(username="user", password="pass"))
+        self.assertEqual(status, 200)
+        auth = dict(username="user", token=body["token"])
+
+        status, _, trip = await call(app, "POST", "/trips/",
+                                     dict(name="A Trip", **auth))
+        self.assertEqual(status, 200)
+        status, _, body = await call(app, "GET", "/trips/" + trip["_id"],
+                                     auth)
+        self.assertEqual((status, body["name"]), (200, "A Trip"))
+        status, _, body = await call(app, "PUT", "/trips/" + trip["_id"],
+                                     dict(name="Renamed", **auth))
+        self.assertEqual((status, body["name"]), (200, "Renamed"))
+        status, _, body = await call(app, "PATCH", "/trips/" + trip["_id"],
+                                     dict(patch=[{"op": "replace",
+                                                  "path": "/name",
+                                                  "value": "Patched"}],
+                                          **auth))
+        self.assertEqual((status, body["name"]), (200, "Patched"))
+        await call(app, "POST", "/trips/", dict(name="Another", **auth))
+
+        status, headers, body = await call(app, "GET", "/trips/", auth,
+                                           query=b"limit=1")
+        self.assertEqual([t["name"] for t in body], ["Patched"])
+        self.assertEqual(headers[b"x-next-cursor"].decode(), trip["_id"])
+        status, _, body = await call(app, "GET", "/trips/", auth,
+                                     query=b"stream=1")
+        self.assertEqual([t["name"] for t in body], ["Patched", "Another"])
+
+        status, _, _ = await call(app, "DELETE", "/trips/" + trip["_id"],
+                                  auth)
+        self.assertEqual(status, 200)
+        status, _, _ = await call(app, "GET", "/trips/" + trip["_id"], auth)
+        self.assertEqual(status, 404)
+        status, _, _ = await call(app, "GET", "/trips/notanid", auth)
+        self.assertEqual(status, 404)
+        status, _, _ = await call(app, "GET", "/trips/",
+                                  dict(username="user", token="wrong"))
+        self.assertEqual(status, 401)
+
+    # Sends one request through the app's ASGI interface and returns the
+    # status, headers and decoded JSON body
+    async def __asgi_call(self, app, method, path, payload, query=b""):
+        scope = {"type": "http", "method": method, "path": path,
+                 "query_string": query,
+                 "headers": [(b"content-type", b"application/json")]}
+        request = [{"type": "http.request",
+                    "body": json.dumps(payload).encode("utf-8"),
+                    "more_body": False}]
+        messages = []
+
+        async def receive():
+            return request.pop(0)
+
+        async def send(message):
+            messages.append(message)
+
+        await app(scope, receive, send)
+        start = messages[0]
+        self.assertEqual(start["type"], "http.response.start")
+        body = b"".join(message.get("body", b"")
+                        for message in messages[1:])
+        return (start["status"], dict(start["headers"]),
+                json.loads(body.decode("utf-8")))
+
     def __register_and_login(self, user, passw):
             self.app.post('/register/',
                           data=json.dumps(dict(
@@ -0,0 +1,67 @@
+import argparse
+import datetime
+import sys
+
+from bson.objectid import ObjectId
+from pymongo import DeleteOne, MongoClient
+
+# The trip change log gains an entry on every trip write, but /trips/changes
+# only ever serves the latest entry of each trip. This removes the entries
+# a later one for the same trip supersedes, leaving about one per trip
+# (deleted trips keep their tombstone), e.g. from cron:
+#
+#     python -m utils.compact_changes --database develop_database
+#
+# Feeds read the same before and after. Only entries older than `older_than`
+# go, which must stay well above server.CHANGE_SEQ_TTL: a worker may still
+# write right after a seq it remembers, and relies on the entry after it
+# surviving to detect that it fell behind.
+MIN_AGE = datetime.timedelta(hours=1)
+
+
+# Entries created before `cutoff` with a newer entry for the same trip.
+# Reads the whole log once; meant for a maintenance job, not a request.
+def superseded_changes(db, cutoff):
+    latest = {}
+    old = []
+    for entry in db.trip_changes.find({}, {"username": 1, "trip_id": 1,
+                                           "seq": 1}):
+        key = (entry["username"], entry["trip_id"])
+        latest[key] = max(latest.get(key, 0), entry["seq"])
+        if entry["_id"] < cutoff:
+            old.append(entry)
+    return [entry for entry in old
+            if entry["seq"] < latest[(entry["username"], entry["trip_id"])]]
+
+
+def compact_changes(db, older_than=datetime.timedelta(days=7), now=None,
+                    batch_size=1000):
+    if older_than < MIN_AGE:
+        raise ValueError("Entries younger than %s must be kept" % MIN_AGE)
+    now = now or datetime.datetime.utcnow()
+    superseded = superseded_changes(db, ObjectId.from_datetime(
+        now - older_than))
+    for start in range(0, len(superseded), batch_size):
+        db.trip_changes.bulk_write(
+            [DeleteOne({"_id": entry["_id"]})
+             for entry in superseded[start:start + batch_size]],
+            ordered=False)
+    return len(superseded)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Remove superseded trip change log entries")
+    parser.add_argument("--uri", default="mongodb://localhost:27017/")
+    parser.add_argument("--database", default="develop_database")
+    parser.add_argument("--older-than-days", type=float, default=7)
+    args = parser.parse_args(argv)
+
+    db = MongoClient(args.uri)[args.database]
+    removed = compact_changes(
+        db, datetime.timedelta(days=args.older_than_days))
+    print("Removed %d superseded change log entries" % removed)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,62 @@
+import zlib
+from collections import OrderedDict
+
+
+# Incremental gzip stream: compress() returns whatever output is ready
+# for the data passed in, flush() ends the stream
+class GzipCompressor(object):
+
+    def __init__(self, level=6):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                            16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+
+# Content-Encoding -> compressor factory taking a gzip style level (1-9),
+# preferred encoding first
+COMPRESSORS = OrderedDict()
+
+try:
+    import brotli
+
+    class BrotliCompressor(object):
+
+        def __init__(self, level=6):
+            # Brotli qualities run 0-11; mid levels match gzip -6 for speed
+            # while still producing smaller output
+            self._compressor = brotli.Compressor(quality=min(level, 11))
+
+        def compress(self, data):
+            return self._compressor.process(data)
+
+        def flush(self):
+            return self._compressor.finish()
+
+    COMPRESSORS['br'] = BrotliCompressor
+except ImportError:
+    pass
+
+COMPRESSORS['gzip'] = GzipCompressor
+
+
+def compress(data, encoding, level=6):
+    compressor = COMPRESSORS[encoding](level)
+    return compressor.compress(data) + compressor.flush()
+
+
+# Compresses a response body produced chunk by chunk without buffering
+# it; empty outputs are skipped so the server doesn't send empty chunks
+def compress_stream(chunks, encoding, level=6):
+    compressor = COMPRESSORS[encoding](level)
+    for chunk in chunks:
+        if not isinstance(chunk, bytes):
+            chunk = chunk.encode('utf-8')
+        output = compressor.compress(chunk)
+        if output:
+            yield output
+    yield compressor.flush()
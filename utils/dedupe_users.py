@@ -0,0 +1,61 @@
+import argparse
+import sys
+
+from pymongo import ASCENDING, MongoClient
+
+# Register didn't always enforce unique usernames, and the unique index
+# on users.username can't be built over the duplicates left from then.
+# This keeps the oldest account of each username (lowest _id; trips are
+# owned by username, so they all stay with it) and removes the others,
+# then builds the indexes:
+#
+#     python -m utils.dedupe_users --database develop_database --dry-run
+#     python -m utils.dedupe_users --database develop_database
+#
+# Whoever registered a removed account logs in with the kept account's
+# password from then on.
+
+
+# Every account but the oldest of each username
+def duplicate_users(db):
+    duplicates = []
+    users = db.users.find({}, {"username": 1}).sort(
+        [("username", ASCENDING), ("_id", ASCENDING)])
+    previous = None
+    for position, user in enumerate(users):
+        if position and user.get("username") == previous:
+            duplicates.append(user)
+        previous = user.get("username")
+    return duplicates
+
+
+def dedupe_users(db):
+    duplicates = duplicate_users(db)
+    for user in duplicates:
+        db.users.delete_one({"_id": user["_id"]})
+    return duplicates
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Remove duplicate usernames and build the indexes")
+    parser.add_argument("--uri", default="mongodb://localhost:27017/")
+    parser.add_argument("--database", default="develop_database")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="only list the accounts that would go")
+    args = parser.parse_args(argv)
+
+    import server
+    db = MongoClient(args.uri)[args.database]
+    if args.dry_run:
+        duplicates = duplicate_users(db)
+    else:
+        duplicates = dedupe_users(db)
+        server.ensure_indexes(db)
+    for user in duplicates:
+        print("%s %s %s" % ("Would remove" if args.dry_run else "Removed",
+                            user["_id"], user["username"]))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,139 @@
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+import bcrypt
+
+
+# Raised when every slot of the hashing pool is taken; callers should
+# answer with 429 instead of queueing more CPU work behind the pool.
+class PoolSaturated(Exception):
+    pass
+
+
+# Module-level so they can be pickled into worker processes
+def hashpw(password, salt):
+    return bcrypt.hashpw(password, salt)
+
+
+def checkpw(password, hashed):
+    return bcrypt.checkpw(password, hashed)
+
+
+# Work factor a bcrypt hash was created with, e.g. 12 for b"$2b$12$..."
+def hash_rounds(hashed):
+    return int(hashed.split(b"$")[2])
+
+
+# Whether a hash is far enough from the current work factor to be redone.
+# Calibrated workers can disagree by a round on hardware near a cost
+# boundary, and rehashing on every such difference would bounce a hash
+# between them on each login; `tolerance` rounds of drift are let be.
+def needs_rehash(hashed, rounds, tolerance):
+    return abs(hash_rounds(hashed) - rounds) >= tolerance
+
+
+# Highest work factor whose hash still takes at most `target_seconds` on
+# this machine. Every extra round doubles the cost, so timing a cheap hash
+# is enough to extrapolate.
+def calibrate_rounds(target_seconds, min_rounds=4, max_rounds=16,
+                     base_rounds=6):
+    base_rounds = max(min_rounds, min(base_rounds, max_rounds))
+    salt = bcrypt.gensalt(base_rounds)
+    elapsed = None
+    for _ in range(3):
+        started = time.perf_counter()
+        bcrypt.hashpw(b"calibration", salt)
+        took = time.perf_counter() - started
+        elapsed = took if elapsed is None else min(elapsed, took)
+    rounds = base_rounds
+    while rounds < max_rounds and elapsed * 2 <= target_seconds:
+        rounds += 1
+        elapsed *= 2
+    while rounds > min_rounds and elapsed > target_seconds:
+        rounds -= 1
+        elapsed /= 2
+    return rounds
+
+
+# Work factor for new hashes: BCRYPT_ROUNDS if set, else calibrated to
+# BCRYPT_TARGET_SECONDS within [BCRYPT_MIN_ROUNDS, BCRYPT_MAX_ROUNDS]
+def configured_rounds(config):
+    if config['BCRYPT_ROUNDS']:
+        return config['BCRYPT_ROUNDS']
+    return calibrate_rounds(config['BCRYPT_TARGET_SECONDS'],
+                            config['BCRYPT_MIN_ROUNDS'],
+                            config['BCRYPT_MAX_ROUNDS'])
+
+
+# Runs work on the calling thread; handy for tests and single-core hosts
+class InlineExecutor(object):
+
+    def submit(self, fn, *args):
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self, wait=True):
+        pass
+
+
+# Dispatches bcrypt work to a pool of workers (processes by default, one
+# per core) with a bounded number of outstanding jobs for back-pressure.
+class HashingPool(object):
+
+    def __init__(self, kind='process', workers=None, queue_size=None):
+        if kind not in ('process', 'thread', 'inline'):
+            raise ValueError("Unknown hashing executor: %s" % kind)
+        self.kind = kind
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = queue_size or self.workers * 4
+        self._executor = None
+        self._pid = None
+        self._slots = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        # Executors don't survive a fork, so each worker process gets its own
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    if self.kind == 'process':
+                        self._executor = ProcessPoolExecutor(self.workers)
+                    elif self.kind == 'thread':
+                        self._executor = ThreadPoolExecutor(self.workers)
+                    else:
+                        self._executor = InlineExecutor()
+                    self._slots = threading.BoundedSemaphore(self.queue_size)
+                    self._pid = os.getpid()
+        return self._executor
+
+    def submit(self, fn, *args):
+        executor = self._get_executor()
+        slots = self._slots
+        if not slots.acquire(blocking=False):
+            raise PoolSaturated()
+        try:
+            future = executor.submit(fn, *args)
+        except Exception:
+            slots.release()
+            raise
+        future.add_done_callback(lambda _: slots.release())
+        return future
+
+    def hashpw(self, password, salt):
+        return self.submit(hashpw, password, salt).result()
+
+    def checkpw(self, password, hashed):
+        return self.submit(checkpw, password, hashed).result()
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait=wait)
+            self._executor = None
+            self._pid = None
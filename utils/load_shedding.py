@@ -0,0 +1,38 @@
+import threading
+
+
+# Turns requests away up front once the process is already as busy as it
+# can usefully be: too many requests in flight, or Mongo connections so
+# contended that checkouts queue. Failing fast there keeps the requests
+# that are admitted from waiting behind the overload.
+class LoadShedder(object):
+
+    def __init__(self, max_in_flight=None, max_pool_wait=None,
+                 pool_wait=None):
+        self.max_in_flight = max_in_flight
+        self.max_pool_wait = max_pool_wait
+        # Callable returning the recent pool checkout wait in seconds
+        self.pool_wait = pool_wait
+        self.in_flight = 0
+        self.shed = 0
+        self._lock = threading.Lock()
+
+    # Admits a request, to be matched by a call to leave(), or returns
+    # False if it should be shed
+    def enter(self):
+        if (self.max_pool_wait is not None and self.pool_wait is not None and
+                self.pool_wait() > self.max_pool_wait):
+            with self._lock:
+                self.shed += 1
+            return False
+        with self._lock:
+            if (self.max_in_flight is not None and
+                    self.in_flight >= self.max_in_flight):
+                self.shed += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def leave(self):
+        with self._lock:
+            self.in_flight -= 1
@@ -0,0 +1,829 @@
+import copy
+import datetime
+import math
+import re
+import threading
+from collections import OrderedDict
+
+from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pymongo.results import (BulkWriteResult, DeleteResult, InsertManyResult,
+                             InsertOneResult, UpdateResult)
+
+# An in-process stand-in for the parts of a pymongo Database the handlers
+# use, so tests (or a quick local run) need no MongoDB server and each test
+# can have a database of its own. It covers the queries, updates and index
+# behaviour of server.py: equality and comparison filters on dotted paths,
+# $in/$all/$exists/$or, $text, $near/$geoWithin on points, $set/$unset/$push/
+# $pull/$inc with arrayFilters, unique indexes and ordered/unordered bulk
+# writes. It is not a query planner: everything is a scan.
+
+EARTH_RADIUS_METERS = 6378100.0
+MISSING = object()
+
+
+# Sort order across BSON types, lowest first, as MongoDB compares them
+def type_order(value):
+    if value is None or value is MISSING:
+        return 1
+    if isinstance(value, bool):
+        return 8
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, str):
+        return 3
+    if isinstance(value, dict):
+        return 4
+    if isinstance(value, list):
+        return 5
+    if isinstance(value, ObjectId):
+        return 7
+    if isinstance(value, datetime.datetime):
+        return 9
+    return 10
+
+
+def sort_key(value):
+    if value is MISSING:
+        value = None
+    if isinstance(value, list):
+        value = [sort_key(item) for item in value]
+    elif isinstance(value, dict):
+        value = [(key, sort_key(item)) for key, item in value.items()]
+    return (type_order(value), value if value is not None else 0)
+
+
+# Values a dotted path reaches in a document, fanning out over arrays
+def path_values(document, path):
+    values = [document]
+    for part in path.split("."):
+        found = []
+        for value in values:
+            if isinstance(value, dict):
+                if part in value:
+                    found.append(value[part])
+            elif isinstance(value, list):
+                if part.isdigit() and int(part) < len(value):
+                    found.append(value[int(part)])
+                else:
+                    found.extend(item[part] for item in value
+                                 if isinstance(item, dict) and part in item)
+        values = found
+    return values
+
+
+# A value and, for arrays, each of their elements, which is what a filter
+# on the path is compared with
+def candidates(values):
+    for value in values:
+        yield value
+        if isinstance(value, list):
+            for item in value:
+                yield item
+
+
+def compare(candidate, operator, operand):
+    if type_order(candidate) != type_order(operand):
+        return False
+    if operator == "$gt":
+        return candidate > operand
+    if operator == "$gte":
+        return candidate >= operand
+    if operator == "$lt":
+        return candidate < operand
+    return candidate <= operand
+
+
+def haversine(point, other):
+    lng1, lat1 = [math.radians(c) for c in point]
+    lng2, lat2 = [math.radians(c) for c in other]
+    a = (math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) *
+         math.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_METERS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def point_in_polygon(point, ring):
+    x, y = point
+    inside = False
+    for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1]):
+        if (y1 > y) != (y2 > y) and x < (x2 - x1) * (y - y1) / (y2 - y1) + x1:
+            inside = not inside
+    return inside
+
+
+def points(values):
+    for value in candidates(values):
+        if (isinstance(value, dict) and value.get("type") == "Point" and
+                isinstance(value.get("coordinates"), list)):
+            yield value["coordinates"]
+
+
+def words(text):
+    return re.findall(r"\w+", text.lower())
+
+
+class Matcher(object):
+
+    def __init__(self, query, text_fields=()):
+        self.query = query or {}
+        self.text_fields = text_fields
+
+    # Returns None if `document` doesn't match, else a dict with the
+    # text score and $near distance it matched with (if any)
+    def match(self, document):
+        meta = {}
+        if self._match(document, self.query, meta):
+            return meta
+        return None
+
+    def _match(self, document, query, meta):
+        for key, condition in query.items():
+            if key == "$or":
+                if not any(self._match(document, clause, meta)
+                           for clause in condition):
+                    return False
+            elif key == "$and":
+                if not all(self._match(document, clause, meta)
+                           for clause in condition):
+                    return False
+            elif key == "$text":
+                score = self._text_score(document, condition["$search"])
+                if not score:
+                    return False
+                meta["score"] = score
+            elif not self._match_field(path_values(document, key), condition,
+                                       meta):
+                return False
+        return True
+
+    def _text_score(self, document, search):
+        terms = set(words(search))
+        found = set()
+        for field in self.text_fields:
+            for value in candidates(path_values(document, field)):
+                if isinstance(value, str):
+                    found.update(terms.intersection(words(value)))
+        return float(len(found))
+
+    def _match_field(self, values, condition, meta):
+        if not (isinstance(condition, dict) and condition and
+                all(key.startswith("$") for key in condition)):
+            return self._equals(values, condition)
+        for operator, operand in condition.items():
+            if operator == "$in":
+                if not any(self._equals(values, item) for item in operand):
+                    return False
+            elif operator == "$all":
+                if not all(self._equals(values, item) for item in operand):
+                    return False
+            elif operator == "$nin":
+                if any(self._equals(values, item) for item in operand):
+                    return False
+            elif operator == "$ne":
+                if self._equals(values, operand):
+                    return False
+            elif operator == "$exists":
+                if bool(values) != bool(operand):
+                    return False
+            elif operator in ("$gt", "$gte", "$lt", "$lte"):
+                if not any(compare(value, operator, operand)
+                           for value in candidates(values)):
+                    return False
+            elif operator == "$near":
+                origin = operand["$geometry"]["coordinates"]
+                distances = [haversine(origin, point)
+                             for point in points(values)]
+                if not distances:
+                    return False
+                distance = min(distances)
+                if distance > operand.get("$maxDistance", float("inf")):
+                    return False
+                meta["distance"] = distance
+            elif operator == "$geoWithin":
+                ring = operand["$geometry"]["coordinates"][0]
+                if not any(point_in_polygon(point, ring)
+                           for point in points(values)):
+                    return False
+            elif operator == "$elemMatch":
+                if not any(isinstance(item, dict) and
+                           self._match(item, operand, {})
+                           for value in values if isinstance(value, list)
+                           for item in value):
+                    return False
+            else:
+                raise NotImplementedError("Query operator %s" % operator)
+        return True
+
+    def _equals(self, values, expected):
+        if not values:
+            return expected is None
+        return any(value == expected for value in candidates(values))
+
+
+# Array filter identifier -> predicate for the elements it selects, e.g.
+# {"w0._id": id} selects the elements of "$[w0]" whose _id is id
+def array_filter_predicates(array_filters):
+    grouped = {}
+    for array_filter in array_filters or ():
+        for key, condition in array_filter.items():
+            name, _, rest = key.partition(".")
+            grouped.setdefault(name, {})[rest] = condition
+    predicates = {}
+    for name, query in grouped.items():
+        if "" in query:
+            def selects(item, condition=query[""]):
+                return Matcher({"value": condition}).match(
+                    {"value": item}) is not None
+        else:
+            def selects(item, matcher=Matcher(query)):
+                return (isinstance(item, dict) and
+                        matcher.match(item) is not None)
+        predicates[name] = selects
+    return predicates
+
+
+def child_keys(holder, part, predicates):
+    if part.startswith("$[") and part.endswith("]"):
+        if not isinstance(holder, list):
+            return []
+        selects = predicates.get(part[2:-1], lambda item: True)
+        return [index for index, item in enumerate(holder) if selects(item)]
+    if isinstance(holder, list):
+        return [int(part)] if part.isdigit() else []
+    if isinstance(holder, dict):
+        return [part]
+    return []
+
+
+# (container, key) pairs a dotted update path addresses, creating missing
+# sub-documents on the way when `create` is set
+def update_targets(document, path, predicates, create):
+    parts = path.split(".")
+    holders = [document]
+    for part in parts[:-1]:
+        children = []
+        for holder in holders:
+            for key in child_keys(holder, part, predicates):
+                child = container_get(holder, key)
+                if child is MISSING or child is None:
+                    if not create:
+                        continue
+                    child = {}
+                    container_set(holder, key, child)
+                children.append(child)
+        holders = children
+    return [(holder, key) for holder in holders
+            for key in child_keys(holder, parts[-1], predicates)]
+
+
+def container_get(container, key):
+    if isinstance(container, list):
+        return container[key] if key < len(container) else MISSING
+    return container.get(key, MISSING)
+
+
+def container_set(container, key, value):
+    if isinstance(container, list):
+        container.extend([None] * (key + 1 - len(container)))
+    container[key] = value
+
+
+def pull_predicate(condition):
+    if isinstance(condition, dict):
+        matcher = Matcher(condition)
+        return lambda item: (isinstance(item, dict) and
+                             matcher.match(item) is not None)
+    return lambda item: item == condition
+
+
+def apply_update(document, update, array_filters=None):
+    predicates = array_filter_predicates(array_filters)
+    for operator, fields in update.items():
+        if operator not in ("$set", "$unset", "$inc", "$push", "$pull"):
+            raise NotImplementedError("Update operator %s" % operator)
+        for path, value in fields.items():
+            create = operator != "$unset" and operator != "$pull"
+            for container, key in update_targets(document, path, predicates,
+                                                 create):
+                current = container_get(container, key)
+                if operator == "$set":
+                    container_set(container, key, copy.deepcopy(value))
+                elif operator == "$unset":
+                    if isinstance(container, dict):
+                        container.pop(key, None)
+                    else:
+                        container[key] = None
+                elif operator == "$inc":
+                    container_set(container, key, value if current is MISSING
+                                  else current + value)
+                elif operator == "$push":
+                    each, position = [value], None
+                    if isinstance(value, dict) and "$each" in value:
+                        each = value["$each"]
+                        position = value.get("$position")
+                    if current is MISSING:
+                        current = []
+                        container_set(container, key, current)
+                    if position is None:
+                        position = len(current)
+                    current[position:position] = copy.deepcopy(each)
+                elif isinstance(current, list):
+                    pulled = pull_predicate(value)
+                    current[:] = [item for item in current
+                                  if not pulled(item)]
+
+
+def project(document, projection, meta):
+    if not projection:
+        return copy.deepcopy(document)
+    metas = dict((field, spec) for field, spec in projection.items()
+                 if isinstance(spec, dict) and "$meta" in spec)
+    fields = dict((field, spec) for field, spec in projection.items()
+                  if field not in metas)
+    include = [field for field, spec in fields.items()
+               if spec and field != "_id"]
+    if include:
+        projected = OrderedDict()
+        if fields.get("_id", 1) and "_id" in document:
+            projected["_id"] = document["_id"]
+        for field in include:
+            include_path(document, projected, field.split("."))
+        projected = copy.deepcopy(dict(projected))
+    else:
+        projected = copy.deepcopy(document)
+        for field, spec in fields.items():
+            if not spec:
+                for container, key in update_targets(projected, field, {},
+                                                      False):
+                    if isinstance(container, dict):
+                        container.pop(key, None)
+    for field, spec in metas.items():
+        if spec["$meta"] == "textScore":
+            projected[field] = meta.get("score", 0.0)
+    return projected
+
+
+def include_path(source, target, parts):
+    if isinstance(source, list):
+        return [include_path(item, {}, parts) for item in source
+                if isinstance(item, dict)]
+    if not isinstance(source, dict) or parts[0] not in source:
+        return target
+    if len(parts) == 1:
+        target[parts[0]] = source[parts[0]]
+    else:
+        child = target.get(parts[0], {})
+        target[parts[0]] = include_path(source[parts[0]], child, parts[1:])
+    return target
+
+
+# Indexes of one collection. Only unique ones change behaviour; text ones
+# tell $text which fields to search.
+class IndexSet(object):
+
+    def __init__(self):
+        self.indexes = OrderedDict()
+        self.indexes["_id_"] = ([("_id", 1)], True)
+
+    def create(self, keys, unique=False, name=None):
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        keys = list(keys)
+        name = name or "_".join("%s_%s" % (field, direction)
+                                for field, direction in keys)
+        self.indexes[name] = (keys, unique)
+        return name
+
+    def text_fields(self):
+        return [field for keys, _ in self.indexes.values()
+                for field, direction in keys if direction == "text"]
+
+    def unique_keys(self, document):
+        for name, (keys, unique) in self.indexes.items():
+            if unique:
+                yield name, tuple(
+                    tuple(path_values(document, field)) or (None,)
+                    for field, _ in keys)
+
+
+class MemoryCursor(object):
+
+    def __init__(self, collection, query, projection):
+        self._collection = collection
+        self._query = query
+        self._projection = projection
+        self._sort = None
+        self._skip = 0
+        self._limit = 0
+
+    def sort(self, key_or_list, direction=1):
+        if isinstance(key_or_list, str):
+            key_or_list = [(key_or_list, direction)]
+        self._sort = list(key_or_list)
+        return self
+
+    def skip(self, skip):
+        self._skip = skip
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def explain(self):
+        raise NotImplementedError("The memory store has no query plans")
+
+    def __iter__(self):
+        matches = self._collection._matches(self._query)
+        if self._sort:
+            for field, direction in reversed(self._sort):
+                if isinstance(direction, dict):
+                    matches.sort(key=lambda match: match[1].get("score", 0.0),
+                                 reverse=True)
+                else:
+                    matches.sort(key=lambda match, field=field: sort_key(
+                        self._sort_value(match[0], field, direction)),
+                        reverse=direction < 0)
+        elif any(meta.get("distance") is not None for _, meta in matches):
+            matches.sort(key=lambda match: match[1].get("distance", 0.0))
+        end = self._skip + self._limit if self._limit else None
+        for document, meta in matches[self._skip:end]:
+            yield project(document, self._projection, meta)
+
+    # Arrays sort by their lowest element ascending, highest descending
+    def _sort_value(self, document, field, direction):
+        values = list(candidates(path_values(document, field)))
+        values = [value for value in values if not isinstance(value, list)]
+        if not values:
+            return None
+        keys = sorted(values, key=sort_key)
+        return keys[0] if direction > 0 else keys[-1]
+
+
+class MemoryCollection(object):
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self._documents = OrderedDict()
+        self._indexes = IndexSet()
+        self._lock = threading.RLock()
+
+    # Like Mongo, a unique index can't be built over duplicates
+    def create_index(self, keys, unique=False, name=None, **kwargs):
+        with self._lock:
+            name = self._indexes.create(keys, unique, name)
+            if unique:
+                seen = set()
+                for document in self._documents.values():
+                    key = dict(self._indexes.unique_keys(document))[name]
+                    if key in seen:
+                        del self._indexes.indexes[name]
+                        raise DuplicateKeyError(
+                            "E11000 duplicate key error collection: %s "
+                            "index: %s" % (self.name, name), 11000)
+                    seen.add(key)
+            return name
+
+    def drop(self):
+        self.database.drop_collection(self.name)
+
+    # [(document, meta)] for the stored documents matching `query`
+    def _matches(self, query):
+        matcher = Matcher(query, self._indexes.text_fields())
+        with self._lock:
+            matches = []
+            for document in self._documents.values():
+                meta = matcher.match(document)
+                if meta is not None:
+                    matches.append((document, meta))
+            return matches
+
+    def _first(self, query, sort=None):
+        cursor = MemoryCursor(self, query, None).limit(1)
+        if sort:
+            cursor.sort(sort)
+        for document in cursor:
+            return document
+        return None
+
+    def _check_unique(self, document, replacing=None):
+        keys = dict(self._indexes.unique_keys(document))
+        for other_id, other in self._documents.items():
+            if other_id == replacing:
+                continue
+            for name, key in self._indexes.unique_keys(other):
+                if keys[name] == key:
+                    raise DuplicateKeyError(
+                        "E11000 duplicate key error collection: %s index: %s"
+                        % (self.name, name), 11000)
+
+    def _insert(self, document):
+        if "_id" not in document:
+            document["_id"] = ObjectId()
+        stored = copy.deepcopy(document)
+        self._check_unique(stored)
+        self._documents[stored["_id"]] = stored
+        return stored["_id"]
+
+    def _replace(self, stored, replacement):
+        document = copy.deepcopy(replacement)
+        document["_id"] = stored["_id"]
+        self._check_unique(document, stored["_id"])
+        self._documents[stored["_id"]] = document
+
+    def _update(self, stored, update, array_filters):
+        document = copy.deepcopy(stored)
+        apply_update(document, update, array_filters)
+        self._check_unique(document, stored["_id"])
+        self._documents[stored["_id"]] = document
+
+    def find(self, filter=None, projection=None, sort=None, skip=0, limit=0):
+        cursor = MemoryCursor(self, filter, projection)
+        if sort:
+            cursor.sort(sort)
+        return cursor.skip(skip).limit(limit)
+
+    def find_one(self, filter=None, projection=None, sort=None):
+        if filter is not None and not isinstance(filter, dict):
+            filter = {"_id": filter}
+        for document in self.find(filter, projection, sort, limit=1):
+            return document
+        return None
+
+    def count_documents(self, filter):
+        return len(self._matches(filter))
+
+    def insert_one(self, document):
+        with self._lock:
+            return InsertOneResult(self._insert(document), True)
+
+    def insert_many(self, documents, ordered=True):
+        ids = []
+        errors = []
+        with self._lock:
+            for index, document in enumerate(documents):
+                try:
+                    ids.append(self._insert(document))
+                except DuplicateKeyError as e:
+                    errors.append({"index": index, "code": 11000,
+                                   "errmsg": str(e), "op": document})
+                    if ordered:
+                        break
+        if errors:
+            raise BulkWriteError(bulk_result(len(ids), 0, 0, errors))
+        return InsertManyResult(ids, True)
+
+    def update_one(self, filter, update, upsert=False, array_filters=None):
+        with self._lock:
+            matches = self._matches(filter)
+            if not matches:
+                return UpdateResult({"n": 0, "nModified": 0}, True)
+            self._update(matches[0][0], update, array_filters)
+            return UpdateResult({"n": 1, "nModified": 1}, True)
+
+    def find_one_and_replace(self, filter, replacement, projection=None,
+                             sort=None, return_document=False, **kwargs):
+        with self._lock:
+            before = self._first(filter, sort)
+            if before is None:
+                return None
+            self._replace(self._documents[before["_id"]], replacement)
+            after = self._documents[before["_id"]]
+            return project(after if return_document else before,
+                           projection, {})
+
+    def find_one_and_update(self, filter, update, projection=None, sort=None,
+                            return_document=False, array_filters=None,
+                            **kwargs):
+        with self._lock:
+            before = self._first(filter, sort)
+            if before is None:
+                return None
+            self._update(self._documents[before["_id"]], update,
+                         array_filters)
+            after = self._documents[before["_id"]]
+            return project(after if return_document else before,
+                           projection, {})
+
+    def delete_one(self, filter):
+        with self._lock:
+            matches = self._matches(filter)
+            if not matches:
+                return DeleteResult({"n": 0}, True)
+            del self._documents[matches[0][0]["_id"]]
+            return DeleteResult({"n": 1}, True)
+
+    def delete_many(self, filter):
+        with self._lock:
+            matches = self._matches(filter)
+            for document, _ in matches:
+                del self._documents[document["_id"]]
+            return DeleteResult({"n": len(matches)}, True)
+
+    def bulk_write(self, requests, ordered=True):
+        operations = BulkRecorder()
+        for request in requests:
+            request._add_to_bulk(operations)
+        counts = {"inserted": 0, "matched": 0, "removed": 0}
+        errors = []
+        with self._lock:
+            for index, (kind, args) in enumerate(operations.operations):
+                try:
+                    self._bulk_operation(kind, args, counts)
+                except DuplicateKeyError as e:
+                    errors.append({"index": index, "code": 11000,
+                                   "errmsg": str(e), "op": args[0]})
+                    if ordered:
+                        break
+        result = bulk_result(counts["inserted"], counts["matched"],
+                             counts["removed"], errors)
+        if errors:
+            raise BulkWriteError(result)
+        return BulkWriteResult(result, True)
+
+    def _bulk_operation(self, kind, args, counts):
+        if kind == "insert":
+            self._insert(args[0])
+            counts["inserted"] += 1
+            return
+        matches = self._matches(args[0])
+        if kind == "delete":
+            if matches:
+                del self._documents[matches[0][0]["_id"]]
+                counts["removed"] += 1
+        elif matches:
+            if kind == "replace":
+                self._replace(matches[0][0], args[1])
+            else:
+                self._update(matches[0][0], args[1], args[2])
+            counts["matched"] += 1
+
+
+def bulk_result(inserted, matched, removed, errors):
+    return {"writeErrors": errors, "writeConcernErrors": [],
+            "nInserted": inserted, "nUpserted": 0, "nMatched": matched,
+            "nModified": matched, "nRemoved": removed, "upserted": []}
+
+
+# Receives pymongo's InsertOne/ReplaceOne/UpdateOne/DeleteOne requests the
+# way pymongo's own bulk runner does, through _add_to_bulk
+class BulkRecorder(object):
+
+    def __init__(self):
+        self.operations = []
+
+    def add_insert(self, document):
+        self.operations.append(("insert", (document,)))
+
+    def add_replace(self, selector, replacement, upsert=False, **kwargs):
+        self.operations.append(("replace", (selector, replacement)))
+
+    def add_update(self, selector, update, multi=False, upsert=False,
+                   array_filters=None, **kwargs):
+        self.operations.append(("update", (selector, update, array_filters)))
+
+    def add_delete(self, selector, limit, **kwargs):
+        self.operations.append(("delete", (selector,)))
+
+
+class MemoryDatabase(object):
+
+    def __init__(self, name="memory"):
+        self.name = name
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._collections:
+                self._collections[name] = MemoryCollection(self, name)
+            return self._collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def drop_collection(self, name):
+        with self._lock:
+            self._collections.pop(getattr(name, "name", name), None)
+
+    def list_collection_names(self):
+        return sorted(self._collections)
+
+
+class MemoryClient(object):
+
+    def __init__(self):
+        self._databases = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._databases:
+                self._databases[name] = MemoryDatabase(name)
+            return self._databases[name]
+
+    def drop_database(self, name):
+        with self._lock:
+            self._databases.pop(getattr(name, "name", name), None)
+
+    def close(self):
+        pass
+
+
+# Same interface as utils.mongo.MongoConnection. Memory isn't shared across
+# a fork, so each worker process ends up with a database of its own.
+class MemoryConnection(object):
+
+    def __init__(self, database):
+        self.database_name = database
+        self.client = MemoryClient()
+        self.pool_stats = None
+
+    @property
+    def database(self):
+        return self.client[self.database_name]
+
+    def close(self):
+        pass
+
+
+# motor-style facade over the memory store, for asgi.py: the same calls,
+# awaitable. They run inline, there being no I/O to wait on.
+class AsyncMemoryCursor(object):
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self._iterator = None
+
+    def sort(self, *args, **kwargs):
+        self._cursor.sort(*args, **kwargs)
+        return self
+
+    def skip(self, skip):
+        self._cursor.skip(skip)
+        return self
+
+    def limit(self, limit):
+        self._cursor.limit(limit)
+        return self
+
+    async def to_list(self, length=None):
+        documents = list(self._cursor)
+        return documents[:length] if length is not None else documents
+
+    def __aiter__(self):
+        self._iterator = iter(self._cursor)
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._iterator)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class AsyncMemoryCollection(object):
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def find(self, *args, **kwargs):
+        return AsyncMemoryCursor(self._collection.find(*args, **kwargs))
+
+    def __getattr__(self, name):
+        method = getattr(self._collection, name)
+
+        async def call(*args, **kwargs):
+            return method(*args, **kwargs)
+        return call
+
+
+class AsyncMemoryDatabase(object):
+
+    def __init__(self, database):
+        self._database = database
+        self.name = database.name
+
+    def __getitem__(self, name):
+        return AsyncMemoryCollection(self._database[name])
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+
+# Stands in for motor's AsyncIOMotorClient
+class AsyncMemoryClient(object):
+
+    def __init__(self, client=None):
+        self.delegate = client if client is not None else MemoryClient()
+
+    def __getitem__(self, name):
+        return AsyncMemoryDatabase(self.delegate[name])
+
+    def close(self):
+        self.delegate.close()
@@ -0,0 +1,159 @@
+import threading
+import time
+
+from pymongo import monitoring
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\")
+                     .replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs)
+
+
+# Cumulative Prometheus histogram, one series per label combination
+class Histogram(object):
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = \
+                    [[0] * len(self.buckets), 0.0, 0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.documentation),
+                 "# TYPE %s histogram" % self.name]
+        with self._lock:
+            series = sorted(self._series.items())
+            for labelvalues, (counts, total, count) in series:
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append("%s_bucket%s %d" % (
+                        self.name, format_labels(self.labelnames, labelvalues,
+                                                 [("le", repr(bound))]),
+                        bucket_count))
+                lines.append("%s_bucket%s %d" % (
+                    self.name, format_labels(self.labelnames, labelvalues,
+                                             [("le", "+Inf")]), count))
+                labels = format_labels(self.labelnames, labelvalues)
+                lines.append("%s_sum%s %r" % (self.name, labels, total))
+                lines.append("%s_count%s %d" % (self.name, labels, count))
+        return lines
+
+
+# Value read from a callback at scrape time
+class Gauge(object):
+
+    def __init__(self, name, documentation, callback, kind="gauge"):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.kind = kind
+
+    def render(self):
+        return ["# HELP %s %s" % (self.name, self.documentation),
+                "# TYPE %s %s" % (self.name, self.kind),
+                "%s %r" % (self.name, float(self.callback()))]
+
+
+# Records Mongo command counts and durations, both overall and for the
+# request currently being handled on this thread
+class CommandTimer(monitoring.CommandListener):
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.metrics.record_command(event.command_name,
+                                    event.duration_micros / 1e6, "ok")
+
+    def failed(self, event):
+        self.metrics.record_command(event.command_name,
+                                    event.duration_micros / 1e6, "error")
+
+
+class Metrics(object):
+
+    def __init__(self):
+        self.request_seconds = Histogram(
+            "trip_api_request_duration_seconds",
+            "Time spent handling a request",
+            ("endpoint", "method", "status"))
+        self.serialization_seconds = Histogram(
+            "trip_api_serialization_seconds",
+            "Time spent encoding response bodies in output_json",
+            ("endpoint",))
+        self.request_mongo_ops = Histogram(
+            "trip_api_request_mongo_operations",
+            "Mongo commands issued per request", ("endpoint",),
+            buckets=(0, 1, 2, 3, 4, 5, 10, 20, 50))
+        self.request_mongo_seconds = Histogram(
+            "trip_api_request_mongo_seconds",
+            "Time spent waiting on Mongo per request", ("endpoint",))
+        self.command_seconds = Histogram(
+            "trip_api_mongo_command_duration_seconds",
+            "Duration of individual Mongo commands", ("command", "outcome"))
+        self.gauges = []
+        self.listener = CommandTimer(self)
+        self._request = threading.local()
+
+    def add_gauge(self, name, documentation, callback, kind="gauge"):
+        self.gauges.append(Gauge(name, documentation, callback, kind))
+
+    def record_command(self, command, seconds, outcome):
+        self.command_seconds.observe(seconds, command, outcome)
+        state = self._request
+        if getattr(state, "active", False):
+            state.ops += 1
+            state.mongo_seconds += seconds
+
+    def begin_request(self):
+        state = self._request
+        state.active = True
+        state.ops = 0
+        state.mongo_seconds = 0.0
+        state.started = time.perf_counter()
+
+    def end_request(self, endpoint, method, status):
+        state = self._request
+        if not getattr(state, "active", False):
+            return
+        state.active = False
+        self.request_seconds.observe(time.perf_counter() - state.started,
+                                     endpoint, method, status)
+        self.request_mongo_ops.observe(state.ops, endpoint)
+        self.request_mongo_seconds.observe(state.mongo_seconds, endpoint)
+
+    def render(self):
+        lines = []
+        for metric in (self.request_seconds, self.serialization_seconds,
+                       self.request_mongo_ops, self.request_mongo_seconds,
+                       self.command_seconds):
+            lines.extend(metric.render())
+        for gauge in self.gauges:
+            lines.extend(gauge.render())
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,166 @@
+import os
+import threading
+import time
+
+from pymongo import MongoClient, monitoring
+
+
+# Connection pool listener keeping utilization and checkout wait figures
+class PoolStats(monitoring.ConnectionPoolListener):
+
+    def __init__(self, max_pool_size):
+        self.max_pool_size = max_pool_size
+        self.open = 0
+        self.in_use = 0
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        # Exponentially weighted recent checkout wait, in seconds
+        self.wait_time_recent = 0.0
+        self.last_wait_at = time.monotonic()
+        self._started = threading.local()
+        self._lock = threading.Lock()
+
+    def _waited(self):
+        started = getattr(self._started, "at", None)
+        self._started.at = None
+        return time.monotonic() - started if started is not None else 0.0
+
+    def pool_created(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self._lock:
+            self.open += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.open -= 1
+
+    def connection_check_out_started(self, event):
+        self._started.at = time.monotonic()
+
+    def connection_check_out_failed(self, event):
+        waited = self._waited()
+        with self._lock:
+            self.checkout_failures += 1
+            self.wait_time_total += waited
+            self.wait_time_max = max(self.wait_time_max, waited)
+            self.wait_time_recent += 0.1 * (waited - self.wait_time_recent)
+            self.last_wait_at = time.monotonic()
+
+    def connection_checked_out(self, event):
+        waited = self._waited()
+        with self._lock:
+            self.in_use += 1
+            self.checkouts += 1
+            self.wait_time_total += waited
+            self.wait_time_max = max(self.wait_time_max, waited)
+            self.wait_time_recent += 0.1 * (waited - self.wait_time_recent)
+            self.last_wait_at = time.monotonic()
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.in_use -= 1
+
+    # wait_time_recent, halved for every `half_life` seconds without a
+    # checkout so an idle pool (e.g. while requests are being shed) stops
+    # looking congested
+    def current_wait(self, half_life=1.0):
+        idle = time.monotonic() - self.last_wait_at
+        return self.wait_time_recent * 0.5 ** (idle / half_life)
+
+    def snapshot(self):
+        with self._lock:
+            attempts = self.checkouts + self.checkout_failures
+            return {
+                "max_pool_size": self.max_pool_size,
+                "open": self.open,
+                "in_use": self.in_use,
+                "utilization": float(self.in_use) / self.max_pool_size,
+                "checkouts": self.checkouts,
+                "checkout_failures": self.checkout_failures,
+                "wait_time_avg": self.wait_time_total / attempts
+                if attempts else 0.0,
+                "wait_time_max": self.wait_time_max,
+                "wait_time_recent": self.wait_time_recent
+            }
+
+
+# Owns the MongoClient of the current process. pymongo clients must not be
+# shared across a fork, so the client is only created on first use and is
+# created again whenever the pid changes (e.g. in each WSGI worker).
+class MongoConnection(object):
+
+    def __init__(self, uri, database, max_pool_size=100, min_pool_size=0,
+                 wait_queue_timeout_ms=None, connect_timeout_ms=20000,
+                 socket_timeout_ms=None, server_selection_timeout_ms=30000,
+                 read_preference='primary', event_listeners=()):
+        self.uri = uri
+        self.database_name = database
+        self.options = {
+            "maxPoolSize": max_pool_size,
+            "minPoolSize": min_pool_size,
+            "waitQueueTimeoutMS": wait_queue_timeout_ms,
+            "connectTimeoutMS": connect_timeout_ms,
+            "socketTimeoutMS": socket_timeout_ms,
+            "serverSelectionTimeoutMS": server_selection_timeout_ms,
+            "readPreference": read_preference
+        }
+        self.event_listeners = list(event_listeners)
+        self.pool_stats = None
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self.pool_stats = PoolStats(self.options["maxPoolSize"])
+                    self._client = MongoClient(
+                        self.uri, connect=False,
+                        event_listeners=self.event_listeners +
+                        [self.pool_stats],
+                        **self.options)
+                    self._pid = os.getpid()
+        return self._client
+
+    @property
+    def database(self):
+        return self.client[self.database_name]
+
+    def close(self):
+        with self._lock:
+            if self._client is not None and self._pid == os.getpid():
+                self._client.close()
+            self._client = None
+            self._pid = None
+
+
+# Stands in for a pymongo Database and resolves every access against the
+# current process's client, so it is safe to create before forking
+class LazyDatabase(object):
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def __getattr__(self, name):
+        return getattr(self._connection.database, name)
+
+    def __getitem__(self, name):
+        return self._connection.database[name]
@@ -0,0 +1,82 @@
+import argparse
+import sys
+
+from bson.objectid import ObjectId
+from pymongo import MongoClient, ASCENDING, DESCENDING
+
+# Every query shape the request handlers issue, as
+# (collection, filter, sort). Keep in sync with server.py.
+HANDLER_QUERIES = [
+    # Login.post, requires_auth
+    ("users", {"username": "user"}, None),
+    # Trip.get list, first page and following pages
+    ("trips", {"username": "user"}, [("_id", ASCENDING)]),
+    ("trips", {"username": "user", "_id": {"$gt": ObjectId()}},
+     [("_id", ASCENDING)]),
+    # Trip.get by id, missing_or_unauthorized
+    ("trips", {"_id": ObjectId()}, None),
+    # Trip.put, Trip.delete
+    ("trips", {"_id": ObjectId(), "username": "user"}, None),
+    # TripBulk.post ownership check
+    ("trips", {"_id": {"$in": [ObjectId(), ObjectId()]}}, None),
+    # record_changes, latest entry
+    ("trip_changes", {"username": "user"}, [("seq", DESCENDING)]),
+    # TripChanges.get log page and current trips
+    ("trip_changes", {"username": "user", "seq": {"$gt": 0}},
+     [("seq", ASCENDING)]),
+    ("trips", {"_id": {"$in": [ObjectId()]}, "username": "user"}, None),
+    # TripSearch.get by date, name and waypoint location
+    ("trips", {"username": "user",
+               "start_date": {"$gte": "2016-01-01", "$lte": "2016-12-31"}},
+     [("start_date", ASCENDING), ("_id", ASCENDING)]),
+    ("trips", {"username": "user", "$text": {"$search": "road"}}, None),
+    ("trips", {"username": "user", "waypoints.location": {"$near": {
+        "$geometry": {"type": "Point", "coordinates": [-105.0, 39.7]}}}},
+     None),
+]
+
+
+# Walks an explain() plan and yields the name of every stage in it
+def plan_stages(plan):
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            for stage in plan_stages(value):
+                yield stage
+    elif isinstance(plan, list):
+        for item in plan:
+            for stage in plan_stages(item):
+                yield stage
+
+
+# Returns the handler queries whose winning plan scans a whole collection
+def collection_scans(db, queries=HANDLER_QUERIES):
+    offending = []
+    for collection, query, sort in queries:
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        winning_plan = cursor.explain()["queryPlanner"]["winningPlan"]
+        if "COLLSCAN" in plan_stages(winning_plan):
+            offending.append((collection, query, sort))
+    return offending
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Fail if any handler query is a collection scan")
+    parser.add_argument("--uri", default="mongodb://localhost:27017/")
+    parser.add_argument("--database", default="develop_database")
+    args = parser.parse_args(argv)
+
+    import server
+    db = MongoClient(args.uri)[args.database]
+    server.ensure_indexes(db)
+    offending = collection_scans(db)
+    for collection, query, sort in offending:
+        print("COLLSCAN on %s: find(%r) sort %r" % (collection, query, sort))
+    return 1 if offending else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,104 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+# Interface for token bucket stores. take() spends one token from the
+# bucket under `key`, which refills at `rate` tokens a second up to
+# `burst`, and returns (allowed, seconds until a token is available).
+class RateLimitBackend(object):
+
+    def take(self, key, rate, burst):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+# Buckets in process memory, each worker limiting on its own. Only the
+# `max_keys` most recently used buckets are kept; a dropped bucket was
+# idle long enough to have refilled anyway in all but abusive cases.
+class MemoryBuckets(RateLimitBackend):
+
+    def __init__(self, max_keys=100000, clock=time.monotonic):
+        self.max_keys = max_keys
+        self._clock = clock
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        now = self._clock()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return allowed, 0.0 if allowed else (1 - tokens) / rate
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+# Refill and spend in one step on the server, so concurrent workers can't
+# both take the last token
+TAKE_SCRIPT = """
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens),
+           'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(tokens)}
+"""
+
+
+# Buckets shared by every worker through Redis, on any client speaking
+# the redis-py register_script API
+class RedisBuckets(RateLimitBackend):
+
+    def __init__(self, client, prefix="trip-planner:rate:",
+                 clock=time.time):
+        self.client = client
+        self.prefix = prefix
+        self._clock = clock
+        self._take = client.register_script(TAKE_SCRIPT)
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        import redis
+        return cls(redis.StrictRedis.from_url(url), **kwargs)
+
+    def take(self, key, rate, burst):
+        allowed, tokens = self._take(keys=[self.prefix + key],
+                                     args=[rate, burst, self._clock()])
+        if allowed:
+            return True, 0.0
+        return False, (1 - float(tokens)) / rate
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + "*"):
+            self.client.delete(key)
+
+
+def create_rate_limiter(backend, max_keys, url=None):
+    if not backend:
+        return None
+    if backend == 'memory':
+        return MemoryBuckets(max_keys)
+    if backend == 'redis':
+        return RedisBuckets.from_url(url)
+    raise ValueError("Unknown rate limit backend: %s" % backend)
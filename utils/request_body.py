@@ -0,0 +1,49 @@
+import json
+
+from flask import g, request
+
+
+# Raised for bodies that are too large (413) or not what the handler
+# expects (400)
+class BodyError(Exception):
+
+    def __init__(self, status):
+        Exception.__init__(self, status)
+        self.status = status
+
+
+# Reads and decodes the JSON object sent with the current request, at most
+# once per request: the result is kept on flask.g for the auth decorator
+# and the handler to share. An empty body counts as {} so that GETs can
+# send their credentials in an Authorization header instead.
+def parsed_body(max_bytes):
+    body = getattr(g, '_parsed_body', None)
+    if body is not None:
+        return body
+    if request.content_length is not None and \
+            request.content_length > max_bytes:
+        raise BodyError(413)
+    data = request.stream.read(max_bytes + 1)
+    if len(data) > max_bytes:
+        raise BodyError(413)
+    if not data.strip():
+        body = {}
+    else:
+        try:
+            body = json.loads(data.decode('utf-8'))
+        except ValueError:
+            raise BodyError(400)
+        if not isinstance(body, dict):
+            raise BodyError(400)
+    g._parsed_body = body
+    return body
+
+
+# Checks a body against a {field: (types, required)} schema
+def validate(body, schema):
+    for field, (types, required) in schema.items():
+        if field not in body:
+            if required:
+                raise BodyError(400)
+        elif not isinstance(body[field], types):
+            raise BodyError(400)
@@ -0,0 +1,162 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+# Interface for caches of already encoded response bodies. Keys are str,
+# values bytes; implementations expire entries on their own.
+class CacheBackend(object):
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    # Stores `value` only if the entry is still `expected` (None for no
+    # entry), so a value computed from the state read alongside `expected`
+    # can't overwrite a newer one. Returns whether it was stored.
+    def set_if(self, key, expected, value):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+# In-process LRU bounded by the total size of the cached values
+class MemoryCache(CacheBackend):
+
+    def __init__(self, ttl=60, max_bytes=64 * 1024 * 1024,
+                 clock=time.monotonic):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires = entry
+            if expires <= self._clock():
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            self._store(key, value)
+
+    def set_if(self, key, expected, value):
+        if len(value) > self.max_bytes:
+            return False
+        with self._lock:
+            entry = self._entries.get(key)
+            current = None
+            if entry is not None and entry[1] > self._clock():
+                current = entry[0]
+            if current != expected:
+                return False
+            self._store(key, value)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _store(self, key, value):
+        self._remove(key)
+        self._entries[key] = (value, self._clock() + self.ttl)
+        self.size += len(value)
+        while self.size > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[0])
+
+
+# Compare and set in one step on the server; ARGV[1] is "1" when an entry
+# is expected, ARGV[2] its value
+SET_IF_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+if (ARGV[1] == '1' and current ~= ARGV[2]) or
+        (ARGV[1] == '0' and current ~= false) then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[3], 'EX', ARGV[4])
+return 1
+"""
+
+
+# Shared cache on any client speaking the redis-py get/set/delete and
+# register_script API; the memory cap is the server's maxmemory policy
+class RedisCache(CacheBackend):
+
+    def __init__(self, client, ttl=60, prefix="trip-planner:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self._set_if = client.register_script(SET_IF_SCRIPT)
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        import redis
+        return cls(redis.StrictRedis.from_url(url), **kwargs)
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, value, ex=int(self.ttl))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def set_if(self, key, expected, value):
+        return bool(self._set_if(
+            keys=[self.prefix + key],
+            args=["0" if expected is None else "1", expected or b"", value,
+                  int(self.ttl)]))
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + "*"):
+            self.client.delete(key)
+
+
+# Entry lifetimes in seconds when none is configured. An in-process cache
+# never hears of other workers' writes, so its entries are short-lived.
+DEFAULT_TTL = {'memory': 5, 'redis': 60}
+
+
+def create_cache(backend, ttl, max_bytes, url=None):
+    if not backend:
+        return None
+    if ttl is None:
+        ttl = DEFAULT_TTL.get(backend)
+    if backend == 'memory':
+        return MemoryCache(ttl, max_bytes)
+    if backend == 'redis':
+        return RedisCache.from_url(url, ttl=ttl)
+    raise ValueError("Unknown response cache backend: %s" % backend)
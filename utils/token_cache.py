@@ -0,0 +1,59 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+# Bounded, thread-safe LRU cache mapping usernames to their current auth
+# token. Entries expire after `ttl` seconds so tokens rotated by another
+# worker process are picked up again within that window.
+class TokenCache(object):
+
+    def __init__(self, max_size=10000, ttl=300, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, username):
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None:
+                self.misses += 1
+                return None
+            token, expires = entry
+            if expires <= self._clock():
+                del self._entries[username]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(username)
+            self.hits += 1
+            return token
+
+    def set(self, username, token):
+        with self._lock:
+            self._entries[username] = (token, self._clock() + self.ttl)
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, username):
+        with self._lock:
+            self._entries.pop(username, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses
+            }
@@ -0,0 +1,136 @@
+import calendar
+import datetime
+import threading
+import time
+import uuid
+
+from itsdangerous import BadData, URLSafeTimedSerializer
+from pymongo.errors import DuplicateKeyError
+
+
+# Ids of revoked tokens, each kept only until the token would have expired
+# on its own; after that the signature check rejects it anyway, so the
+# list stays as small as the number of recent revocations. It lives in
+# process memory, so with several workers a revocation only applies in the
+# worker that handled it; use MongoRevocationList or keep tokens
+# short-lived in that setup.
+class RevocationList(object):
+
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self._revoked = {}
+        self._lock = threading.Lock()
+
+    def revoke(self, token_id, expires_at):
+        with self._lock:
+            self._prune()
+            self._revoked[token_id] = expires_at
+
+    def is_revoked(self, token_id):
+        if not self._revoked:
+            return False
+        with self._lock:
+            expires_at = self._revoked.get(token_id)
+            return expires_at is not None and expires_at > self._clock()
+
+    def __len__(self):
+        return len(self._revoked)
+
+    def _prune(self):
+        now = self._clock()
+        for token_id in [token_id for token_id, expires_at
+                         in self._revoked.items() if expires_at <= now]:
+            del self._revoked[token_id]
+
+
+# Collection MongoRevocationList keeps revoked token ids in
+REVOKED_COLLECTION = "revoked_tokens"
+
+
+# Query for `token_id` if it is revoked and the token not yet expired
+def revoked_query(token_id, now):
+    return {"_id": token_id,
+            "expires_at": {"$gt": datetime.datetime.utcfromtimestamp(now)}}
+
+
+# RevocationList shared by every worker through a Mongo collection, at the
+# cost of a lookup per authenticated request. Expired ids are removed on
+# the next revocation.
+class MongoRevocationList(object):
+
+    def __init__(self, database, clock=time.time):
+        # Callable returning the database to use
+        self.database = database
+        self._clock = clock
+
+    def revoke(self, token_id, expires_at):
+        collection = getattr(self.database(), REVOKED_COLLECTION)
+        collection.delete_many({"expires_at": {
+            "$lte": datetime.datetime.utcfromtimestamp(self._clock())}})
+        try:
+            collection.insert_one({
+                "_id": token_id,
+                "expires_at": datetime.datetime.utcfromtimestamp(expires_at)
+            })
+        except DuplicateKeyError:
+            # Revoked already
+            pass
+
+    def is_revoked(self, token_id):
+        collection = getattr(self.database(), REVOKED_COLLECTION)
+        return collection.find_one(revoked_query(token_id, self._clock()),
+                                   {"_id": 1}) is not None
+
+
+def create_revocations(backend, database=None):
+    if backend == 'memory':
+        return RevocationList()
+    if backend == 'mongo':
+        return MongoRevocationList(database)
+    raise ValueError("Unknown revocation backend: %s" % backend)
+
+
+# HMAC-signed, expiring auth tokens that can be verified without a
+# database round trip
+class SignedTokens(object):
+
+    def __init__(self, secret_key, max_age=3600, salt='trip-planner-auth',
+                 revocations=None):
+        if not secret_key:
+            raise ValueError("Signed tokens need a SECRET_KEY")
+        self.max_age = max_age
+        self.revocations = revocations or RevocationList()
+        self._serializer = URLSafeTimedSerializer(secret_key, salt=salt)
+
+    def issue(self, username):
+        return self._serializer.dumps({"u": username,
+                                       "j": uuid.uuid4().hex})
+
+    def _load(self, token):
+        try:
+            payload, issued = self._serializer.loads(
+                token, max_age=self.max_age, return_timestamp=True)
+        except (BadData, TypeError):
+            return None, None
+        return payload, issued
+
+    # Id of `token` if it is validly signed, unexpired and issued to
+    # `username`, else None; revocation is left to the caller
+    def token_id(self, token, username):
+        payload, _ = self._load(token)
+        if payload is None or payload.get("u") != username:
+            return None
+        return payload.get("j")
+
+    def verify(self, token, username):
+        token_id = self.token_id(token, username)
+        return (token_id is not None and
+                not self.revocations.is_revoked(token_id))
+
+    def revoke(self, token):
+        payload, issued = self._load(token)
+        if payload is None:
+            return False
+        expires_at = calendar.timegm(issued.utctimetuple()) + self.max_age
+        self.revocations.revoke(payload.get("j"), expires_at)
+        return True
@@ -0,0 +1,170 @@
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+
+from utils.trip_search import DATE_FIELDS, check_location, iso_date
+
+# Trip fields a patch may not touch: identity, ownership and the version
+# stamp are the server's to set, and waypoints have their own operations
+PROTECTED_FIELDS = ("_id", "username", "version", "updated_at", "waypoints")
+# Fields every trip must keep, with their types
+REQUIRED_FIELDS = {"name": str}
+
+
+def waypoint_id(value):
+    try:
+        return ObjectId(value)
+    except (InvalidId, TypeError):
+        raise ValueError("Invalid waypoint id: %r" % (value,))
+
+
+# Copy of a client supplied waypoint with an ObjectId `_id`: a valid one it
+# already has is kept, so PATCH paths stay valid across a PUT of a fetched
+# trip, otherwise a new one is assigned
+def waypoint_document(value):
+    if not isinstance(value, dict):
+        raise ValueError("A waypoint must be an object")
+    waypoint = dict(value)
+    try:
+        waypoint["_id"] = ObjectId(waypoint.get("_id"))
+    except (InvalidId, TypeError):
+        waypoint["_id"] = ObjectId()
+    if "location" in waypoint:
+        check_location(waypoint["location"])
+    return waypoint
+
+
+def waypoint_documents(values):
+    if not isinstance(values, list):
+        raise ValueError("waypoints must be a list")
+    return [waypoint_document(value) for value in values]
+
+
+# Splits a JSON Pointer ("/waypoints/<id>/name") into its unescaped parts
+def pointer_parts(path):
+    if not isinstance(path, str) or not path.startswith("/"):
+        raise ValueError("Invalid path: %r" % (path,))
+    parts = [part.replace("~1", "/").replace("~0", "~")
+             for part in path[1:].split("/")]
+    for part in parts:
+        if not part or part.startswith("$") or "." in part:
+            raise ValueError("Invalid path: %r" % (path,))
+    return parts
+
+
+# Translates a JSON-Patch style list of operations into one Mongo update
+# document and its array filters, so a change costs what it touches:
+#
+#   {"op": "add" | "replace", "path": "/<field>", "value"}   -> $set
+#   {"op": "remove", "path": "/<field>"}                     -> $unset
+#   {"op": "add", "path": "/waypoints/-" | "/waypoints/<index>",
+#    "value": {...}}                                         -> $push
+#   {"op": "remove", "path": "/waypoints/<waypoint id>"}     -> $pull
+#   {"op": "replace", "path": "/waypoints/<waypoint id>[/<field>]",
+#    "value"}                                                -> $set
+#
+# Waypoints are addressed by id rather than index so edits made against a
+# slightly stale copy still land on the intended stop. Mongo can't push,
+# pull and set into the same array in one update, so a patch sticks to
+# one kind of waypoint operation; several adds must all append.
+#
+# Returns (update, array_filters, query): `query` is what the trip must
+# also match, every waypoint the patch removes or replaces, so a patch
+# naming a missing one applies nothing.
+def patch_update(operations):
+    if not isinstance(operations, list) or not operations:
+        raise ValueError("A patch is a non-empty list of operations")
+    sets = {}
+    unsets = {}
+    pushes = []
+    position = None
+    pulls = []
+    array_filters = []
+    # waypoint id -> its array filter identifier and the fields set in it
+    targets = {}
+    for operation in operations:
+        if not isinstance(operation, dict):
+            raise ValueError("An operation must be an object")
+        op = operation.get("op")
+        parts = pointer_parts(operation.get("path"))
+        if op in ("add", "replace") and "value" not in operation:
+            raise ValueError("%s needs a value" % op)
+        value = operation.get("value")
+
+        if parts[0] != "waypoints":
+            if len(parts) != 1 or parts[0] in PROTECTED_FIELDS:
+                raise ValueError("Can't patch %s" % operation["path"])
+            if parts[0] in sets or parts[0] in unsets:
+                raise ValueError("%s patched twice" % operation["path"])
+            if op in ("add", "replace"):
+                if (parts[0] in REQUIRED_FIELDS and
+                        not isinstance(value, REQUIRED_FIELDS[parts[0]])):
+                    raise ValueError("Invalid %s" % parts[0])
+                if parts[0] in DATE_FIELDS:
+                    iso_date(value)
+                sets[parts[0]] = value
+            elif op == "remove" and parts[0] not in REQUIRED_FIELDS:
+                unsets[parts[0]] = ""
+            else:
+                raise ValueError("Unsupported operation: %r" % (op,))
+        elif op == "add" and len(parts) == 2:
+            if parts[1] != "-":
+                try:
+                    index = int(parts[1])
+                except ValueError:
+                    raise ValueError("Invalid waypoint index: %r" % parts[1])
+                if pushes or index < 0:
+                    raise ValueError("Only one waypoint can be inserted at "
+                                     "an index")
+                position = index
+            elif position is not None:
+                raise ValueError("Only one waypoint can be inserted at an "
+                                 "index")
+            pushes.append(waypoint_document(value))
+        elif op == "remove" and len(parts) == 2:
+            pulls.append(waypoint_id(parts[1]))
+        elif op == "replace" and len(parts) in (2, 3):
+            target = waypoint_id(parts[1])
+            if target not in targets:
+                name = "w%d" % len(array_filters)
+                array_filters.append({name + "._id": target})
+                targets[target] = (name, set())
+            name, fields = targets[target]
+            # None stands for the whole waypoint, which overlaps any field
+            field = parts[2] if len(parts) == 3 else None
+            if field in fields or None in fields or (field is None and
+                                                     fields):
+                raise ValueError("%s patched twice" % operation["path"])
+            fields.add(field)
+            if field is None:
+                if not isinstance(value, dict):
+                    raise ValueError("A waypoint must be an object")
+                sets["waypoints.$[%s]" % name] = waypoint_document(
+                    dict(value, _id=target))
+            elif field == "_id":
+                raise ValueError("Can't change a waypoint's id")
+            else:
+                if field == "location":
+                    check_location(value)
+                sets["waypoints.$[%s].%s" % (name, field)] = value
+        else:
+            raise ValueError("Unsupported operation on %s: %r" %
+                             (operation["path"], op))
+    if sum(1 for kind in (pushes, pulls, array_filters) if kind) > 1:
+        raise ValueError("A patch can only add, remove or replace waypoints")
+
+    update = {}
+    if sets:
+        update["$set"] = sets
+    if unsets:
+        update["$unset"] = unsets
+    if pushes:
+        push = {"$each": pushes}
+        if position is not None:
+            push["$position"] = position
+        update["$push"] = {"waypoints": push}
+    if pulls:
+        update["$pull"] = {"waypoints": {"_id": {"$in": pulls}}}
+    query = {}
+    if pulls or targets:
+        query["waypoints._id"] = {"$all": pulls + list(targets)}
+    return update, array_filters, query
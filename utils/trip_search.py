@@ -0,0 +1,105 @@
+import datetime
+
+from pymongo import ASCENDING
+
+# Trip fields holding ISO 8601 dates ("2016-07-04"), which sort and compare
+# correctly as strings
+DATE_FIELDS = ("start_date", "end_date")
+
+
+def iso_date(value):
+    try:
+        datetime.datetime.strptime(value, "%Y-%m-%d")
+    except (TypeError, ValueError):
+        raise ValueError("Invalid date: %r" % (value,))
+    return value
+
+
+def coordinates(value, count):
+    try:
+        numbers = [float(number) for number in value.split(",")]
+    except (AttributeError, ValueError):
+        raise ValueError("Invalid coordinates: %r" % (value,))
+    if len(numbers) != count:
+        raise ValueError("Expected %d coordinates: %r" % (count, value))
+    for lng, lat in zip(numbers[::2], numbers[1::2]):
+        if not (-180 <= lng <= 180 and -90 <= lat <= 90):
+            raise ValueError("Coordinates out of range: %r" % (value,))
+    return numbers
+
+
+# GeoJSON point {"type": "Point", "coordinates": [lng, lat]}, as 2dsphere
+# indexes expect it; anything else would make the trip's insert fail
+def check_location(location):
+    if (not isinstance(location, dict) or location.get("type") != "Point" or
+            not isinstance(location.get("coordinates"), list)):
+        raise ValueError("A location must be a GeoJSON Point")
+    point = location["coordinates"]
+    if (len(point) != 2 or
+            not all(isinstance(number, (int, float)) and
+                    not isinstance(number, bool) for number in point)):
+        raise ValueError("A location must be a GeoJSON Point")
+    lng, lat = point
+    if not (-180 <= lng <= 180 and -90 <= lat <= 90):
+        raise ValueError("Coordinates out of range: %r" % (point,))
+    return location
+
+
+# Builds (filter, projection, sort) for GET /trips/search from its query
+# parameters, raising ValueError for bad ones:
+#
+#   q=<words>                     text search on the trip name
+#   from=<date>, to=<date>        start_date within the range
+#   near=<lng>,<lat>[&max_distance=<meters>]
+#                                 trips with a waypoint near a point
+#   within=<min lng>,<min lat>,<max lng>,<max lat>
+#                                 trips with a waypoint inside a box
+#
+# Text matches come best first, near matches closest first, everything
+# else by start_date. Mongo can't combine $text with $near, so q and near
+# are exclusive.
+def search_query(args, username):
+    query = {"username": username}
+    projection = None
+    sort = [("start_date", ASCENDING), ("_id", ASCENDING)]
+
+    if args.get("from") or args.get("to"):
+        dates = {}
+        if args.get("from"):
+            dates["$gte"] = iso_date(args["from"])
+        if args.get("to"):
+            dates["$lte"] = iso_date(args["to"])
+        query["start_date"] = dates
+
+    if args.get("q") and args.get("near"):
+        raise ValueError("q and near can't be combined")
+    if args.get("q"):
+        query["$text"] = {"$search": args["q"]}
+        projection = {"score": {"$meta": "textScore"}}
+        sort = [("score", {"$meta": "textScore"})]
+
+    if args.get("near") and args.get("within"):
+        raise ValueError("near and within can't be combined")
+    if args.get("near"):
+        near = {"$geometry": {"type": "Point",
+                              "coordinates": coordinates(args["near"], 2)}}
+        if args.get("max_distance"):
+            try:
+                near["$maxDistance"] = float(args["max_distance"])
+            except ValueError:
+                raise ValueError("Invalid max_distance")
+            if near["$maxDistance"] < 0:
+                raise ValueError("Invalid max_distance")
+        query["waypoints.location"] = {"$near": near}
+        # $near already returns the closest first
+        sort = None
+    elif args.get("within"):
+        min_lng, min_lat, max_lng, max_lat = coordinates(args["within"], 4)
+        if min_lng >= max_lng or min_lat >= max_lat:
+            raise ValueError("Invalid box: %r" % args["within"])
+        query["waypoints.location"] = {"$geoWithin": {"$geometry": {
+            "type": "Polygon",
+            "coordinates": [[[min_lng, min_lat], [max_lng, min_lat],
+                             [max_lng, max_lat], [min_lng, max_lat],
+                             [min_lng, min_lat]]]}}}
+    return query, projection, sort
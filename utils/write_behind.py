@@ -0,0 +1,144 @@
+import atexit
+import os
+import threading
+from collections import OrderedDict, deque
+
+from pymongo import InsertOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+
+# Queues inserts nobody waits on (audit events) and sends them from a
+# background thread as bulk_write batches, once `batch_size` are pending
+# or `interval` seconds after the first one, so requests don't pay a round
+# trip each. The queue holds at most `max_pending` documents; past that
+# insert() refuses and the caller decides whether to write synchronously
+# or let it go. Whatever is pending is written on close() and at
+# interpreter exit.
+class WriteBehind(object):
+
+    def __init__(self, database, max_pending=10000, batch_size=500,
+                 interval=0.1):
+        # Callable returning the database to write to
+        self.database = database
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.interval = interval
+        self.written = 0
+        self.refused = 0
+        self.failed = 0
+        self._reset()
+
+    # Fresh state for this process; a forked child starts with an empty
+    # queue and no thread, the parent still owns what it had queued
+    def _reset(self):
+        # (collection, document), oldest first
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        # Held while a batch is taken and written, so documents reach
+        # Mongo in the order they were queued
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        self._pid = os.getpid()
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    # Queues insert_one(document); False if the queue is full or closed
+    def insert(self, collection, document):
+        if self._pid != os.getpid():
+            self._reset()
+        with self._lock:
+            if self._closed or len(self._pending) >= self.max_pending:
+                self.refused += 1
+                return False
+            self._pending.append((collection, document))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name="write-behind")
+                self._thread.daemon = True
+                self._thread.start()
+                atexit.register(self.close)
+            if len(self._pending) in (1, self.batch_size):
+                self._wake.notify()
+            return True
+
+    # Writes everything pending on the calling thread. Stops early, leaving
+    # the rest queued, if Mongo can't be reached.
+    def flush(self):
+        while True:
+            with self._write_lock:
+                with self._lock:
+                    batch = []
+                    while self._pending and len(batch) < self.batch_size:
+                        batch.append(self._pending.popleft())
+                if not batch or not self._write(batch):
+                    return
+
+    # Sends a batch, one unordered bulk_write per collection. Returns False
+    # if it had to be requeued.
+    def _write(self, batch):
+        requests = OrderedDict()
+        for collection, document in batch:
+            requests.setdefault(collection, []).append(InsertOne(document))
+        try:
+            database = self.database()
+            for collection, operations in list(requests.items()):
+                try:
+                    database[collection].bulk_write(operations,
+                                                    ordered=False)
+                    self.written += len(operations)
+                except BulkWriteError as e:
+                    # Rejected by the server; retrying won't change that
+                    failed = len(e.details["writeErrors"])
+                    self.failed += failed
+                    self.written += len(operations) - failed
+                del requests[collection]
+        except PyMongoError:
+            # Network trouble or a failover: retried on the next flush
+            self._requeue([(collection, document)
+                           for collection, document in batch
+                           if collection in requests])
+            return False
+        return True
+
+    # Puts back inserts that didn't go out, ahead of any queued since
+    def _requeue(self, batch):
+        with self._lock:
+            self._pending.extendleft(reversed(batch))
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._pending and not self._closed:
+                    self._wake.wait()
+                # Give writes a moment to accumulate into a batch
+                if not self._closed and len(self._pending) < self.batch_size:
+                    self._wake.wait(self.interval)
+                closed = self._closed
+            self.flush()
+            if closed:
+                return
+
+    # Stops the thread once what is pending has been written; later
+    # writes are refused. Called at interpreter exit too.
+    def close(self, timeout=5):
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            self._closed = True
+            self._wake.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+            atexit.unregister(self.close)
+            if thread.is_alive():
+                return
+        else:
+            self.flush()
+        # Whatever is still pending (Mongo unreachable) is lost
+        with self._lock:
+            self.failed += len(self._pending)
+            self._pending.clear()